@@ -0,0 +1,65 @@
+import sys
+import types
+import pytest
+
+# pace_util needs pyhamilton and the reader, pump and shaker packages, which only live on the robot's PC.
+# Tests that import it (or robot_method, or sim_instruments) ask for stub_instruments: just enough of those
+# packages for the sim_instruments stand-ins, with pyhamilton's command names spelled as pyhamilton does.
+
+class Labware:
+    def __init__(self, name):
+        self.name = name
+
+    def layout_name(self):
+        return self.name
+
+    def position_id(self, idx):
+        return 'ABCDEFGH'[idx%8] + str(idx//8 + 1)
+
+    def well_coords(self, idx):
+        return idx%8, idx//8
+
+class ResourceType:
+    def __init__(self, res_class, test, name_from_line=None):
+        self.res_class = res_class
+        self.name = test if isinstance(test, str) else None
+
+class LayoutManager:
+    def __init__(self, layfile):
+        self.num_assigned = 0
+
+    def assign_unused_resource(self, res_type, order_key=None, reverse=False):
+        self.num_assigned += 1
+        return res_type.res_class((res_type.name or 'resource_') + str(self.num_assigned))
+
+    layline_objid = layline_first_field = staticmethod(lambda line: line)
+    field_starts_with = staticmethod(lambda field, prefix: True)
+
+pyhamilton_commands = {'INITIALIZE': 'initialize', 'PICKUP': 'pickup', 'EJECT': 'eject',
+        'ASPIRATE': 'aspirate', 'DISPENSE': 'dispense', 'ISWAP_GET': 'iSwapGet', 'ISWAP_PLACE': 'iSwapPlace',
+        'HEPA': 'hepaFan', 'WASH96_EMPTY': 'wash96Empty', 'PICKUP96': 'mph96TipPickUp', 'EJECT96': 'mph96TipEject',
+        'ASPIRATE96': 'mph96Aspirate', 'DISPENSE96': 'mph96Dispense'}
+
+def stub_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__file__ = '<stub ' + name + '>' # pace_util reports where each package came from
+    module.__dict__.update(attrs)
+    return module
+
+@pytest.fixture
+def stub_instruments(monkeypatch):
+    stubs = [stub_module('pyhamilton', HamiltonInterface=object, LayoutManager=LayoutManager,
+                         ResourceType=ResourceType, Plate24=Labware, Plate96=Labware, Tip96=Labware,
+                         oemerr=Exception, PositionError=type('PositionError', (Exception,), {}),
+                         **pyhamilton_commands),
+             stub_module('platereader'), stub_module('platereader.clariostar', ClarioStar=object, PlateData=object),
+             stub_module('auxpump'), stub_module('auxpump.pace', OffDeckCulturePumps=object, LBPumps=object),
+             stub_module('auxshaker'), stub_module('auxshaker.bigbear', Shaker=object)]
+    for module in stubs:
+        monkeypatch.setitem(sys.modules, module.__name__, module)
+    imported_with_stubs = ('pace_util', 'sim_instruments', 'robot_method')
+    for name in imported_with_stubs:
+        monkeypatch.delitem(sys.modules, name, raising=False)
+    yield
+    for name in imported_with_stubs: # don't leave them bound to the stubs for later tests
+        sys.modules.pop(name, None)
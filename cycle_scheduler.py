@@ -0,0 +1,106 @@
+import time
+import logging
+from threading import Thread, Condition
+
+class Task:
+    def __init__(self, name, func, resources=(), deps=(), priority=0):
+        self.name = name
+        self.func = func
+        self.resources = tuple(resources)
+        self.deps = tuple(deps)
+        self.priority = priority
+        self.result = None
+        self.exception = None
+        self.start_time = self.end_time = None
+        self.status = 'waiting' # -> 'running' -> 'done' | 'error'
+
+    def __repr__(self):
+        return 'Task(' + self.name + ', ' + self.status + ')'
+
+class ResourceScheduler:
+    '''
+    Runs a dependency graph of tasks, each of which holds a set of named resources (instruments) for as
+    long as it runs. A task starts as soon as every task it depends on is done and all of its resources
+    are free; among tasks that could start, lower priority values go first. Tasks run on their own
+    threads, so anything not contending for the same resource overlaps. A dependency's return value is
+    available to later tasks as dep.result. If a task raises, nothing new is started, the running tasks
+    are allowed to finish, and run() re-raises the first exception.
+    '''
+    def __init__(self, resources, clock=time.time):
+        self.resources = tuple(resources)
+        self.clock = clock
+        self.tasks = []
+        self.last_run = [] # tasks of the latest run(), with their start and end times
+        self.busy_time = {res: 0.0 for res in self.resources}
+        self.elapsed_time = 0.0
+
+    def add(self, name, func, resources=(), deps=(), priority=0):
+        unknown = [res for res in resources if res not in self.resources]
+        if unknown:
+            raise ValueError('Unknown resources ' + str(unknown) + ' for task ' + name)
+        task = Task(name, func, resources, deps, priority)
+        self.tasks.append(task)
+        return task
+
+    def run(self):
+        pending = sorted(self.tasks, key=lambda task: task.priority) # stable, so ties go in order added
+        self.tasks = []
+        self.last_run = list(pending)
+        held = set()
+        running = []
+        first_error = None
+        done = Condition()
+        start_time = self.clock()
+
+        def go(task):
+            try:
+                result, exception = task.func(), None
+            except Exception as e:
+                result, exception = None, e
+            with done: # the task's outcome, end time and status all change together
+                task.result, task.exception = result, exception
+                task.end_time = self.clock()
+                task.status = 'done' if exception is None else 'error'
+                done.notify_all()
+
+        with done:
+            while pending or running:
+                if first_error is None:
+                    for task in list(pending):
+                        if held.intersection(task.resources):
+                            continue
+                        if any(dep.status != 'done' for dep in task.deps):
+                            if any(dep.status == 'error' for dep in task.deps):
+                                pending.remove(task) # can never run
+                            continue
+                        pending.remove(task)
+                        held.update(task.resources)
+                        task.status = 'running'
+                        task.start_time = self.clock()
+                        running.append(task)
+                        Thread(target=go, args=(task,), daemon=True).start()
+                    if not running and pending:
+                        raise ValueError('Tasks can never start (dependency cycle or missing dependency): ' +
+                                str(pending))
+                elif not running:
+                    break
+                done.wait()
+                for task in [task for task in running if task.status in ('done', 'error')]:
+                    running.remove(task)
+                    held.difference_update(task.resources)
+                    for res in task.resources:
+                        self.busy_time[res] += task.end_time - task.start_time
+                    if task.status == 'error' and first_error is None:
+                        first_error = task.exception
+        self.elapsed_time += self.clock() - start_time
+        if first_error is not None:
+            raise first_error
+
+    def utilization(self):
+        '''Fraction of the time spent in run() that each resource was held, over all runs so far'''
+        if not self.elapsed_time:
+            return {res: 0.0 for res in self.resources}
+        return {res: self.busy_time[res]/self.elapsed_time for res in self.resources}
+
+    def log_utilization(self):
+        logging.info('RESOURCE UTILIZATION ' + str({res: round(frac, 3) for res, frac in self.utilization().items()}))
@@ -0,0 +1,374 @@
+import os
+import time
+import json
+import hashlib
+import queue
+import atexit
+import logging
+import sqlite3
+from datetime import datetime
+from threading import Thread, Lock
+
+meas_columns = ('lagoon_number', 'filename', 'plate_id', 'timestamp', 'well', 'measurement_delay_time', 'reading',
+                'data_type', 'plate_number', 'time_str')
+legacy_meas_columns = meas_columns[:8]
+meas_schema_version = 2
+
+def ensure_meas_table_exists(db_conn):
+    '''
+    Definitions of the fields in this table:
+    lagoon_number - the number of the lagoon, uniquely identifying the experiment, zero-indexed
+    filename - absolute path to the file in which this data is housed
+    plate_id - ID field given when measurement was requested, should match ID in data file
+    timestamp - time at which the measurement was taken, in seconds since the epoch
+    well - the location in the plate reader plate where this sample was read, e.g. 'B2'
+    measurement_delay_time - the time, in minutes, after the sample was pipetted that the
+                            measurement was taken. For migration, we consider this to be 0
+                            minutes in the absense of pipetting time values
+    reading - the raw measured value from the plate reader
+    data_type - 'lum' 'abs' or the spectra values for the fluorescence measurement
+    plate_number - which plate of lagoons the lagoon is on, zero-indexed
+    time_str - the time as recorded in the plate reader data file header
+
+    Databases with the old untyped table (no plate_number) are migrated in place first.
+    '''
+    c = db_conn.cursor()
+    existing_cols = [row[1] for row in c.execute('PRAGMA table_info(measurements)')]
+    if existing_cols and 'plate_number' not in existing_cols:
+        migrate_meas_table(db_conn)
+    create_meas_table(db_conn, 'measurements')
+    db_conn.commit()
+
+def create_meas_table(db_conn, table_name):
+    c = db_conn.cursor()
+    c.execute('''CREATE TABLE if not exists ''' + table_name + '''
+                (lagoon_number INTEGER, filename TEXT, plate_id TEXT, timestamp REAL, well TEXT,
+                 measurement_delay_time REAL, reading REAL, data_type TEXT, plate_number INTEGER, time_str TEXT)''')
+
+def create_meas_indexes(db_conn):
+    c = db_conn.cursor()
+    c.execute('CREATE INDEX if not exists meas_lagoon_type_time ON measurements (lagoon_number, data_type, timestamp)')
+    c.execute('CREATE INDEX if not exists meas_well_type ON measurements (well, data_type)')
+    c.execute('PRAGMA user_version = ' + str(meas_schema_version))
+
+def epoch_from_filename(filename):
+    '''Plate reader data files end in _yymmdd_HHMM.<ext>; None if this one doesn't (e.g. dummy reads)'''
+    try:
+        return datetime.strptime(filename[-15:-4], '%y%m%d_%H%M').timestamp()
+    except (ValueError, TypeError):
+        return None
+
+def typed_row(row):
+    '''Full measurements row from either a full row or an old-style 8-column one'''
+    if len(row) == len(meas_columns):
+        return tuple(row)
+    lagoon_number, filename, plate_id, time_str, well, measurement_delay_time, reading, data_type = row
+    lagoon_number = None if lagoon_number is None else int(lagoon_number)
+    return (lagoon_number, filename, plate_id, epoch_from_filename(filename), well,
+            measurement_delay_time, reading, data_type,
+            None if lagoon_number is None else lagoon_number//96, None if time_str is None else str(time_str))
+
+def migrate_meas_table(db_conn, chunk_size=10000, progress=None):
+    '''
+    Convert an old untyped measurements table to the typed, indexed one in place. Rows are streamed
+    across in chunks so memory use doesn't depend on the size of the database; the swap at the end
+    happens in one transaction, so an interrupted migration leaves the old table untouched.
+    '''
+    c = db_conn.cursor()
+    c.execute('DROP TABLE if exists measurements_migrating')
+    create_meas_table(db_conn, 'measurements_migrating')
+    c.execute('BEGIN')
+    read_cursor = db_conn.cursor()
+    read_cursor.execute('SELECT ' + ', '.join(legacy_meas_columns) + ' FROM measurements ORDER BY rowid')
+    num_rows = 0
+    while True:
+        rows = read_cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        c.executemany('INSERT INTO measurements_migrating (' + ', '.join(meas_columns) + ') VALUES (' +
+                ','.join('?'*len(meas_columns)) + ')', [typed_row(row) for row in rows])
+        num_rows += len(rows)
+        if progress:
+            progress(num_rows)
+    c.execute('DROP TABLE measurements')
+    c.execute('ALTER TABLE measurements_migrating RENAME TO measurements')
+    create_meas_indexes(db_conn)
+    db_conn.commit()
+    logging.info('Migrated ' + str(num_rows) + ' measurements to schema version ' + str(meas_schema_version))
+    return num_rows
+
+def plate_data_rows(plate_data, data_type, plate, vessel_numbers, read_wells):
+    '''Rows for the measurements table, one per read well, from one plate reader data file'''
+    filename = plate_data.path
+    plate_id = plate_data.header.plate_ids[0]
+    time_str = str(plate_data.header.time)
+    timestamp = epoch_from_filename(filename)
+    if timestamp is None:
+        timestamp = time.time()
+    measurement_delay_time = 0.0
+    return [(lagoon_number, filename, plate_id, timestamp, plate.position_id(read_well), measurement_delay_time,
+             plate_data.value_at(*plate.well_coords(read_well)), data_type, lagoon_number//96, time_str)
+            for lagoon_number, read_well in zip(vessel_numbers, read_wells)]
+
+class MeasurementDB:
+    '''
+    Persistent connection to the measurements database. Everything passed to one add_rows() call is
+    written with a single executemany in a single transaction, so a whole plate read (absorbance and
+    all fluorescence channels) costs one commit. Failed transactions are rolled back and retried with
+    backoff, up to max_retries times; what happened is counted in self.stats.
+    '''
+    def __init__(self, db_path, journal_mode='WAL', max_retries=8, retry_wait=1, max_retry_wait=30):
+        self.db_path = db_path
+        # retries before add_rows raises, about 2 minutes in with the default waits; None to keep trying
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.stats = {'transactions': 0, 'rows': 0, 'retries': 0, 'failures': 0,
+                      'retry_wait_time': 0.0, 'last_transaction_time': None, 'last_error': None}
+        self.conn = sqlite3.connect(db_path, timeout=10)
+        if journal_mode:
+            self.conn.execute('PRAGMA journal_mode=' + journal_mode)
+        ensure_meas_table_exists(self.conn)
+        create_meas_indexes(self.conn)
+        self.conn.commit()
+
+    def add_rows(self, rows):
+        rows = [typed_row(row) for row in rows]
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                with self.conn: # commits, or rolls back on exception
+                    self.conn.executemany('INSERT INTO measurements (' + ', '.join(meas_columns) + ') VALUES (' +
+                            ','.join('?'*len(meas_columns)) + ')', rows)
+                break
+            except (sqlite3.OperationalError, IOError) as e: # Unknown why error has been happening. Maybe Dropbox.
+                attempt += 1
+                self.stats['retries'] += 1
+                self.stats['last_error'] = repr(e)
+                if self.max_retries is not None and attempt > self.max_retries:
+                    self.stats['failures'] += 1
+                    raise
+                wait = min(self.max_retry_wait, self.retry_wait*2**(attempt - 1))
+                logging.warning('MeasurementDB: transaction of ' + str(len(rows)) + ' rows failed (' + repr(e) +
+                        '), retry ' + str(attempt) + ' in ' + str(wait) + 's')
+                time.sleep(wait)
+                self.stats['retry_wait_time'] += wait
+        self.stats['transactions'] += 1
+        self.stats['rows'] += len(rows)
+        self.stats['last_transaction_time'] = time.time() - start_time
+
+    def add_plate_reads(self, plate, vessel_numbers, read_wells, platedatas_by_type):
+        '''platedatas_by_type: (data_type, plate_data) pairs from one plate read; all written together'''
+        rows = []
+        for data_type, plate_data in platedatas_by_type:
+            rows += plate_data_rows(plate_data, data_type, plate, vessel_numbers, read_wells)
+        self.add_rows(rows)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+local_spool_dir = os.path.join(os.path.expanduser('~'), '.meas_spool') # off the synced folder the database is in
+
+def default_spool_path(db_path):
+    # one spool per database, named for it (and its full path, so databases with the same name don't share one)
+    db_path = os.path.abspath(db_path)
+    return os.path.join(local_spool_dir, os.path.basename(db_path) + '.' +
+                        hashlib.md5(db_path.encode()).hexdigest()[:8] + '.spool')
+
+class BackgroundMeasurementWriter:
+    '''
+    Same add_rows/add_plate_reads interface as MeasurementDB, but rows are handed through a queue to writer
+    threads so the robot loop never waits on the disk or the database: add_rows only queues the batch. A
+    spool thread appends each batch to a spool file (JSON lines, by default in a local directory rather than
+    next to the database, which may be on a synced drive) and passes it on to the database thread, which
+    marks it done in the spool once committed. So anything spooled but not yet in the database survives a
+    crash and is replayed on the next start. At most max_memory_rows spooled rows are held in memory; beyond
+    that the database thread reads batches back from the spool. A batch that fails to commit is set aside
+    and retried, from the spool, once the writer next catches up on the batches after it. close() (also run
+    at exit) flushes everything.
+    '''
+    def __init__(self, db_path, spool_path=None, max_memory_rows=96*4*50, **db_options):
+        self.db_path = db_path
+        self.db_options = db_options
+        self.spool_path = spool_path if spool_path is not None else default_spool_path(db_path)
+        spool_dir = os.path.dirname(os.path.abspath(self.spool_path))
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+        self.max_memory_rows = max_memory_rows
+        self.stats = {'batches_submitted': 0, 'batches_written': 0, 'rows_written': 0,
+                      'batches_spooled_only': 0, 'batches_replayed': 0, 'batches_retried': 0, 'write_errors': 0}
+        self.db_stats = {}
+        self._queue = queue.Queue() # (batch id, rows) from add_rows to the spool thread
+        self._db_queue = queue.Queue() # (batch id, spool offset, number of rows, rows or None) to the database thread
+        self._lock = Lock() # guards the backlog counters only, and is never held during I/O
+        self._spool_lock = Lock() # guards the spool file, between the two writer threads
+        self._pending_batches = 0
+        self._pending_rows = 0
+        self._memory_rows = 0
+        self._failed = [] # (spool offset, rows) of batches that failed to commit, not counted as pending
+        self._next_id = 0
+        self._replay_spool()
+        self._spool_thread = Thread(target=self._spool_run, daemon=True)
+        self._spool_thread.start()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def backlog(self):
+        '''(batches, rows) submitted but not yet committed'''
+        with self._lock:
+            return (self._pending_batches + len(self._failed),
+                    self._pending_rows + sum(num_rows for _, num_rows in self._failed))
+
+    def add_rows(self, rows):
+        rows = [list(row) for row in rows]
+        with self._lock:
+            batch_id = self._next_id
+            self._next_id += 1
+            self._pending_batches += 1
+            self._pending_rows += len(rows)
+            self.stats['batches_submitted'] += 1
+        self._queue.put((batch_id, rows))
+
+    def add_plate_reads(self, plate, vessel_numbers, read_wells, platedatas_by_type):
+        rows = []
+        for data_type, plate_data in platedatas_by_type:
+            rows += plate_data_rows(plate_data, data_type, plate, vessel_numbers, read_wells)
+        self.add_rows(rows)
+
+    def close(self, timeout=None):
+        if self._spool_thread.is_alive():
+            self._queue.put(None) # passed on to the database thread once everything before it is spooled
+            self._spool_thread.join(timeout)
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _spool_append(self, record):
+        # returns the byte offset of the record; caller holds the spool lock (or is the constructor)
+        with open(self.spool_path, 'a') as f:
+            offset = f.tell()
+            f.write(json.dumps(record, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        return offset
+
+    def _spool_read(self, offset):
+        with self._spool_lock, open(self.spool_path) as f:
+            f.seek(offset)
+            return json.loads(f.readline())['rows']
+
+    def _replay_spool(self):
+        if not os.path.isfile(self.spool_path):
+            return
+        batches = {}
+        with open(self.spool_path) as f:
+            offset = f.tell()
+            for line in iter(f.readline, ''):
+                try:
+                    record = json.loads(line)
+                except ValueError: # torn last line from a crash mid-write
+                    break
+                if 'done' in record:
+                    batches.pop(record['done'], None)
+                else:
+                    batches[record['batch']] = offset, len(record['rows'])
+                offset = f.tell()
+            self._next_id = max([b for b in batches] + [-1]) + 1
+        if not batches:
+            os.remove(self.spool_path)
+            return
+        num_replayed = self._respool([offset for batch_id, (offset, _) in sorted(batches.items())])
+        self.stats['batches_replayed'] += num_replayed
+        logging.info('BackgroundMeasurementWriter: replaying ' + str(num_replayed) + ' uncommitted batches from spool')
+
+    def _respool(self, offsets):
+        # start a fresh spool holding only the batches at these offsets, and queue them to be written again;
+        # caller holds the spool lock, or is the constructor
+        with open(self.spool_path) as f:
+            records = []
+            for offset in offsets:
+                f.seek(offset)
+                records.append(json.loads(f.readline()))
+        os.replace(self.spool_path, self.spool_path + '.old')
+        for record in records:
+            offset = self._spool_append(record)
+            with self._lock:
+                self._pending_batches += 1
+                self._pending_rows += len(record['rows'])
+            self._db_queue.put((record['batch'], offset, len(record['rows']), None))
+        os.remove(self.spool_path + '.old')
+        return len(records)
+
+    def _spool_run(self):
+        # makes each submitted batch durable in the spool, then hands it to the database thread
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._db_queue.put(None)
+                break
+            batch_id, rows = item
+            with self._spool_lock:
+                offset = self._spool_append({'batch': batch_id, 'rows': rows})
+            with self._lock:
+                keep_in_memory = self._memory_rows + len(rows) <= self.max_memory_rows
+                if keep_in_memory:
+                    self._memory_rows += len(rows)
+                else:
+                    self.stats['batches_spooled_only'] += 1
+            self._db_queue.put((batch_id, offset, len(rows), rows if keep_in_memory else None))
+
+    def _run(self):
+        db = MeasurementDB(self.db_path, **self.db_options) # sqlite connections belong to the thread that made them
+        self.db_stats = db.stats
+        try:
+            while True:
+                item = self._db_queue.get()
+                if item is None:
+                    break
+                batch_id, offset, num_rows, rows = item
+                in_memory = rows is not None
+                if not in_memory:
+                    rows = self._spool_read(offset)
+                try:
+                    db.add_rows(rows)
+                    failed = False
+                except Exception:
+                    failed = True
+                    logging.exception('BackgroundMeasurementWriter: batch ' + str(batch_id) +
+                            ' left in spool, to retry once the writer catches up')
+                with self._lock:
+                    self._pending_batches -= 1
+                    self._pending_rows -= num_rows
+                    if in_memory:
+                        self._memory_rows -= num_rows
+                    if failed:
+                        self.stats['write_errors'] += 1
+                        self._failed.append((offset, num_rows))
+                        continue
+                    self.stats['batches_written'] += 1
+                    self.stats['rows_written'] += num_rows
+                with self._spool_lock:
+                    self._spool_append({'done': batch_id})
+                    with self._lock: # a batch counted as pending is spooled only after it gets the spool lock
+                        caught_up = self._pending_batches == 0
+                        failed, self._failed = (self._failed, []) if caught_up else ([], self._failed)
+                    if caught_up: # everything else committed; spool can start over
+                        if failed: # with just the failed batches, queued again
+                            self.stats['batches_retried'] += self._respool([offset for offset, _ in failed])
+                        else:
+                            os.remove(self.spool_path)
+        finally:
+            db.close()
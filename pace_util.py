@@ -1,7 +1,9 @@
 #!python3
 
-import sys, os, time, logging, importlib
-from threading import Thread
+import sys, os, time, json, gzip, shutil, queue, logging, logging.handlers, importlib
+from threading import Thread, Lock
+from contextlib import contextmanager
+from collections import deque
 
 this_file_dir = os.path.dirname(__file__)
 methods_dir = os.path.abspath(os.path.join(this_file_dir, '..', '..', '..'))
@@ -57,47 +59,197 @@ def compound_pos_str(pos_tuples):
 def compound_pos_str_96(labware96):
     return ';'.join((labware_pos_str(labware96, idx) for idx in range(96)))
 
-def initialize(ham, async=False):
-    logging.info('initialize: ' + ('a' if async else '') + 'synchronously initialize the robot')
-    cmd = ham.send_command(INITIALIZE)
-    if not async:
-        ham.wait_on_response(cmd, raise_first_exception=True)
+command_names = {str(cmd): name for cmd, name in ((INITIALIZE, 'INITIALIZE'), (PICKUP, 'PICKUP'), (EJECT, 'EJECT'),
+        (ASPIRATE, 'ASPIRATE'), (DISPENSE, 'DISPENSE'), (ISWAP_GET, 'ISWAP_GET'), (ISWAP_PLACE, 'ISWAP_PLACE'),
+        (HEPA, 'HEPA'), (WASH96_EMPTY, 'WASH96_EMPTY'), (PICKUP96, 'PICKUP96'), (EJECT96, 'EJECT96'),
+        (ASPIRATE96, 'ASPIRATE96'), (DISPENSE96, 'DISPENSE96'))}
+latency_buckets = (.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120, 300, float('inf')) # seconds
+
+class LatencyHistogram:
+    '''Streaming latency summary: counts per bucket, count, sum, min, max and a moving average'''
+    def __init__(self, buckets=latency_buckets, ewma_weight=.1):
+        self.buckets = buckets
+        self.bucket_counts = [0]*len(buckets)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.min = self.max = None
+        self.ewma = None # weights recent commands, so a step that is creeping up shows before the mean moves
+        self.ewma_weight = ewma_weight
+
+    def observe(self, seconds, error=False):
+        for i, upper in enumerate(self.buckets):
+            if seconds <= upper:
+                self.bucket_counts[i] += 1
+                break
+        self.count += 1
+        self.errors += bool(error)
+        self.sum += seconds
+        self.min = seconds if self.min is None else min(self.min, seconds)
+        self.max = seconds if self.max is None else max(self.max, seconds)
+        self.ewma = seconds if self.ewma is None else self.ewma + self.ewma_weight*(seconds - self.ewma)
+
+    def quantile(self, q):
+        # upper edge of the bucket holding the q-th quantile, capped at the largest value seen
+        if not self.count:
+            return None
+        running = 0
+        for upper, count in zip(self.buckets, self.bucket_counts):
+            running += count
+            if running >= q*self.count:
+                return min(upper, self.max)
+        return self.max
+
+    def cumulative_counts(self):
+        running = 0
+        for count in self.bucket_counts:
+            running += count
+            yield running
+
+class CommandMetrics:
+    '''
+    Latency of every robot command round trip (send_command until its wait_on_response returns), per command
+    and channel pattern, plus anything else timed with timed(), e.g. plate reads. snapshot() gives the
+    histograms as a dict; write_snapshot() saves them as JSON, or as Prometheus text if the file ends in .prom.
+    clock can be swapped, e.g. for a virtual clock in simulation.
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.histograms = {} # (command, channel pattern): LatencyHistogram
+        self._sent = {} # (interface id, command id): (command, channel pattern, send time)
+        self._lock = Lock()
+
+    def observe(self, command, seconds, channels='', error=False):
+        with self._lock:
+            key = command, channels
+            if key not in self.histograms:
+                self.histograms[key] = LatencyHistogram()
+            self.histograms[key].observe(seconds, error)
+
+    def sent(self, ham_int, cmd_id, cmd, channels=''):
+        with self._lock:
+            self._sent[id(ham_int), cmd_id] = command_names.get(str(cmd), str(cmd)), channels, self.clock()
+
+    def responded(self, ham_int, cmd_id, error=False):
+        with self._lock:
+            sent = self._sent.pop((id(ham_int), cmd_id), None)
+        if sent is not None:
+            command, channels, send_time = sent
+            self.observe(command, self.clock() - send_time, channels, error)
+
+    @contextmanager
+    def timed(self, name):
+        start = self.clock()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observe(name, self.clock() - start, error=error)
+
+    def snapshot(self):
+        with self._lock:
+            return {'time': self.clock(), 'commands': [
+                {'command': command, 'channels': channels, 'count': hist.count, 'errors': hist.errors,
+                 'sum': hist.sum, 'mean': hist.sum/hist.count, 'min': hist.min, 'max': hist.max, 'ewma': hist.ewma,
+                 'p50': hist.quantile(.5), 'p90': hist.quantile(.9), 'p99': hist.quantile(.99),
+                 'buckets': {str(upper): count for upper, count in zip(hist.buckets, hist.cumulative_counts())}}
+                for (command, channels), hist in sorted(self.histograms.items())]}
+
+    def prometheus_text(self):
+        lines = ['# HELP pace_command_seconds Robot command round trip latency',
+                 '# TYPE pace_command_seconds histogram']
+        error_lines = ['# HELP pace_command_errors_total Robot commands that returned an error',
+                       '# TYPE pace_command_errors_total counter']
+        with self._lock:
+            for (command, channels), hist in sorted(self.histograms.items()):
+                labels = 'command="' + command + '",channels="' + channels + '"'
+                for upper, count in zip(hist.buckets, hist.cumulative_counts()):
+                    le = '+Inf' if upper == float('inf') else repr(float(upper))
+                    lines.append('pace_command_seconds_bucket{' + labels + ',le="' + le + '"} ' + str(count))
+                lines.append('pace_command_seconds_sum{' + labels + '} ' + repr(hist.sum))
+                lines.append('pace_command_seconds_count{' + labels + '} ' + str(hist.count))
+                error_lines.append('pace_command_errors_total{' + labels + '} ' + str(hist.errors))
+        return '\n'.join(lines + error_lines) + '\n'
+
+    def write_snapshot(self, path):
+        # written to a temp file and swapped in, so a scraper never reads half a snapshot
+        if path.endswith('.prom'):
+            contents = self.prometheus_text()
+        else:
+            contents = json.dumps(self.snapshot(), indent=1)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+command_metrics = CommandMetrics()
+
+def send_command(ham_int, cmd, **params):
+    # ham_int.send_command, timed into command_metrics until the matching wait_on_response
+    cmd_id = ham_int.send_command(cmd, **params)
+    command_metrics.sent(ham_int, cmd_id, cmd, params.get('channelVariable', ''))
+    return cmd_id
+
+def wait_on_response(ham_int, cmd_id, **kwargs):
+    try:
+        response = ham_int.wait_on_response(cmd_id, **kwargs)
+    except Exception:
+        command_metrics.responded(ham_int, cmd_id, error=True)
+        raise
+    command_metrics.responded(ham_int, cmd_id)
+    return response
+
+def initialize(ham, async_=False):
+    log_event('initialize', 'initialize: %ssynchronously initialize the robot', 'a' if async_ else '')
+    cmd = send_command(ham, INITIALIZE)
+    if not async_:
+        wait_on_response(ham, cmd, raise_first_exception=True)
     return cmd
 
-def hepa_on(ham, speed=15, async=False, **more_options):
-    logging.info('hepa_on: turn on HEPA filter at ' + str(speed) + '% capacity' +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
-    cmd = ham.send_command(HEPA, fanSpeed=speed, **more_options)
-    if not async:
-        ham.wait_on_response(cmd, raise_first_exception=True)
+def hepa_on(ham, speed=15, async_=False, **more_options):
+    options = dict(more_options)
+    log_event('hepa_on', 'hepa_on: turn on HEPA filter at %s%% capacity%s', speed, LazyStr(options_str, options),
+            speed=speed, options=options)
+    cmd = send_command(ham, HEPA, fanSpeed=speed, **more_options)
+    if not async_:
+        wait_on_response(ham, cmd, raise_first_exception=True)
     return cmd
 
-def wash_empty_refill(ham, async=False, **more_options):
-    logging.info('wash_empty_refill: empty the washer' +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
-    cmd = ham.send_command(WASH96_EMPTY, **more_options)
-    if not async:
-        ham.wait_on_response(cmd, raise_first_exception=True)
+def wash_empty_refill(ham, async_=False, **more_options):
+    options = dict(more_options)
+    log_event('wash_empty_refill', 'wash_empty_refill: empty the washer%s', LazyStr(options_str, options),
+            options=options)
+    cmd = send_command(ham, WASH96_EMPTY, **more_options)
+    if not async_:
+        wait_on_response(ham, cmd, raise_first_exception=True)
     return cmd
 
-def move_plate(ham, source_plate, target_plate, try_inversions=None):
-    logging.info('move_plate: Moving plate ' + source_plate.layout_name() + ' to ' + target_plate.layout_name())
+def move_plate(ham, source_plate, target_plate, try_inversions=None, pipeline=None):
+    # with a pipeline, the grip is still waited on (a failed grip is retried inverted), but the place is
+    # returned as a CommandFuture; its PositionError is not converted to IOError
+    log_event('move_plate', 'move_plate: Moving plate %s to %s', LazyStr(source_plate.layout_name),
+            LazyStr(target_plate.layout_name), source=source_plate, target=target_plate)
     src_pos = labware_pos_str(source_plate, 0)
     trgt_pos = labware_pos_str(target_plate, 0)
     if try_inversions is None:
         try_inversions = (0, 1)
+    if pipeline is not None:
+        pipeline.wait_all() # earlier commands have to succeed before we grab the plate
     for inv in try_inversions:
-        cid = ham.send_command(ISWAP_GET, plateLabwarePositions=src_pos, gripHeight=6, inverseGrip=inv)
+        cid = send_command(ham, ISWAP_GET, plateLabwarePositions=src_pos, gripHeight=6, inverseGrip=inv)
         try:
-            ham.wait_on_response(cid, raise_first_exception=True, timeout=120)
+            wait_on_response(ham, cid, raise_first_exception=True, timeout=120)
             break
         except PositionError:
             pass
     else:
         raise IOError
-    cid = ham.send_command(ISWAP_PLACE, plateLabwarePositions=trgt_pos)
+    if pipeline is not None:
+        return pipeline.submit(ISWAP_PLACE, timeout=120, plateLabwarePositions=trgt_pos)
+    cid = send_command(ham, ISWAP_PLACE, plateLabwarePositions=trgt_pos)
     try:
-        ham.wait_on_response(cid, raise_first_exception=True, timeout=120)
+        wait_on_response(ham, cid, raise_first_exception=True, timeout=120)
     except PositionError:
         raise IOError
 
@@ -118,19 +270,22 @@ def offset_equal_spaced_idxs(start_idx, increment):
         idx += increment
 
 def read_plate(ham_int, reader_int, reader_site, plate, protocol_names, plate_id=None, async_task=None, plate_destination=None):
-    logging.info('read_plate: Running plate protocols ' + ', '.join(protocol_names) +
-            ' on plate ' + plate.layout_name() + ('' if plate_id is None else ' with id ' + plate_id))
-    reader_int.plate_out(block=True)
-    move_plate(ham_int, plate, reader_site)
-    if async_task:
-        t = run_async(async_task)
-    plate_datas = reader_int.run_protocols(protocol_names, plate_id_1=plate_id)
-    reader_int.plate_out(block=True)
-    while async_task and t.is_alive():
-        t.join(.1)
-    if plate_destination is None:
-        plate_destination = plate
-    move_plate(ham_int, reader_site, plate_destination)
+    log_event('read_plate', 'read_plate: Running plate protocols %s on plate %s%s', LazyStr(', '.join, protocol_names),
+            LazyStr(plate.layout_name), '' if plate_id is None else ' with id ' + plate_id,
+            protocols=protocol_names, plate=plate, plate_id=plate_id)
+    with command_metrics.timed('READ_PLATE'):
+        reader_int.plate_out(block=True)
+        move_plate(ham_int, plate, reader_site)
+        if async_task:
+            t = run_async(async_task)
+        with command_metrics.timed('RUN_PROTOCOLS'):
+            plate_datas = reader_int.run_protocols(protocol_names, plate_id_1=plate_id)
+        reader_int.plate_out(block=True)
+        while async_task and t.is_alive():
+            t.join(.1)
+        if plate_destination is None:
+            plate_destination = plate
+        move_plate(ham_int, reader_site, plate_destination)
     return plate_datas
 
 def channel_var(pos_tuples):
@@ -140,37 +295,137 @@ def channel_var(pos_tuples):
             ch_var[i] = '1'
     return ''.join(ch_var)
 
-def tip_pick_up(ham_int, pos_tuples, **more_options):
-    logging.info('tip_pick_up: Pick up tips at ' + '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+class CommandCancelledError(Exception):
+    pass
+
+class CommandFuture:
+    '''A robot command submitted to a CommandPipeline; result() waits for it like wait_on_response'''
+    def __init__(self, pipeline, cmd, timeout, params):
+        self.pipeline = pipeline
+        self.cmd = cmd
+        self.timeout = timeout
+        self.params = params
+        self.id = None
+        self.status = 'queued' # -> 'sent' -> 'done' | 'error'; or 'cancelled' if never sent
+        self._response = None
+        self._exception = None
+
+    def done(self):
+        return self.status in ('done', 'error', 'cancelled')
+
+    def result(self):
+        while not self.done():
+            self.pipeline._wait_oldest()
+        if self._exception is not None:
+            raise self._exception
+        return self._response
+
+class CommandPipeline:
+    '''
+    Future-based alternative to sending a command and immediately blocking on it. submit() sends a
+    command and returns right away, so the caller can prepare the next one (position strings, volumes,
+    logging) while the robot executes; the next submit() waits for the robot only when max_in_flight
+    commands are already out. On the first error, nothing more is sent: later submissions come back
+    cancelled and wait_all() raises that first error. Use as a context manager to wait for everything
+    at the end of a block.
+    '''
+    def __init__(self, ham_int, max_in_flight=1):
+        # with the default of 1, a command is only sent once the previous one succeeded, so a failed
+        # aspirate can never be followed by a dispense that was already on its way to the robot
+        self.ham_int = ham_int
+        self.max_in_flight = max_in_flight
+        self.in_flight = deque()
+        self.error = None
+
+    def submit(self, cmd, timeout=None, **params):
+        future = CommandFuture(self, cmd, timeout, params)
+        while len(self.in_flight) >= self.max_in_flight and self.error is None:
+            self._wait_oldest()
+        if self.error is not None:
+            future.status = 'cancelled'
+            future._exception = CommandCancelledError('Not sent because an earlier command failed: ' + repr(self.error))
+            return future
+        future.id = send_command(self.ham_int, cmd, **params)
+        future.status = 'sent'
+        self.in_flight.append(future)
+        return future
+
+    def _wait_oldest(self):
+        future = self.in_flight.popleft()
+        wait_kwargs = {} if future.timeout is None else {'timeout': future.timeout}
+        try:
+            future._response = wait_on_response(self.ham_int, future.id, raise_first_exception=True, **wait_kwargs)
+            future.status = 'done'
+        except Exception as e:
+            future._exception = e
+            future.status = 'error'
+            if self.error is None:
+                self.error = e
+
+    def wait_all(self):
+        while self.in_flight:
+            self._wait_oldest()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        # stop sending; commands already sent still have to finish on the robot, but their errors are dropped
+        if self.error is None:
+            self.error = CommandCancelledError('Pipeline cancelled')
+        while self.in_flight:
+            self._wait_oldest()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.cancel()
+            return False
+        self.wait_all()
+
+def run_command(ham_int, cmd, pipeline=None, timeout=None, **params):
+    # send one command and wait for it, or hand it to a pipeline and return its CommandFuture
+    if pipeline is not None:
+        return pipeline.submit(cmd, timeout=timeout, **params)
+    wait_kwargs = {} if timeout is None else {'timeout': timeout}
+    return wait_on_response(ham_int, send_command(ham_int, cmd, **params), raise_first_exception=True, **wait_kwargs)
+
+def tip_pick_up(ham_int, pos_tuples, pipeline=None, **more_options):
+    options = dict(more_options)
+    log_event('tip_pick_up', 'tip_pick_up: Pick up tips at %s%s', LazyStr(positions_str, pos_tuples),
+            LazyStr(options_str, options), positions=pos_tuples, options=options)
     num_channels = len(pos_tuples)
     if num_channels > 8:
         raise ValueError('Can only pick up 8 tips at a time')
     ch_patt = channel_var(pos_tuples)
     labware_poss = compound_pos_str(pos_tuples)
-    ham_int.wait_on_response(ham_int.send_command(PICKUP,
+    return run_command(ham_int, PICKUP, pipeline,
         labwarePositions=labware_poss,
         channelVariable=ch_patt,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
-def tip_eject(ham_int, pos_tuples=None, **more_options):
+def tip_eject(ham_int, pos_tuples=None, pipeline=None, **more_options):
     if pos_tuples is None:
-        logging.info('tip_eject: Eject tips to default waste' + ('' if not more_options else ' with extra options ' + str(more_options)))
+        options = dict(more_options)
+        log_event('tip_eject', 'tip_eject: Eject tips to default waste%s', LazyStr(options_str, options),
+                positions=None, options=options)
         more_options['useDefaultWaste'] = 1
         dummy = Tip96('')
         pos_tuples = [(dummy, 0)] * 8
     else:
-        logging.info('tip_eject: Eject tips to ' + '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-                ('' if not more_options else ' with extra options ' + str(more_options)))
+        options = dict(more_options)
+        log_event('tip_eject', 'tip_eject: Eject tips to %s%s', LazyStr(positions_str, pos_tuples),
+                LazyStr(options_str, options), positions=pos_tuples, options=options)
     num_channels = len(pos_tuples)
     if num_channels > 8:
         raise ValueError('Can only eject up to 8 tips')
     ch_patt = channel_var(pos_tuples)
     labware_poss = compound_pos_str(pos_tuples)
-    ham_int.wait_on_response(ham_int.send_command(EJECT,
+    return run_command(ham_int, EJECT, pipeline,
         labwarePositions=labware_poss,
         channelVariable=ch_patt,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
 default_liq_class = 'HighVolumeFilter_Water_DispenseJet_Empty_with_transport_vol'
 
@@ -178,75 +433,260 @@ def assert_parallel_nones(list1, list2):
     if not (len(list1) == len(list2) and all([(i1 is None) == (i2 is None) for i1, i2 in zip(list1, list2)])):
         raise ValueError('Lists must have parallel None entries')
 
-def aspirate(ham_int, pos_tuples, vols, **more_options):
+def aspirate(ham_int, pos_tuples, vols, pipeline=None, **more_options):
     assert_parallel_nones(pos_tuples, vols)
-    logging.info('aspirate: Aspirate volumes ' + str(vols) + ' from positions [' +
-            '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            (']' if not more_options else '] with extra options ' + str(more_options)))
+    options = dict(more_options) # a copy, since defaults get filled into more_options after this is logged
+    log_event('aspirate', 'aspirate: Aspirate volumes %s from positions [%s]%s', vols, LazyStr(positions_str, pos_tuples),
+            LazyStr(options_str, options), vols=vols, positions=pos_tuples, options=options)
     if len(pos_tuples) > 8:
         raise ValueError('Can only aspirate with 8 channels at a time')
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(ASPIRATE,
+    return run_command(ham_int, ASPIRATE, pipeline,
         channelVariable=channel_var(pos_tuples),
         labwarePositions=compound_pos_str(pos_tuples),
         volumes=[v for v in vols if v is not None],
-        **more_options), raise_first_exception=True)
+        **more_options)
 
-def dispense(ham_int, pos_tuples, vols, **more_options):
+def dispense(ham_int, pos_tuples, vols, pipeline=None, **more_options):
     assert_parallel_nones(pos_tuples, vols)
-    logging.info('dispense: Dispense volumes ' + str(vols) + ' into positions [' +
-            '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples)) +
-            (']' if not more_options else '] with extra options ' + str(more_options)))
+    options = dict(more_options)
+    log_event('dispense', 'dispense: Dispense volumes %s into positions [%s]%s', vols, LazyStr(positions_str, pos_tuples),
+            LazyStr(options_str, options), vols=vols, positions=pos_tuples, options=options)
     if len(pos_tuples) > 8:
         raise ValueError('Can only aspirate with 8 channels at a time')
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(DISPENSE,
+    return run_command(ham_int, DISPENSE, pipeline,
         channelVariable=channel_var(pos_tuples),
         labwarePositions=compound_pos_str(pos_tuples),
         volumes=[v for v in vols if v is not None],
-        **more_options), raise_first_exception=True)
+        **more_options)
 
-def tip_pick_up_96(ham_int, tip96, **more_options):
-    logging.info('tip_pick_up_96: Pick up tips at ' + tip96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+def tip_pick_up_96(ham_int, tip96, pipeline=None, **more_options):
+    options = dict(more_options)
+    log_event('tip_pick_up_96', 'tip_pick_up_96: Pick up tips at %s%s', LazyStr(tip96.layout_name),
+            LazyStr(options_str, options), tips=tip96, options=options)
     labware_poss = compound_pos_str_96(tip96)
-    ham_int.wait_on_response(ham_int.send_command(PICKUP96,
+    return run_command(ham_int, PICKUP96, pipeline,
         labwarePositions=labware_poss,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
-def tip_eject_96(ham_int, tip96=None, **more_options):
-    logging.info('tip_eject_96: Eject tips to ' + (tip96.layout_name() if tip96 else 'default waste') +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+def tip_eject_96(ham_int, tip96=None, pipeline=None, **more_options):
+    options = dict(more_options)
+    log_event('tip_eject_96', 'tip_eject_96: Eject tips to %s%s', LazyStr(tip96.layout_name) if tip96 else 'default waste',
+            LazyStr(options_str, options), tips=tip96, options=options)
     if tip96 is None:
         labware_poss = ''
         more_options.update({'tipEjectToKnownPosition':2}) # 2 is default waste
     else:   
         labware_poss = compound_pos_str_96(tip96)
-    ham_int.wait_on_response(ham_int.send_command(EJECT96,
+    return run_command(ham_int, EJECT96, pipeline,
         labwarePositions=labware_poss,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
-def aspirate_96(ham_int, plate96, vol, **more_options):
-    logging.info('aspirate_96: Aspirate volume ' + str(vol) + ' from ' + plate96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+def aspirate_96(ham_int, plate96, vol, pipeline=None, **more_options):
+    options = dict(more_options)
+    log_event('aspirate_96', 'aspirate_96: Aspirate volume %s from %s%s', vol, LazyStr(plate96.layout_name),
+            LazyStr(options_str, options), vol=vol, plate=plate96, options=options)
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(ASPIRATE96,
+    return run_command(ham_int, ASPIRATE96, pipeline,
         labwarePositions=compound_pos_str_96(plate96),
         aspirateVolume=vol,
-        **more_options), raise_first_exception=True)
+        **more_options)
 
-def dispense_96(ham_int, plate96, vol, **more_options):
-    logging.info('dispense_96: Dispense volume ' + str(vol) + ' into ' + plate96.layout_name() +
-            ('' if not more_options else ' with extra options ' + str(more_options)))
+def dispense_96(ham_int, plate96, vol, pipeline=None, **more_options):
+    options = dict(more_options)
+    log_event('dispense_96', 'dispense_96: Dispense volume %s into %s%s', vol, LazyStr(plate96.layout_name),
+            LazyStr(options_str, options), vol=vol, plate=plate96, options=options)
     if 'liquidClass' not in more_options:
         more_options.update({'liquidClass':default_liq_class})
-    ham_int.wait_on_response(ham_int.send_command(DISPENSE96,
+    return run_command(ham_int, DISPENSE96, pipeline,
         labwarePositions=compound_pos_str_96(plate96),
         dispenseVolume=vol,
-        **more_options), raise_first_exception=True)
+        **more_options)
+
+class LazyStr:
+    '''Builds its string only when str() is called, i.e. when a handler actually formats the log record'''
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return self.func(*self.args)
+
+def positions_str(pos_tuples):
+    return '; '.join((labware_pos_str(*pt) if pt else '(skip)' for pt in pos_tuples))
+
+def options_str(more_options):
+    return '' if not more_options else ' with extra options ' + str(more_options)
+
+def values_str(values):
+    return str(values.tolist() if hasattr(values, 'tolist') else list(values))
+
+def log_event(event, msg, *args, level=logging.INFO, **fields):
+    '''
+    Log msg % args, where args are rendered only if some handler formats the record, so wrap anything
+    costly in a LazyStr. event and fields (the raw values, not strings) ride along on the record for
+    structured sinks such as add_structured_log(). Nothing is built at all when the level is disabled.
+    '''
+    logger = logging.getLogger()
+    if logger.isEnabledFor(level):
+        logger.log(level, msg, *args, extra={'event': event, 'fields': fields})
+
+def structured_value(value):
+    # JSON stand-in for the objects log fields hold: labware by layout name, numpy arrays as lists
+    if hasattr(value, 'layout_name'):
+        return value.layout_name()
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+class StructuredFormatter(logging.Formatter):
+    '''One compact JSON object per record: time, level, event and fields, or the message for plain records'''
+    def format(self, record):
+        entry = {'t': round(record.created, 3), 'level': record.levelname}
+        event = getattr(record, 'event', None)
+        if event is None:
+            entry['msg'] = record.getMessage()
+        else:
+            entry['event'] = event
+            entry.update(record.fields)
+        return json.dumps(entry, separators=(',', ':'), default=structured_value)
+
+def add_structured_log(log_path, logger_name=None, level=logging.INFO, **rotation):
+    # INFO by default: every record it takes is formatted once for each sink, and the DEBUG chatter the
+    # instrument packages send to the root logger would double the formatting work for no use to tools
+    return add_file_log(log_path, StructuredFormatter(), logger_name, level, **rotation)
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    '''
+    Rolls the log over once it reaches max_bytes or has been open for rotate_seconds, whichever comes
+    first, and gzips the old segment (name.1.gz, name.2.gz, ...), keeping backup_count of them. The age of
+    a segment carries over restarts, so a method restarted more often than rotate_seconds still rotates.
+    '''
+    def __init__(self, filename, max_bytes=50*2**20, rotate_seconds=24*60*60, backup_count=30, encoding=None):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding=encoding)
+        self.rotate_seconds = rotate_seconds
+        self.namer = lambda name: name + '.gz'
+        self.rotator = self.compress
+        self.rollover_at = self.segment_start() + rotate_seconds
+
+    def segment_start(self):
+        # when the current file was started: the last rollover wrote name.1.gz just before opening it; with no
+        # rollover yet, the file's creation time where the platform keeps one, else its last modification
+        if not os.path.getsize(self.baseFilename):
+            return time.time()
+        last_backup = self.rotation_filename(self.baseFilename + '.1')
+        if os.path.exists(last_backup):
+            return os.path.getmtime(last_backup)
+        stat = os.stat(self.baseFilename)
+        return getattr(stat, 'st_birthtime', stat.st_mtime)
+
+    @staticmethod
+    def compress(source, dest):
+        with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.remove(source)
+
+    def shouldRollover(self, record):
+        return time.time() >= self.rollover_at or super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        self.rollover_at = time.time() + self.rotate_seconds
+
+class AsyncLogHandler(logging.Handler):
+    '''
+    Passes records through a bounded queue to a writer thread that hands them on to handlers, so a slow
+    disk or a stalled synced folder never holds up the thread doing the logging. Records are not formatted
+    until the writer gets to them. When the queue is full, records below block_level are dropped; at or
+    above it, the caller waits up to block_timeout for room before dropping. What happened is counted in
+    stats, and the writer logs how many records were dropped once it catches up.
+    '''
+    def __init__(self, *handlers, max_queue=10000, block_level=logging.WARNING, block_timeout=1.0,
+                 close_timeout=10.0):
+        super().__init__()
+        self.handlers = handlers
+        self.block_level = block_level
+        self.block_timeout = block_timeout
+        self.close_timeout = close_timeout
+        self.stats = {'written': 0, 'dropped': 0, 'blocked': 0, 'blocked_time': 0.0}
+        self._reported_drops = 0
+        self._queue = queue.Queue(max_queue)
+        self._thread = Thread(target=self._write, daemon=True)
+        self._thread.start()
+        async_log_handlers.append(self)
+
+    def emit(self, record):
+        # called with self.lock held, so the stats need no further locking
+        try:
+            self._queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if record.levelno >= self.block_level:
+            self.stats['blocked'] += 1
+            start = time.time()
+            try:
+                self._queue.put(record, timeout=self.block_timeout)
+                return
+            except queue.Full:
+                pass
+            finally:
+                self.stats['blocked_time'] += time.time() - start
+        self.stats['dropped'] += 1
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            self._handle(record)
+            self.stats['written'] += 1
+            dropped = self.stats['dropped']
+            if dropped > self._reported_drops and self._queue.empty():
+                self._handle(logging.makeLogRecord({'name': 'AsyncLogHandler', 'levelno': logging.WARNING,
+                        'levelname': 'WARNING', 'msg': 'Dropped %s log records while the log queue was full',
+                        'args': (dropped - self._reported_drops,)}))
+                self._reported_drops = dropped
+
+    def _handle(self, record):
+        for hdlr in self.handlers:
+            if record.levelno >= hdlr.level:
+                hdlr.handle(record)
+
+    def close(self):
+        # waits up to close_timeout for what's queued to be written; a writer stuck on a stalled disk is left
+        # to its daemon thread, along with its handlers, rather than holding up the exit
+        if self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=self.close_timeout) # everything already queued is written first
+            except queue.Full:
+                pass
+            self._thread.join(self.close_timeout)
+        if not self._thread.is_alive():
+            for hdlr in self.handlers:
+                hdlr.close()
+        super().close()
+
+async_log_handlers = []
+
+def add_file_log(log_path, formatter=None, logger_name=None, level=logging.DEBUG, **rotation):
+    # a rotating, compressing log file written from a background thread; rotation is passed to
+    # CompressingRotatingFileHandler. Returns the AsyncLogHandler added to the logger.
+    file_hdlr = CompressingRotatingFileHandler(log_path, **rotation)
+    file_hdlr.setFormatter(formatter or logging.Formatter('[%(asctime)s] %(name)s %(levelname)s %(message)s'))
+    hdlr = AsyncLogHandler(file_hdlr)
+    hdlr.setLevel(level)
+    logging.getLogger(logger_name).addHandler(hdlr) # root logger if None
+    return hdlr
+
+def async_log_stats():
+    # {log file: counters} for every AsyncLogHandler
+    return {getattr(hdlr.handlers[0], 'baseFilename', str(i)): dict(hdlr.stats)
+            for i, hdlr in enumerate(async_log_handlers)}
 
 def add_robot_level_log(logger_name=None):
     logger = logging.getLogger(logger_name) # root logger if None
@@ -254,27 +694,37 @@ def add_robot_level_log(logger_name=None):
     with open(os.path.join(user_dir, '.roboid')) as roboid_f:
         robot_id = roboid_f.read()
     robot_log_dir = os.path.join(global_log_dir, robot_id, robot_id + '.log')
-    hdlr = logging.FileHandler(robot_log_dir)
-    formatter = logging.Formatter('[%(asctime)s] %(name)s %(levelname)s %(message)s')
-    hdlr.setFormatter(formatter)
-    logger.addHandler(hdlr)
+    return add_file_log(robot_log_dir, logger_name=logger_name) # off the control thread, as the folder is synced
 
 class StderrLogger:
+    # logs whole lines, so a traceback written a piece at a time doesn't become dozens of records
     def __init__(self, level):
         self.level = level
         self.stderr = sys.stderr
+        self.partial_line = ''
 
     def write(self, message):
         self.stderr.write(message)
-        if message.strip():
-            self.level(message.replace('\n', ''))
+        *lines, self.partial_line = (self.partial_line + message).split('\n')
+        for line in lines:
+            if line.strip():
+                self.level(line)
+
+    def flush(self):
+        if self.partial_line.strip():
+            self.level(self.partial_line)
+        self.partial_line = ''
+        self.stderr.flush()
 
 def add_stderr_logging(logger_name=None):
     logger = logging.getLogger(logger_name) # root logger if None
     sys.stderr = StderrLogger(logger.error)
 
 fileflag_dir = os.path.abspath('.')
-while fileflag_dir and os.path.basename(fileflag_dir).lower() != 'discrete-turb': # different from std-96-pace
+while os.path.basename(fileflag_dir).lower() != 'discrete-turb': # different from std-96-pace
+    if os.path.dirname(fileflag_dir) == fileflag_dir: # reached the root; not run from inside the method
+        fileflag_dir = os.path.abspath(this_file_dir)
+        break
     fileflag_dir = os.path.dirname(fileflag_dir)
 fileflag_dir = os.path.join(fileflag_dir, 'method_local', 'flags')
 
@@ -4,63 +4,26 @@ import os
 import sys
 import time
 import logging
-import sqlite3
 import csv
-from turb_control import ParamEstTurbCtrlr
+import numpy as np
+from turb_control import ParamEstTurbCtrlrBank
+from meas_db import BackgroundMeasurementWriter
+from cycle_scheduler import ResourceScheduler
+from service_plan import plan_service, plan_service_96, Head96ServicePlan
+from telemetry import TelemetryWriter
 from types import SimpleNamespace
 
 this_file_dir = os.path.dirname(os.path.abspath(__file__))
 method_local_dir = os.path.join(this_file_dir, 'method_local')
 containing_dirname = os.path.basename(os.path.dirname(this_file_dir))
 
-def ensure_meas_table_exists(db_conn):
-    '''
-    Definitions of the fields in this table:
-    lagoon_number - the number of the lagoon, uniquely identifying the experiment, zero-indexed
-    filename - absolute path to the file in which this data is housed
-    plate_id - ID field given when measurement was requested, should match ID in data file
-    timestamp - time at which the measurement was taken
-    well - the location in the plate reader plate where this sample was read, e.g. 'B2'
-    measurement_delay_time - the time, in minutes, after the sample was pipetted that the
-                            measurement was taken. For migration, we consider this to be 0
-                            minutes in the absense of pipetting time values
-    reading - the raw measured value from the plate reader
-    data_type - 'lum' 'abs' or the spectra values for the fluorescence measurement
-    '''
-    c = db_conn.cursor()
-    c.execute('''CREATE TABLE if not exists measurements
-                (lagoon_number, filename, plate_id, timestamp, well, measurement_delay_time, reading, data_type)''')
-    db_conn.commit()
-
-def db_add_plate_data(plate_data, data_type, plate, vessel_numbers, read_wells):
-    db_conn = sqlite3.connect(os.path.join(method_local_dir, containing_dirname + '.db'))
-    ensure_meas_table_exists(db_conn)
-    c = db_conn.cursor()
-    for lagoon_number, read_well in zip(vessel_numbers, read_wells):
-        filename = plate_data.path
-        plate_id = plate_data.header.plate_ids[0]
-        timestamp = plate_data.header.time
-        well = plate.position_id(read_well)
-        measurement_delay_time = 0.0
-        reading = plate_data.value_at(*plate.well_coords(read_well))
-        data = (lagoon_number, filename, plate_id, timestamp, well, measurement_delay_time, 
-                 reading, data_type)
-        c.execute('INSERT INTO measurements VALUES (?,?,?,?,?,?,?,?)', data)
-    while True:
-        try:
-            db_conn.commit() # Unknown why error has been happening. Maybe Dropbox. Repeat until success.
-            break
-        except sqlite3.OperationalError:
-            time.sleep(1)
-        except IOError: # changed from "sqlite3.IOError". IOError is not a part of the sqlite3 library, it's a general python built-in exception. Other than that, this is perfect.
-            time.sleep(1)
-    db_conn.close()
-
 from pace_util import (
     pyhamilton, HamiltonInterface, LayoutManager, ClarioStar,
     ResourceType, Plate96, Tip96, LAYFILE, PlateData,
-    initialize, hepa_on, tip_pick_up, tip_eject, aspirate, dispense, read_plate,
-    resource_list_with_prefix, add_robot_level_log, add_stderr_logging, log_banner)
+    initialize, hepa_on, tip_pick_up, tip_eject, aspirate, dispense, move_plate, CommandPipeline,
+    tip_pick_up_96, tip_eject_96, aspirate_96, dispense_96,
+    LBPumps, resource_list_with_prefix, add_robot_level_log, add_stderr_logging, log_banner, command_metrics,
+    log_event, LazyStr, values_str, add_structured_log, add_file_log, async_log_stats)
 
 cycle_time = 15*60 # 15 minutes
 wash_vol = 250
@@ -74,6 +37,12 @@ turb_vol = 150 # uL
 desired_od = 0.6
 disp_height = fixed_turb_height - 1 # mm
 shake_speed = 300 # RPM
+std_class = 'StandardVolumeFilter_Water_DispenseSurface_Part_no_transport_vol'
+skip_min_transfer_wells = True # don't service wells whose controllers are pinned at min_transfer_vol
+use_96_head_service = '--service96' in sys.argv # let the 96 head do the common exchange when that's faster
+service_96_bins = 4 # replacement volumes are binned to this many levels in 96 head mode
+reader_protocols = [proto_name + '_fast' for proto_name in # use the speed optimized versions
+        ['kinetic_abs', 'mCherry', 'YFP', 'CFP']]
 
 def read_manifest(filename, cols_as_tuple=False):
     '''Reads in the current contents of a controller manifest; returns as dict'''
@@ -100,27 +69,45 @@ def split_in_batches(some_list, batch_len):
             yield some_list[i:i+batch_len]
     return list(batch_gen())
 
-def flow_rate_controller():
+controller_history_dir = 'controller_history' # same default location as TurbController.save/load
+command_metrics_file = os.path.join(method_local_dir, 'log', 'command_metrics.prom') # Prometheus text
+
+def flow_rate_controllers(num_ctrlrs):
     min_flow_through = min_transfer_vol/turb_vol
     max_flow_through = max_transfer_vol/turb_vol
-    controller = ParamEstTurbCtrlr(setpoint=desired_od, init_k=.5) # estimate for slow growing bacteria in challenging media
-    if '--reset' not in sys.argv:
+    bank = ParamEstTurbCtrlrBank(num_ctrlrs, setpoint=desired_od, init_k=.5) # estimate for slow growing bacteria in challenging media
+    # keep a day in memory (the bank takes a row per cycle); the history is kept in the spill file
+    bank.set_history_window(24*60*60//cycle_time, spill_dir=controller_history_dir)
+    if '--reset' in sys.argv:
+        bank.history.resume_spill(0) # new history; the last run's rows would otherwise come before it
+    else:
         try:
-            controller.load() # will overwrite init k value if saved controller history is found
-        except ValueError:
-            pass
-    controller.output_limits = min_flow_through, max_flow_through
-    return controller
+            bank.load(controller_history_dir) # will overwrite init k values if a saved bank is found
+        except ValueError: # no bank checkpoint yet; fall back to per-controller histories
+            bank.history.resume_spill(0) # anything spilled without a checkpoint is from an unknown state
+            for controller in bank.views:
+                try:
+                    controller.load(controller_history_dir)
+                except ValueError:
+                    pass
+    bank.output_limits = min_flow_through, max_flow_through
+    return bank
+
+sys_state = SimpleNamespace(instruments=None, clock=time.time) # set up in the main block
 
 num_plates = 5
 turb_nums = list(range(96*num_plates))
 turbs_by_plate = split_in_batches(turb_nums, 96)
-controllers = [flow_rate_controller() for _ in range(96*num_plates)]
+controller_bank = flow_rate_controllers(96*num_plates)
+controllers = controller_bank.views
 controllers_by_plate = split_in_batches(controllers, 96)
 helper_plate = Plate96('dummy')
 manifest = read_manifest('method_local/controller_manifest')
+active_by_plate = [] # False for wells marked "off" in the manifest; these are never stepped or serviced
+delivered_by_plate = {} # plate number: volumes the last service actually delivered
 for plate_no, ctrlr_batch in enumerate(controllers_by_plate):
     plate_key = 'plate' + str(plate_no)
+    active_by_plate.append([])
     for position_idx, ctrlr in enumerate(ctrlr_batch):
         well_id = Plate96('').position_id(position_idx)
         entry_key = plate_key + ',' + well_id
@@ -128,32 +115,145 @@ for plate_no, ctrlr_batch in enumerate(controllers_by_plate):
         if not target_od:
             print('key', entry_key, 'has no value in manifest!')
             exit()
-        ctrlr.setpoint = float(target_od)
+        is_active = target_od.strip().lower() != 'off'
+        active_by_plate[-1].append(is_active)
+        if is_active:
+            ctrlr.setpoint = float(target_od)
 
-def broadcast_transfer_function(controller_batch, readings_batch):
-    flow_rates = [controller(reading) for controller, reading in zip(controller_batch, readings_batch)] # step (__call__()) all controllers
-    logging.info('FLOW RATES ' + str(flow_rates))
-    logging.info('K ESTIMATES ' + str([controller.k_estimate for controller in controller_batch]))
-    logging.info('OD ESTIMATES ' + str([controller.od for controller in controller_batch]))
-    replace_vols = [rate*turb_vol for rate in flow_rates]
-    logging.info('REPLACEMENT VOLUMES ' + str(replace_vols))
+telemetry = None # TelemetryWriter, opened in the main block
+
+def broadcast_transfer_function(controller_batch, readings_batch, delivered_vols=None, plate_no=None, active=None):
+    # delivered_vols: what the last service actually gave each well, if it differs from what was asked for
+    # active: False for wells switched off in the manifest, which are not stepped, logged or serviced
+    bank = controller_batch[0].bank
+    stepped = [i for i in range(len(controller_batch)) if active is None or active[i]]
+    if not stepped:
+        return None # nothing on this plate to control
+    idxs = [controller_batch[i].idx for i in stepped]
+    od_readings = [readings_batch[i] for i in stepped]
+    last_transfer_fracs = None if delivered_vols is None else [delivered_vols[i]/turb_vol for i in stepped]
+    # step all controllers at once, into the same history row as the cycle's other plates
+    flow_rates = bank(od_readings, last_transfer_fracs, idxs=idxs, same_row=True)
+    # the arrays are fresh copies, so they can be turned into log text later, only if anything needs it
+    log_event('flow_rates', 'FLOW RATES %s', LazyStr(values_str, flow_rates), idxs=idxs, values=flow_rates)
+    k_estimates, od_estimates = bank.k_estimate[idxs], bank.od[idxs]
+    log_event('k_estimates', 'K ESTIMATES %s', LazyStr(values_str, k_estimates), idxs=idxs, values=k_estimates)
+    log_event('od_estimates', 'OD ESTIMATES %s', LazyStr(values_str, od_estimates), idxs=idxs, values=od_estimates)
+    stepped_vols = (flow_rates*turb_vol).tolist()
+    log_event('replacement_volumes', 'REPLACEMENT VOLUMES %s', stepped_vols, idxs=idxs, values=stepped_vols)
+    replace_vols = [0.0]*len(controller_batch) # wells that are off are left out of service by the active mask
+    for i, vol in zip(stepped, stepped_vols):
+        replace_vols[i] = vol
+    if telemetry is not None and plate_no is not None:
+        def by_well(vals): # nan for wells that are off
+            well_vals = np.full(len(controller_batch), np.nan)
+            well_vals[stepped] = vals
+            return well_vals
+        telemetry.append(bank.last_time[idxs[0]], plate_no, by_well(od_readings), by_well(od_estimates),
+                         by_well(k_estimates), by_well(flow_rates), by_well(stepped_vols))
     return replace_vols
 
-if __name__ == '__main__':
-    local_log_dir = os.path.join(method_local_dir, 'log')
-    if not os.path.exists(local_log_dir):
-        os.mkdir(local_log_dir)
-    main_logfile = os.path.join(local_log_dir, 'main.log')
-    logging.basicConfig(filename=main_logfile, level=logging.DEBUG, format='[%(asctime)s] %(name)s %(levelname)s %(message)s')
-    add_robot_level_log()
-    add_stderr_logging()
-    for banner_line in log_banner('Begin execution of ' + __file__):
-        logging.info(banner_line)
+def transfer_function(controllers_for_plate, od_readings, delivered_vols=None, plate_no=None, active=None):
+    assert len(controllers_for_plate) == len(od_readings)
+    return broadcast_transfer_function(controllers_for_plate, od_readings, delivered_vols, plate_no, active)
 
-    simulation_on = '--simulate' in sys.argv
+def service(replace_vols, plate, tips, media_reservoir, active=None):
+    # returns the volume each well actually got, for the controllers' next step
+    ham_int, *_ = sys_state.instruments
+    if not replace_vols:
+        return None # no transfer volumes ready to act on
+    plan = plan_service(replace_vols, active,
+            skip_at_or_below=min_transfer_vol + 1e-6 if skip_min_transfer_wells else None)
+    if use_96_head_service:
+        plan_96 = plan_service_96(replace_vols, min_transfer_vol, max_transfer_vol, active, num_bins=service_96_bins)
+        if plan_96.estimated_seconds() < plan.estimated_seconds():
+            plan = plan_96
+    report = plan.report()
+    log_event('service_plan', 'SERVICE PLAN %s %s', LazyStr(plate.layout_name), report, plate=plate, **report)
+    # build each next command while the robot runs the last; on an error here, nothing more is sent and
+    # what's already out is waited on before the error leaves
+    with CommandPipeline(ham_int) as pipeline:
+        if isinstance(plan, Head96ServicePlan):
+            service_batches(plan.residual_plan, plate, tips, media_reservoir, pipeline, exchange=False) # top-ups first
+            service_plate_96(plan.base_vol, plate, tips, media_reservoir, pipeline)
+        else:
+            service_batches(plan, plate, tips, media_reservoir, pipeline)
+    return plan.delivered_vols()
+
+def service_batches(plan, plate, tips, media_reservoir, pipeline, exchange=True):
+    # exchange=False only adds media (no mixing, no excess removal), for top-ups before a 96 head exchange
+    ham_int, *_ = sys_state.instruments
+    liq_move_param = {'liquidClass':std_class, 'airTransportRetractDist':0, 'pipeline':pipeline}
+    for array_idxs, batch_vols in zip(plan.batches, plan.vols):
+        def poss(labware, idx_fn=lambda j: j): # None for channels sitting this batch out
+            return [None if j is None else (labware, idx_fn(j)) for j in array_idxs]
+        def same_vol(vol):
+            return [None if j is None else vol for j in array_idxs]
+        tip_poss = poss(tips)
+        tip_pick_up(ham_int, tip_poss, pipeline=pipeline)
+        media_poss = poss(media_reservoir)
+        aspirate(ham_int, media_poss, batch_vols, **liq_move_param)
+        plate_poss = poss(plate)
+        if exchange:
+            dispense(ham_int, plate_poss, batch_vols, liquidHeight=disp_height, mixCycles=2,
+                    mixVolume=mix_vol, dispenseMode=9, **liq_move_param)
+            excess_vols = same_vol(max_transfer_vol)
+            aspirate(ham_int, plate_poss, excess_vols,
+                    liquidHeight=fixed_turb_height, **liq_move_param)
+            dispense(ham_int, poss(waste_site, lambda j: j%8 + 88), excess_vols, # +88 for far right side of bleach
+                    liquidHeight=15, **liq_move_param)
+        else:
+            dispense(ham_int, plate_poss, batch_vols, liquidHeight=disp_height, dispenseMode=9, **liq_move_param)
+        wash_vols = same_vol(wash_vol)
+        bleach_poss = poss(bleach_site)
+        aspirate(ham_int, bleach_poss, wash_vols, **liq_move_param)
+        dispense(ham_int, bleach_poss, wash_vols, **liq_move_param)
+        water_poss = poss(water_site)
+        aspirate(ham_int, water_poss, wash_vols, **liq_move_param)
+        dispense(ham_int, water_poss, wash_vols, **liq_move_param)
+        tip_eject(ham_int, tip_poss, pipeline=pipeline)
+
+def service_plate_96(base_vol, plate, tips, media_reservoir, pipeline):
+    # the whole-plate part of the exchange: base_vol in with mixing, excess above fixed height out, washes
+    ham_int, *_ = sys_state.instruments
+    liq_move_param = {'liquidClass':std_class, 'airTransportRetractDist':0, 'pipeline':pipeline}
+    tip_pick_up_96(ham_int, tips, pipeline=pipeline)
+    aspirate_96(ham_int, media_reservoir, base_vol, **liq_move_param)
+    dispense_96(ham_int, plate, base_vol, liquidHeight=disp_height, mixCycles=2,
+            mixVolume=mix_vol, dispenseMode=9, **liq_move_param)
+    aspirate_96(ham_int, plate, max_transfer_vol, liquidHeight=fixed_turb_height, **liq_move_param)
+    dispense_96(ham_int, waste_site, max_transfer_vol, liquidHeight=15, **liq_move_param)
+    for wash_site in bleach_site, water_site:
+        aspirate_96(ham_int, wash_site, wash_vol, **liq_move_param)
+        dispense_96(ham_int, wash_site, wash_vol, **liq_move_param)
+    tip_eject_96(ham_int, tips, pipeline=pipeline) # back into the box, each well keeps its tip
+
+def convert_to_ods(platedatas, plate_template=Plate96('')):
+    od_readings = []
+    abs_platedata, *_ = platedatas
+    for i in range(96):
+        data_val = abs_platedata.value_at(*plate_template.well_coords(i))
+        od = 3.2*data_val - .093 # empirical best fit line 
+        # https://docs.google.com/spreadsheets/d/1YTnrmKN2TCK6aRZATgT9GmrDiO_hILrXj01NWgXDU6E/edit?usp=sharing
+        # media = M9 minimal media, Volume = 150 uL
+        od_readings.append(od)
+    return od_readings
 
-    lmgr = LayoutManager(LAYFILE)
+meas_db = None # BackgroundMeasurementWriter, opened in the main block
 
+def record_readings(plate, turbs_for_plate, platedatas, active=None):
+    # wells that are off in the manifest aren't recorded
+    data_types = ('abs', 'rfp', 'yfp', 'cfp') # mind r, y, c order
+    read_wells = [i for i in range(96) if active is None or active[i]]
+    meas_db.add_plate_reads(plate, [turbs_for_plate[i] for i in read_wells], read_wells, zip(data_types, platedatas))
+    backlog_batches, backlog_rows = meas_db.backlog()
+    log_event('measurement_backlog', 'MEASUREMENT BACKLOG %s batches, %s rows', backlog_batches, backlog_rows,
+            batches=backlog_batches, rows=backlog_rows)
+    db_stats = dict(meas_db.db_stats)
+    log_event('measurement_db_stats', 'MEASUREMENT DB STATS %s', db_stats, **db_stats)
+
+def assign_labware(lmgr):
+    global reader_tray, waste_site, water_site, bleach_site, plates, media_sources, tip_boxes
     reader_tray = lmgr.assign_unused_resource(ResourceType(Plate96, 'reader_tray_00002'))
     waste_site = lmgr.assign_unused_resource(ResourceType(Plate96, 'waste_site'))
     water_site = lmgr.assign_unused_resource(ResourceType(Plate96, 'water_site'))
@@ -162,96 +262,113 @@ if __name__ == '__main__':
     media_sources = resource_list_with_prefix(lmgr, 'media_reservoir_', Plate96, num_plates)
     tip_boxes = resource_list_with_prefix(lmgr, 'tips_', Tip96, num_plates)
 
-    def transfer_function(controllers_for_plate, od_readings):
-        assert len(controllers_for_plate) == len(od_readings)
-        return split_in_batches(broadcast_transfer_function(controllers_for_plate, od_readings), 8)
-
-    def service(replace_vols, plate, tips, media_reservoir):
-        ham_int, *_ = sys_state.instruments
-        if not remember.replace_vols:
-            return # no transfer volumes ready to act on
-        liq_move_param = {'liquidClass':std_class, 'airTransportRetractDist':0}
-        for col_num, col_vols in enumerate(replace_vols):
-            array_idxs = [col_num*8 + i for i in range(8)]
-            tip_poss = [(tips, j) for j in array_idxs]
-            tip_pick_up(ham_int, tip_poss)
-            media_poss = [(media_reservoir, j) for j in array_idxs]
-            aspirate(ham_int, media_poss, col_vols, **liq_move_param)
-            plate_poss = [(plate, j) for j in array_idxs]
-            dispense(ham_int, plate_poss, col_vols, liquidHeight=disp_height, mixCycles=2,
-                    mixVolume=mix_vol, dispenseMode=9, **liq_move_param)
-            excess_vols = [max_transfer_vol for _ in media_poss]
-            aspirate(ham_int, plate_poss, excess_vols,
-                    liquidHeight=fixed_turb_height, **liq_move_param)
-            dispense(ham_int, [(waste_site, j%8 + 88) for j in array_idxs], excess_vols, # +88 for far right side of bleach
-                    liquidHeight=15, **liq_move_param)
-            wash_vols = [wash_vol for _ in media_poss]
-            bleach_poss = [(bleach_site, j) for j in array_idxs]
-            aspirate(ham_int, bleach_poss, wash_vols, **liq_move_param)
-            dispense(ham_int, bleach_poss, wash_vols, **liq_move_param)
-            water_poss = [(water_site, j) for j in array_idxs]
-            aspirate(ham_int, water_poss, wash_vols, **liq_move_param)
-            dispense(ham_int, water_poss, wash_vols, **liq_move_param)
-            tip_eject(ham_int, tip_poss)
-        remember.replace_vols = None # make sure these transfers are only executed once
-
-    with HamiltonInterface(simulate=simulation_on) as ham_int, ClarioStar() as reader_int:
-        if no_reader or simulation_on:
-            reader_int.disable()
-        ham_int.set_log_dir(os.path.join(local_log_dir, 'hamilton.log'))
-        initialize(ham_int)
-        hepa_on(ham_int, 30, simulate=int(simulation_on))
-        std_class = 'StandardVolumeFilter_Water_DispenseSurface_Part_no_transport_vol'
-        remember = SimpleNamespace()
-        remember.od_readings = None
+# Instruments modeled as scheduler resources. Plate moves also hold the pipetting arms: every deck command
+# goes through the one HamiltonInterface, so the robot can't grip a plate while it pipettes. The controller
+# bank is a resource too, as stepping it from two threads at once isn't safe.
+instrument_resources = ('reader', 'iswap', 'arm8', 'head96', 'pumps', 'controller_bank')
+pipetting_arms = ('arm8', 'head96') if use_96_head_service else ('arm8',)
+deck_arms = ('iswap',) + pipetting_arms
 
-    def measure_plate(plate, reader_protocols, simultaneously_execute=lambda:None):
-        reader_protocols = [proto_name + '_fast' for proto_name in reader_protocols] # use the speed optimized versions
-        ham_int, reader_int, *_ = sys_state.instruments
-        platedatas = read_plate(ham_int, reader_int, reader_tray, plate, reader_protocols,
-                plate_id=plate.layout_name(), async_task=simultaneously_execute)
-
-    def convert_to_ods(platedatas, plate_template=Plate96('')):
-        od_readings = []
-        abs_platedata, *_ = platedatas
-        for i in range(96):
-            data_val = abs_platedata.value_at(*plate_template.well_coords(i))
-            od = 3.2*data_val - .093 # empirical best fit line 
-            # https://docs.google.com/spreadsheets/d/1YTnrmKN2TCK6aRZATgT9GmrDiO_hILrXj01NWgXDU6E/edit?usp=sharing
-            # media = M9 minimal media, Volume = 150 uL
-            od_readings.append(od)
-        return od_readings
+def add_plate_tasks(scheduler, plate_no, turbs_for_plate, controllers_for_plate, labware_for_plate,
+                    reader_protocols, after=None, defer_service=False):
+    # measure -> record, control -> service for one plate. Returns (unload task, service task), or with
+    # defer_service, (unload task, function that services the plate) to be scheduled in a later run.
+    plate, tips, media_supply = labware_for_plate
+    ham_int, reader_int, *_ = sys_state.instruments
+    priority = 3*plate_no # service of plate N waits behind loading plate N+1, so it overlaps N+1's read
+    def load():
+        reader_int.plate_out(block=True)
+        move_plate(ham_int, plate, reader_tray)
+    def read():
+        with command_metrics.timed('RUN_PROTOCOLS'):
+            platedatas = reader_int.run_protocols(reader_protocols, plate_id_1=plate.layout_name())
+        reader_int.plate_out(block=True)
+        return platedatas
+    load_task = scheduler.add('load_' + str(plate_no), load, deck_arms,
+            deps=() if after is None else (after,), priority=priority)
+    read_task = scheduler.add('read_' + str(plate_no), read, ('reader',), deps=(load_task,), priority=priority)
+    unload_task = scheduler.add('unload_' + str(plate_no), lambda: move_plate(ham_int, reader_tray, plate),
+            deck_arms, deps=(read_task,), priority=priority)
+    scheduler.add('record_' + str(plate_no),
+            lambda: record_readings(plate, turbs_for_plate, read_task.result, active_by_plate[plate_no]),
+            deps=(read_task,), priority=priority)
+    control_task = scheduler.add('control_' + str(plate_no), # use optical density calibration curve
+            lambda: transfer_function(controllers_for_plate, convert_to_ods(read_task.result),
+                                      delivered_by_plate.pop(plate_no, None), plate_no, active_by_plate[plate_no]),
+            ('controller_bank',), deps=(read_task,), priority=priority)
+    def service_plate():
+        delivered_by_plate[plate_no] = service(control_task.result, plate, tips, media_supply,
+                                               active_by_plate[plate_no])
+    if defer_service:
+        return unload_task, service_plate
+    service_task = scheduler.add('service_' + str(plate_no), service_plate,
+            pipetting_arms, deps=(control_task, unload_task), priority=priority + 4)
+    return unload_task, service_task
 
-    def record_readings(plate, turbs_for_plate, platedatas):
-        abs_platedata, *fluor_pdatas = platedatas
-        list_96 = list(range(96))
-        db_add_plate_data(abs_platedata, 'abs', plate, turbs_for_plate, list_96)
-        for fluor_protocol, fluor_pdata in zip(('rfp', 'yfp', 'cfp'), fluor_pdatas): # mind r, y, c order
-                data = [fluor_pdata.value_at(*plate.well_coords(i)) for i in list_96]
-                db_add_plate_data(fluor_pdata, fluor_protocol, plate, turbs_for_plate, list_96)
-                
+def run_cycle(scheduler, labware, reader_protocols, carried_service=None):
+    # one rotation over all plates; returns the last plate's deferred service for the next call
+    if carried_service is not None: # last plate of the previous cycle is serviced while plate 0 reads
+        scheduler.add('service_prev_cycle', carried_service, pipetting_arms, priority=1)
+    last_unload = None
+    for plate_no, plate_items in enumerate(zip(turbs_by_plate, controllers_by_plate, zip(*labware))):
+        last_unload, carried_service = add_plate_tasks(scheduler, plate_no, *plate_items,
+                reader_protocols=reader_protocols, after=last_unload,
+                defer_service=plate_no == num_plates - 1) # so it can overlap a read next cycle
+    scheduler.run()
+    controller_bank.save(controller_history_dir) # checkpoint all controllers once per cycle
+    scheduler.log_utilization()
+    return carried_service
 
 def main():
-    def service_prev_plate():
-        pass # initialize to do-nothing function
     labware = plates, tip_boxes, media_sources
-    items_for_each_plate = turbs_by_plate, controllers_by_plate, labware
-    reader_protocols = ['kinetic_abs', 'mCherry', 'YFP', 'CFP']
+    scheduler = ResourceScheduler(instrument_resources, clock=sys_state.clock)
+    carried_service = None
     while True:
-        for turbs_for_plate, controllers_for_plate, labware_for_plate in zip(items_for_each_plate):
-            plate, tips, media_supply = labware_for_plate
-            platedatas = measure_plate(plate, reader_protocols, simultaneously_execute=service_prev_plate)
-            record_readings(plate, turbs_for_plate, platedatas)
-            od_readings = convert_to_ods(platedatas) # use optical density calibration curve
-            remember.replace_vols = transfer_function(controllers_for_plate, od_readings)
-            def service_prev_plate(args=(plate, tips, media_supply)):
-                service(remember.replace_vols, *args)
+        carried_service = run_cycle(scheduler, labware, reader_protocols, carried_service)
+        command_metrics.write_snapshot(command_metrics_file) # per-command latency histograms so far
+        log_stats = async_log_stats()
+        log_event('log_handler_stats', 'LOG HANDLER STATS %s', log_stats, handlers=log_stats)
 
 if __name__ == '__main__':
-    with HamiltonInterface() as ham_int, \
-            ClarioStar() as reader_int, \
-            LBPumps() as pump_int:
+    local_log_dir = os.path.join(method_local_dir, 'log')
+    if not os.path.exists(local_log_dir):
+        os.mkdir(local_log_dir)
+    main_logfile = os.path.join(local_log_dir, 'main.log')
+    logging.getLogger().setLevel(logging.DEBUG)
+    add_file_log(main_logfile) # rotated and gzipped, and written from a background thread
+    add_robot_level_log()
+    add_structured_log(os.path.join(local_log_dir, 'main.jsonl')) # same records as fields, for tools
+    add_stderr_logging()
+    for banner_line in log_banner('Begin execution of ' + __file__):
+        logging.info(banner_line)
+
+    simulation_on = '--simulate' in sys.argv
+    fake_instruments = '--fake-instruments' in sys.argv # run against sim_instruments on a virtual clock
+
+    assign_labware(LayoutManager(LAYFILE))
+    # rows are committed on a writer thread so a stalled database never holds up the robot; flushed at exit
+    meas_db = BackgroundMeasurementWriter(os.path.join(method_local_dir, containing_dirname + '.db'))
+    # per-well controller state for every plate and cycle, for analysis without scraping main.log
+    telemetry = TelemetryWriter(os.path.join(method_local_dir, containing_dirname + '.turbtel'))
+
+    def system_initialize():
+        ham_int, reader_int, *_ = sys_state.instruments
+        if simulation_on:
+            reader_int.disable()
+        ham_int.set_log_dir(os.path.join(local_log_dir, 'hamilton.log'))
+        initialize(ham_int)
+        hepa_on(ham_int, 30, simulate=int(simulation_on))
+
+    if fake_instruments:
+        from sim_instruments import sim_instruments
+        clock, *instrument_stand_ins = sim_instruments(speedup=60)
+        sys_state.clock = command_metrics.clock = clock.time
+        ham_cm, reader_cm, pump_cm = instrument_stand_ins
+    else:
+        ham_cm, reader_cm, pump_cm = HamiltonInterface(simulate=simulation_on), ClarioStar(), LBPumps()
+    with ham_cm as ham_int, reader_cm as reader_int, pump_cm as pump_int:
         sys_state.instruments = ham_int, reader_int, pump_int
         system_initialize()
         main()
 
+
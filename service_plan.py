@@ -0,0 +1,126 @@
+# Rough robot time per 8-channel command, in seconds, and the extra time for each additional column a
+# command's channels have to visit. Only used to estimate what a plan costs compared to a full plate.
+command_seconds = {'tip_pick_up': 9, 'aspirate': 7, 'dispense': 6, 'dispense_mix': 11, 'tip_eject': 7}
+column_move_seconds = 2.5
+# one batch = pick up, media in (mixing), excess out to waste, bleach wash, water wash, eject
+batch_commands = ('tip_pick_up', 'aspirate', 'dispense_mix', 'aspirate', 'dispense',
+                  'aspirate', 'dispense', 'aspirate', 'dispense', 'tip_eject')
+column_visiting_commands = ('tip_pick_up', 'aspirate', 'dispense_mix', 'aspirate', 'tip_eject') # the rest use fixed sites
+# residual top-ups when the 96 head does the exchange: media in (no mix, the head mixes), washes, eject
+residual_batch_commands = ('tip_pick_up', 'aspirate', 'dispense', 'aspirate', 'dispense', 'aspirate', 'dispense',
+                           'tip_eject')
+head96_command_seconds = {'tip_pick_up_96': 14, 'aspirate_96': 9, 'dispense_96': 8, 'dispense_96_mix': 15,
+                          'tip_eject_96': 12}
+# base volume in (mixing), excess out to waste, bleach wash, water wash, tips back
+head96_commands = ('tip_pick_up_96', 'aspirate_96', 'dispense_96_mix', 'aspirate_96', 'dispense_96',
+                   'aspirate_96', 'dispense_96', 'aspirate_96', 'dispense_96', 'tip_eject_96')
+
+def batch_seconds(num_columns=1, commands=batch_commands):
+    return (sum(command_seconds[cmd] for cmd in commands)
+            + column_move_seconds*(num_columns - 1)*len([cmd for cmd in commands if cmd in column_visiting_commands]))
+
+class ServicePlan:
+    '''
+    Which wells of a plate to service, packed into 8-channel batches. batches[b][ch] is the well index
+    (0-95, column-major as in Plate96) channel ch handles in batch b, or None if that channel sits out;
+    vols[b][ch] is the matching replacement volume. Channel ch always serves row ch, so channels never have
+    to cross, and tips are taken from the tip box position matching the well.
+    '''
+    def __init__(self, batches, vols, commands=batch_commands):
+        self.batches = batches
+        self.vols = vols
+        self.commands = commands
+
+    def num_wells(self):
+        return sum(1 for batch in self.batches for idx in batch if idx is not None)
+
+    def delivered_vols(self, num_wells=96):
+        # media each well actually gets; 0 for wells left out
+        delivered = [0.0]*num_wells
+        for batch, vols in zip(self.batches, self.vols):
+            for idx, vol in zip(batch, vols):
+                if idx is not None:
+                    delivered[idx] = vol
+        return delivered
+
+    def estimated_seconds(self):
+        return sum(batch_seconds(len({idx//8 for idx in batch if idx is not None}), self.commands)
+                   for batch in self.batches)
+
+    def seconds_saved(self, num_wells=96):
+        full_plate_seconds = batch_seconds()*(num_wells//8)
+        return full_plate_seconds - self.estimated_seconds()
+
+    def report(self):
+        return {'wells': self.num_wells(), 'batches': len(self.batches),
+                'estimated_seconds': round(self.estimated_seconds(), 1),
+                'seconds_saved': round(self.seconds_saved(), 1)}
+
+def plan_service(replace_vols, active=None, skip_at_or_below=None, num_channels=8):
+    '''
+    Build a ServicePlan for one plate from its 96 replacement volumes. Wells are left out if active (a
+    parallel sequence of bools, e.g. from the manifest) marks them inactive, or if their volume is at or
+    below skip_at_or_below (e.g. the minimum transfer volume the controllers are pinned to). Remaining wells
+    are packed row by row: batch b gives each channel the b-th remaining well in its row, so columns with
+    nothing to do are dropped and sparse columns are merged.
+    '''
+    rows = [[] for _ in range(num_channels)]
+    for idx, vol in enumerate(replace_vols): # column-major: idx//8 is the column, idx%8 the row
+        if active is not None and not active[idx]:
+            continue
+        if skip_at_or_below is not None and vol <= skip_at_or_below:
+            continue
+        rows[idx % num_channels].append(idx)
+    num_batches = max(len(row) for row in rows)
+    batches = [[row[b] if b < len(row) else None for row in rows] for b in range(num_batches)]
+    vols = [[None if idx is None else replace_vols[idx] for idx in batch] for batch in batches]
+    return ServicePlan(batches, vols)
+
+class Head96ServicePlan:
+    '''
+    Service with the 96 head doing the exchange common to the whole plate: base_vol of media into every
+    well (mixing), then the excess above the fixed height out to waste. residual_plan is the 8-channel
+    plan that tops up, beforehand, the wells whose binned volume is above base_vol. Note that the 96 head
+    also gives inactive wells the base exchange.
+    '''
+    def __init__(self, base_vol, residual_plan, binned_vols):
+        self.base_vol = base_vol
+        self.residual_plan = residual_plan
+        self.binned_vols = binned_vols
+
+    def delivered_vols(self, num_wells=96):
+        return [self.base_vol + vol for vol in self.residual_plan.delivered_vols(num_wells)]
+
+    def estimated_seconds(self):
+        return sum(head96_command_seconds[cmd] for cmd in head96_commands) + self.residual_plan.estimated_seconds()
+
+    def seconds_saved(self, num_wells=96):
+        return batch_seconds()*(num_wells//8) - self.estimated_seconds()
+
+    def report(self):
+        return {'base_vol': self.base_vol, 'residual_wells': self.residual_plan.num_wells(),
+                'residual_batches': len(self.residual_plan.batches),
+                'estimated_seconds': round(self.estimated_seconds(), 1),
+                'seconds_saved': round(self.seconds_saved(), 1)}
+
+def bin_vols(vols, min_vol, max_vol, num_bins):
+    '''Round each volume to the nearest of num_bins evenly spaced levels from min_vol to max_vol'''
+    if num_bins < 2 or max_vol <= min_vol:
+        return [float(min_vol) for _ in vols]
+    step = (max_vol - min_vol)/(num_bins - 1)
+    return [min_vol + step*min(num_bins - 1, max(0, round((vol - min_vol)/step))) for vol in vols]
+
+def plan_service_96(replace_vols, min_vol, max_vol, active=None, num_bins=4, num_channels=8):
+    '''
+    Head96ServicePlan for one plate. Volumes are binned into num_bins levels between min_vol and max_vol;
+    the lowest level any active well needs becomes the 96 head's base volume, and only wells binned higher
+    get an 8-channel top-up of the difference. Fewer bins mean fewer top-ups but coarser volumes, so the
+    controllers should be told what was delivered (delivered_vols()).
+    '''
+    binned = bin_vols(replace_vols, min_vol, max_vol, num_bins)
+    active_binned = [vol for i, vol in enumerate(binned) if active is None or active[i]]
+    base_vol = min(active_binned) if active_binned else min_vol
+    residuals = [vol - base_vol for vol in binned]
+    residual_plan = plan_service(residuals, active, skip_at_or_below=1e-6, num_channels=num_channels)
+    residual_plan.commands = residual_batch_commands
+    return Head96ServicePlan(base_vol, residual_plan, binned)
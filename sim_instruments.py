@@ -0,0 +1,183 @@
+#!python3
+
+import os
+import time
+import random
+import logging
+from threading import Lock
+from types import SimpleNamespace
+
+from pyhamilton import PositionError
+from pace_util import command_names
+
+# In-process stand-ins for the instruments robot_method drives (HamiltonInterface, ClarioStar, pumps), so
+# that the whole method can run on a laptop against a virtual clock. Timings are (mean, sd) in seconds of
+# robot time for a normal distribution clipped at 10% of the mean; defaults are rough figures for our deck.
+default_command_latency = {
+    'INITIALIZE': (60, 5), 'HEPA': (1, .2), 'WASH96_EMPTY': (45, 5),
+    'PICKUP': (9, 1), 'EJECT': (7, 1), 'ASPIRATE': (7, 1.5), 'DISPENSE': (8, 2),
+    'PICKUP96': (14, 1.5), 'EJECT96': (12, 1.5), 'ASPIRATE96': (9, 1.5), 'DISPENSE96': (11, 2),
+    'ISWAP_GET': (12, 1.5), 'ISWAP_PLACE': (11, 1.5)}
+default_reader_latency = {'plate_out': (8, 1), 'plate_in': (8, 1), 'protocol': (50, 4)}
+default_pump_latency = (3, .5)
+
+class VirtualClock:
+    '''
+    Robot time that runs speedup times faster than wall time, shared by all the fake instruments.
+    sleep() waits the equivalent wall time, so threads that wait on different instruments at once overlap
+    just as they would on the deck.
+    '''
+    def __init__(self, speedup=1.0, start_time=None):
+        self.speedup = speedup
+        self.start_time = time.time() if start_time is None else start_time
+        self.wall_start = time.time()
+
+    def time(self):
+        return self.start_time + (time.time() - self.wall_start)*self.speedup
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds/self.speedup)
+
+    def sleep_until(self, virtual_time):
+        self.sleep(virtual_time - self.time())
+
+def draw_latency(rng, mean_sd):
+    mean, sd = mean_sd
+    return max(.1*mean, rng.gauss(mean, sd))
+
+class FakeHamiltonInterface:
+    '''
+    Takes the same send_command/wait_on_response calls as pyhamilton's HamiltonInterface. Commands run one
+    after another as on the real robot, each taking a latency drawn from command_latency. fault_rates maps
+    command names to the probability that the command fails with a PositionError, e.g. {'ISWAP_GET': .05}.
+    '''
+    def __init__(self, clock, command_latency=None, fault_rates=None, seed=None):
+        self.clock = clock
+        self.command_latency = dict(default_command_latency)
+        self.command_latency.update(command_latency or {})
+        self.fault_rates = fault_rates or {}
+        self.rng = random.Random(seed)
+        self.lock = Lock()
+        self.busy_until = 0
+        self.next_id = 0
+        self.commands = {} # id: (name, params, completion time, fails)
+        self.command_log = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def set_log_dir(self, log_dir):
+        pass
+
+    @staticmethod
+    def command_name(cmd):
+        if isinstance(cmd, dict) and 'command' in cmd:
+            cmd = cmd['command']
+        return command_names.get(str(cmd), str(cmd)) # pyhamilton's command strings are not the names
+
+    def send_command(self, cmd, **params):
+        name = self.command_name(cmd)
+        with self.lock:
+            start = max(self.clock.time(), self.busy_until)
+            self.busy_until = start + draw_latency(self.rng, self.command_latency.get(name, (5, 1)))
+            fails = self.rng.random() < self.fault_rates.get(name, 0)
+            cmd_id = str(self.next_id)
+            self.next_id += 1
+            self.commands[cmd_id] = name, params, self.busy_until, fails
+            self.command_log.append((name, start, self.busy_until, fails))
+        return cmd_id
+
+    def wait_on_response(self, cmd_id, timeout=0, raise_first_exception=False, return_data=None):
+        name, params, done_time, fails = self.commands.pop(cmd_id)
+        self.clock.sleep_until(done_time)
+        if fails:
+            logging.info('FakeHamiltonInterface: injected PositionError on ' + name)
+            if raise_first_exception:
+                raise PositionError('Simulated fault in ' + name)
+        return {'id': cmd_id}
+
+class FakePlateData:
+    # what robot_method uses of platereader's PlateData: path, header.plate_ids, header.time, value_at()
+    def __init__(self, path, plate_id, read_time, values):
+        self.path = path
+        self.header = SimpleNamespace(plate_ids=[plate_id], time=read_time)
+        self.values = values # 8 rows x 12 columns
+
+    def value_at(self, row, col):
+        return self.values[row][col]
+
+class FakeClarioStar:
+    '''
+    Stands in for platereader's ClarioStar. run_protocols returns one FakePlateData per protocol, with
+    values from readings(plate_id, protocol_name) -> 8x12 nested lists; by default noisy absorbances around
+    the calibration for OD .5 and flat fluorescence.
+    '''
+    def __init__(self, clock, readings=None, latency=None, seed=None, data_dir='sim_reader_data'):
+        self.clock = clock
+        self.latency = dict(default_reader_latency)
+        self.latency.update(latency or {})
+        self.rng = random.Random(seed)
+        self.readings = readings or self.default_readings
+        self.data_dir = data_dir
+        self.disabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def disable(self):
+        self.disabled = True
+
+    def default_readings(self, plate_id, protocol_name):
+        base = (.5 + .093)/3.2 if 'abs' in protocol_name else 1000.0
+        return [[base*(1 + self.rng.gauss(0, .03)) for _ in range(12)] for _ in range(8)]
+
+    def plate_out(self, block=True):
+        self.clock.sleep(draw_latency(self.rng, self.latency['plate_out']))
+
+    def plate_in(self, block=True):
+        self.clock.sleep(draw_latency(self.rng, self.latency['plate_in']))
+
+    def run_protocols(self, protocol_names, plate_id_1=None, **kwargs):
+        plate_datas = []
+        for protocol_name in protocol_names:
+            self.clock.sleep(draw_latency(self.rng, self.latency['protocol']))
+            read_time = self.clock.time()
+            filename = (protocol_name + '_' + str(plate_id_1) + '_' +
+                        time.strftime('%y%m%d_%H%M', time.localtime(read_time)) + '.csv')
+            plate_datas.append(FakePlateData(os.path.join(self.data_dir, filename), plate_id_1,
+                                             time.ctime(read_time), self.readings(plate_id_1, protocol_name)))
+        return plate_datas
+
+class FakePumps:
+    # stands in for auxpump's pump interfaces (and the shaker): any method call just takes pump time
+    def __init__(self, clock, latency=default_pump_latency, seed=None):
+        self.clock = clock
+        self.latency = latency
+        self.rng = random.Random(seed)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            self.clock.sleep(draw_latency(self.rng, self.latency))
+        return call
+
+def sim_instruments(speedup=60.0, fault_rates=None, readings=None, seed=None):
+    '''(clock, hamilton, reader, pumps) ready to stand in for the real instruments'''
+    clock = VirtualClock(speedup)
+    rng = random.Random(seed)
+    return (clock, FakeHamiltonInterface(clock, fault_rates=fault_rates, seed=rng.random()),
+            FakeClarioStar(clock, readings=readings, seed=rng.random()), FakePumps(clock, seed=rng.random()))
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+
+# Per-cycle controller telemetry: one fixed-size little-endian record per plate per control step, appended
+# to a single file, so analysis can map the file as arrays instead of scraping main.log. The file starts
+# with a 16 byte header: magic, format version and the number of wells per record.
+telemetry_magic = b'TURBTELE'
+telemetry_version = 1
+header_dtype = np.dtype([('magic', 'S8'), ('version', '<u4'), ('num_wells', '<u4')])
+well_fields = ('od_reading', 'od', 'k_estimate', 'output', 'replace_vol')
+
+def record_dtype(num_wells=96):
+    return np.dtype([('time', '<f8'), ('plate', '<i8')] + [(field, '<f8', (num_wells,)) for field in well_fields])
+
+class TelemetryWriter:
+    '''
+    Appends telemetry records to path, creating it with a header if needed. Each append is one write of
+    a whole record; a torn record left by a crash mid-write is ignored by read_telemetry, and cut off when
+    the file is reopened so records appended after it stay aligned.
+    '''
+    def __init__(self, path, num_wells=96):
+        self.path = path
+        self.dtype = record_dtype(num_wells)
+        if os.path.isfile(path) and os.path.getsize(path) >= header_dtype.itemsize:
+            existing_wells = read_header(path)
+            if existing_wells != num_wells:
+                raise ValueError('Telemetry file ' + path + ' has ' + str(existing_wells) + ' wells per record, not ' +
+                                 str(num_wells))
+            size = os.path.getsize(path)
+            torn = (size - header_dtype.itemsize) % self.dtype.itemsize
+            if torn:
+                os.truncate(path, size - torn)
+        else:
+            header = np.array([(telemetry_magic, telemetry_version, num_wells)], dtype=header_dtype)
+            with open(path, 'wb') as f:
+                f.write(header.tobytes())
+
+    def append(self, update_time, plate_no, od_reading, od, k_estimate, output, replace_vol):
+        record = np.zeros(1, dtype=self.dtype)
+        record['time'] = update_time
+        record['plate'] = plate_no
+        for field, vals in zip(well_fields, (od_reading, od, k_estimate, output, replace_vol)):
+            record[field] = vals
+        with open(self.path, 'ab') as f:
+            f.write(record.tobytes())
+
+def read_header(path):
+    header = np.fromfile(path, dtype=header_dtype, count=1)
+    if not len(header) or header['magic'][0] != telemetry_magic:
+        raise ValueError(path + ' is not a telemetry file')
+    if header['version'][0] != telemetry_version:
+        raise ValueError('Unsupported telemetry version ' + str(header['version'][0]) + ' in ' + path)
+    return int(header['num_wells'][0])
+
+def read_telemetry(path, start_time=None, end_time=None, plates=None):
+    '''
+    Telemetry records with start_time <= time < end_time (either may be None), optionally only for the
+    given plate numbers, as {'time': (n,), 'plate': (n,), 'od': (n, wells), ...}. The file is memory
+    mapped; without a plate filter the arrays are views of the map. Records are appended in time order, so
+    the window is found by binary search and reading it doesn't touch the rest of a long run's file.
+    '''
+    num_wells = read_header(path)
+    dtype = record_dtype(num_wells)
+    num_records = (os.path.getsize(path) - header_dtype.itemsize)//dtype.itemsize
+    if num_records <= 0:
+        records = np.zeros(0, dtype=dtype)
+    else:
+        records = np.memmap(path, dtype=dtype, mode='r', offset=header_dtype.itemsize, shape=(num_records,))
+    times = records['time']
+    lo = 0 if start_time is None else np.searchsorted(times, start_time, side='left')
+    hi = len(times) if end_time is None else np.searchsorted(times, end_time, side='left')
+    records = records[lo:hi]
+    if plates is not None:
+        records = records[np.isin(records['plate'], list(plates))]
+    return {field: records[field] for field in dtype.names}
@@ -0,0 +1,70 @@
+import time
+import random
+import threading
+import pytest
+from cycle_scheduler import ResourceScheduler
+
+def test_dependencies_and_results():
+    scheduler = ResourceScheduler(('reader', 'arm'))
+    read = scheduler.add('read', lambda: 42, ('reader',))
+    double = scheduler.add('double', lambda: read.result*2, ('arm',), deps=(read,))
+    scheduler.run()
+    assert (read.status, double.status, double.result) == ('done', 'done', 84)
+    assert double.start_time >= read.end_time
+
+def test_resource_held_exclusively():
+    scheduler = ResourceScheduler(('arm',))
+    holders = []
+    lock = threading.Lock()
+    def use_arm():
+        with lock:
+            holders.append(1)
+            assert len(holders) == 1
+        time.sleep(.002)
+        with lock:
+            holders.pop()
+    for i in range(20):
+        scheduler.add('move_' + str(i), use_arm, ('arm',))
+    scheduler.run()
+    assert all(task.status == 'done' for task in scheduler.last_run)
+    assert 0 < scheduler.utilization()['arm'] <= 1
+
+def test_priority_orders_ready_tasks():
+    scheduler = ResourceScheduler(('arm',))
+    order = []
+    for name, priority in (('c', 2), ('a', 0), ('b', 1)):
+        scheduler.add(name, lambda name=name: order.append(name), ('arm',), priority=priority)
+    scheduler.run()
+    assert order == ['a', 'b', 'c']
+
+def test_error_stops_new_tasks_and_reraises():
+    scheduler = ResourceScheduler(('arm', 'reader'))
+    def fail():
+        raise RuntimeError('gripper fault')
+    failing = scheduler.add('move', fail, ('arm',))
+    after = scheduler.add('after', lambda: None, ('arm',), deps=(failing,))
+    with pytest.raises(RuntimeError):
+        scheduler.run()
+    assert failing.status == 'error' and after.status == 'waiting'
+
+def test_dependency_cycle_detected():
+    scheduler = ResourceScheduler(('arm',))
+    first = scheduler.add('first', lambda: None)
+    second = scheduler.add('second', lambda: None, deps=(first,))
+    first.deps = (second,)
+    with pytest.raises(ValueError):
+        scheduler.run()
+
+def test_many_concurrent_completions():
+    # tasks finishing at nearly the same moment on separate resources, run after run
+    resources = tuple('res' + str(i) for i in range(16))
+    scheduler = ResourceScheduler(resources)
+    rng = random.Random(0)
+    for run_no in range(200):
+        tasks = [scheduler.add(res + '_' + str(j), lambda j=j: j, (res,)) for res in resources for j in range(3)]
+        joins = [scheduler.add('join_' + str(k), lambda: None, rng.sample(resources, 2), deps=tasks[k::16])
+                 for k in range(4)]
+        scheduler.run()
+        assert all(task.status == 'done' and task.end_time >= task.start_time for task in tasks + joins)
+    total = sum(scheduler.busy_time.values())
+    assert total > 0 and all(time >= 0 for time in scheduler.busy_time.values())
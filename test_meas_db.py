@@ -0,0 +1,175 @@
+import os
+import time
+import threading
+import sqlite3
+import pytest
+from datetime import datetime
+import meas_db
+from meas_db import BackgroundMeasurementWriter, MeasurementDB, meas_columns, meas_schema_version
+
+def row(lagoon, reading=.5):
+    return (lagoon, 'plate0_abs_240101_1200.csv', 'plate0', 1704110400.0, 'A1', 0.0, reading, 'abs', lagoon//96,
+            '12:00')
+
+def num_rows(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute('SELECT COUNT(*) FROM measurements').fetchone()[0]
+
+def test_failed_batch_is_retried(tmp_path, monkeypatch):
+    db_path = str(tmp_path/'meas.db')
+    add_rows = MeasurementDB.add_rows
+    failures = [1]
+    def flaky_add_rows(self, rows):
+        if failures[0]:
+            failures[0] -= 1
+            raise sqlite3.OperationalError('disk I/O error')
+        add_rows(self, rows)
+    monkeypatch.setattr(MeasurementDB, 'add_rows', flaky_add_rows)
+    writer = BackgroundMeasurementWriter(db_path, str(tmp_path/'spool'), max_memory_rows=10)
+    writer.add_rows([row(i) for i in range(8)]) # fails
+    writer.add_rows([row(i) for i in range(8, 12)]) # commits, then the failed batch goes again
+    deadline = time.time() + 10
+    while writer.backlog() != (0, 0) and time.time() < deadline:
+        time.sleep(.01)
+    writer.close()
+    assert writer.stats['write_errors'] == 1 and writer.stats['batches_retried'] == 1
+    assert writer.backlog() == (0, 0) and writer._memory_rows == 0
+    assert not os.path.exists(writer.spool_path) # everything committed, nothing left to replay
+    assert num_rows(db_path) == 12
+
+def test_failed_batch_survives_restart(tmp_path, monkeypatch):
+    db_path = str(tmp_path/'meas.db')
+    add_rows = MeasurementDB.add_rows
+    def failing_add_rows(self, rows):
+        raise sqlite3.OperationalError('disk I/O error')
+    monkeypatch.setattr(MeasurementDB, 'add_rows', failing_add_rows)
+    writer = BackgroundMeasurementWriter(db_path, str(tmp_path/'spool'))
+    writer.add_rows([row(i) for i in range(5)])
+    writer.close()
+    assert writer.backlog() == (1, 5) and writer._memory_rows == 0
+    monkeypatch.setattr(MeasurementDB, 'add_rows', add_rows)
+    restarted = BackgroundMeasurementWriter(db_path, str(tmp_path/'spool'))
+    restarted.close()
+    assert restarted.stats['batches_replayed'] == 1
+    assert num_rows(db_path) == 5
+
+def test_batches_past_memory_limit_read_from_spool(tmp_path):
+    db_path = str(tmp_path/'meas.db')
+    with BackgroundMeasurementWriter(db_path, str(tmp_path/'spool'), max_memory_rows=4) as writer:
+        for start in range(0, 30, 3):
+            writer.add_rows([row(i, reading=i/10) for i in range(start, start + 3)])
+    assert num_rows(db_path) == 30
+    with sqlite3.connect(db_path) as conn:
+        readings = [r[0] for r in conn.execute('SELECT reading FROM measurements ORDER BY lagoon_number')]
+    assert readings == pytest.approx([i/10 for i in range(30)])
+
+def test_add_rows_never_waits_on_the_spool(tmp_path):
+    db_path = str(tmp_path/'meas.db')
+    writer = BackgroundMeasurementWriter(db_path, str(tmp_path/'spool'))
+    with writer._spool_lock: # as if the spool's drive stalled mid-write
+        start = time.time()
+        for start_lagoon in range(0, 96*5, 96):
+            writer.add_rows([row(i) for i in range(start_lagoon, start_lagoon + 96)])
+        assert time.time() - start < .5
+        assert writer.backlog() == (5, 480)
+    writer.close()
+    assert num_rows(db_path) == 480 and writer.backlog() == (0, 0)
+
+def test_default_spool_is_local(tmp_path, monkeypatch):
+    monkeypatch.setattr(meas_db, 'local_spool_dir', str(tmp_path/'local'))
+    db_path = str(tmp_path/'synced'/'meas.db')
+    os.mkdir(os.path.dirname(db_path))
+    with BackgroundMeasurementWriter(db_path) as writer:
+        assert os.path.dirname(writer.spool_path) == str(tmp_path/'local')
+        writer.add_rows([row(0)])
+    assert num_rows(db_path) == 1
+    assert meas_db.default_spool_path(db_path) != meas_db.default_spool_path(str(tmp_path/'meas.db'))
+
+def legacy_db(path, rows):
+    # untyped table, as robot_method made it before the typed schema
+    conn = sqlite3.connect(path)
+    conn.execute('''CREATE TABLE measurements
+                (lagoon_number, filename, plate_id, timestamp, well, measurement_delay_time, reading, data_type)''')
+    conn.executemany('INSERT INTO measurements VALUES (?,?,?,?,?,?,?,?)', rows)
+    conn.commit()
+    return conn
+
+def test_migrate_legacy_table(tmp_path):
+    legacy_rows = [(str(lagoon), '/data/plate1_abs_240315_0930.csv', 'plate1', '2024-03-15 09:30:00', 'B3', 0,
+                    .25 + lagoon/1000, 'abs') for lagoon in range(96, 192)]
+    legacy_rows.append((None, 'dummy.csv', 'none', None, 'A1', 0, 0.0, 'abs')) # dummy read, no lagoon
+    conn = legacy_db(str(tmp_path/'old.db'), legacy_rows)
+    progress = []
+    assert meas_db.migrate_meas_table(conn, chunk_size=40, progress=progress.append) == len(legacy_rows)
+    assert progress == [40, 80, 97]
+    assert [col[1] for col in conn.execute('PRAGMA table_info(measurements)')] == list(meas_columns)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == meas_schema_version
+    indexes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert {'meas_lagoon_type_time', 'meas_well_type'} <= indexes
+    migrated = conn.execute('SELECT * FROM measurements ORDER BY rowid').fetchall()
+    lagoon, _, _, timestamp, well, _, reading, _, plate_number, time_str = migrated[0]
+    assert (lagoon, well, plate_number, time_str) == (96, 'B3', 1, '2024-03-15 09:30:00')
+    assert timestamp == datetime(2024, 3, 15, 9, 30).timestamp()
+    assert reading == pytest.approx(.346)
+    assert migrated[-1][0] is None and migrated[-1][3] is None and migrated[-1][8] is None
+    conn.close()
+
+def test_opening_legacy_db_migrates_it(tmp_path):
+    db_path = str(tmp_path/'old.db')
+    legacy_db(db_path, [(0, 'plate0_abs_240101_1200.csv', 'plate0', 't', 'A1', 0, .1, 'abs')]).close()
+    with MeasurementDB(db_path) as db:
+        db.add_rows([row(1)]) # legacy rows are accepted too
+        db.add_rows([(2, 'plate0_abs_240101_1200.csv', 'plate0', 't', 'A3', 0, .1, 'abs')])
+    with sqlite3.connect(db_path) as conn:
+        rows = conn.execute('SELECT lagoon_number, timestamp, plate_number FROM measurements ORDER BY rowid').fetchall()
+    assert rows == [(0, 1704110400.0, 0), (1, 1704110400.0, 0), (2, 1704110400.0, 0)]
+
+def test_interrupted_migration_leaves_old_table(tmp_path):
+    conn = legacy_db(str(tmp_path/'old.db'), [(i, 'x_240101_1200.csv', 'p', 't', 'A1', 0, .1, 'abs') for i in range(10)])
+    def interrupt(num_rows):
+        raise KeyboardInterrupt
+    with pytest.raises(KeyboardInterrupt):
+        meas_db.migrate_meas_table(conn, chunk_size=4, progress=interrupt)
+    conn.rollback()
+    assert 'plate_number' not in [col[1] for col in conn.execute('PRAGMA table_info(measurements)')]
+    assert conn.execute('SELECT COUNT(*) FROM measurements').fetchone()[0] == 10
+    conn.close()
+
+def test_batch_is_one_transaction(tmp_path):
+    db_path = str(tmp_path/'meas.db')
+    with MeasurementDB(db_path) as db:
+        db.add_rows([row(i) for i in range(96)])
+        assert (db.stats['transactions'], db.stats['rows'], db.stats['retries']) == (1, 96, 0)
+        db.conn.execute("CREATE TRIGGER reject BEFORE INSERT ON measurements WHEN NEW.reading < 0 "
+                        "BEGIN SELECT RAISE(ABORT, 'negative reading'); END")
+        with pytest.raises(sqlite3.IntegrityError):
+            db.add_rows([row(i) for i in range(96, 150)] + [row(150, reading=-1)])
+        assert db.stats['transactions'] == 1
+    assert num_rows(db_path) == 96 # the failed batch left nothing behind
+
+def locked_db(tmp_path):
+    db_path = str(tmp_path/'meas.db')
+    db = MeasurementDB(db_path, retry_wait=.05, max_retry_wait=.1, max_retries=3)
+    db.conn.execute('PRAGMA busy_timeout = 0') # fail at once rather than wait on the lock
+    blocker = sqlite3.connect(db_path, check_same_thread=False)
+    blocker.execute('BEGIN IMMEDIATE') # holds the write lock
+    return db, blocker
+
+def test_retries_while_locked(tmp_path):
+    db, blocker = locked_db(tmp_path)
+    threading.Timer(.12, blocker.rollback).start() # lock clears after a couple of retries
+    db.add_rows([row(i) for i in range(5)])
+    assert db.stats['retries'] >= 1 and db.stats['failures'] == 0
+    assert db.stats['transactions'] == 1 and db.stats['rows'] == 5
+    assert db.stats['retry_wait_time'] > 0 and 'locked' in db.stats['last_error']
+    db.close()
+    blocker.close()
+    assert num_rows(db.db_path) == 5
+
+def test_gives_up_after_max_retries(tmp_path):
+    db, blocker = locked_db(tmp_path)
+    with pytest.raises(sqlite3.OperationalError):
+        db.add_rows([row(0)])
+    assert (db.stats['retries'], db.stats['failures'], db.stats['transactions']) == (4, 1, 0)
+    blocker.close()
+    db.close()
@@ -0,0 +1,60 @@
+import os
+import json
+import gzip
+import time
+import logging
+import threading
+
+def test_structured_log_skips_debug_by_default(stub_instruments, tmp_path):
+    from pace_util import add_structured_log
+    logger = logging.getLogger('test_structured')
+    logger.setLevel(logging.DEBUG)
+    hdlr = add_structured_log(str(tmp_path/'main.jsonl'), logger_name='test_structured')
+    try:
+        logger.debug('chatter')
+        logger.info('plain')
+        logger.info('event', extra={'event': 'service_plan', 'fields': {'wells': 3}}) # as log_event() logs
+    finally:
+        hdlr.close()
+        logger.removeHandler(hdlr)
+    entries = [json.loads(line) for line in (tmp_path/'main.jsonl').read_text().splitlines()]
+    assert [entry.get('msg', entry.get('event')) for entry in entries] == ['plain', 'service_plan']
+    assert entries[1]['wells'] == 3
+
+def test_async_log_close_gives_up_on_a_stuck_writer(stub_instruments):
+    from pace_util import AsyncLogHandler
+    writing, release = threading.Event(), threading.Event()
+    class StalledHandler(logging.Handler): # as a write to a stalled synced folder
+        def emit(self, record):
+            writing.set()
+            release.wait()
+    hdlr = AsyncLogHandler(StalledHandler(), max_queue=2, close_timeout=.2)
+    try:
+        hdlr.handle(logging.makeLogRecord({'msg': 'stuck', 'levelno': logging.INFO}))
+        assert writing.wait(5)
+        for i in range(3): # two queued behind it, one dropped
+            hdlr.handle(logging.makeLogRecord({'msg': str(i), 'levelno': logging.INFO}))
+        start = time.time()
+        hdlr.close()
+        assert time.time() - start < 2 and hdlr.stats['dropped'] == 1
+    finally:
+        release.set()
+
+def test_rollover_age_carries_over_restarts(stub_instruments, tmp_path):
+    from pace_util import CompressingRotatingFileHandler
+    log_path = tmp_path/'main.log'
+    log_path.write_text('from the last run\n')
+    hdlr = CompressingRotatingFileHandler(str(log_path), rotate_seconds=60)
+    assert hdlr.rollover_at > time.time() # no earlier rollover: the segment dates from the file itself
+    hdlr.close()
+    last_backup = tmp_path/'main.log.1.gz'
+    last_backup.write_bytes(b'')
+    started = time.time() - 120 # the current file was opened at the last rollover, two minutes ago
+    os.utime(str(last_backup), (started, started))
+    hdlr = CompressingRotatingFileHandler(str(log_path), rotate_seconds=60)
+    hdlr.setFormatter(logging.Formatter('%(message)s'))
+    hdlr.handle(logging.makeLogRecord({'msg': 'after the restart', 'levelno': logging.INFO}))
+    hdlr.close()
+    assert log_path.read_text() == 'after the restart\n'
+    with gzip.open(str(last_backup)) as f:
+        assert f.read() == b'from the last run\n'
@@ -0,0 +1,58 @@
+import os
+import sys
+import sqlite3
+import importlib
+import numpy as np
+from telemetry import read_telemetry
+
+manifest_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'util', 'controller_manifest.csv')
+
+def test_one_cycle_on_sim_instruments(stub_instruments, tmp_path, monkeypatch):
+    # robot_method reads its manifest and controller history from the working directory on import
+    (tmp_path/'method_local').mkdir()
+    with open(manifest_path) as f:
+        manifest = f.read().replace('"plate0,A1",0.6', '"plate0,A1",off').replace('"plate0,B1",0.6', '"plate0,B1",Off')
+    (tmp_path/'method_local'/'controller_manifest.csv').write_text(manifest)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', ['robot_method.py', '--reset'])
+    robot_method = importlib.import_module('robot_method')
+    from pace_util import LayoutManager, LAYFILE, command_metrics
+    from meas_db import BackgroundMeasurementWriter
+    from telemetry import TelemetryWriter
+    from cycle_scheduler import ResourceScheduler
+    from sim_instruments import sim_instruments
+
+    def readings(plate_id, protocol_name): # dense enough that every well gets more than the minimum transfer
+        return [[(.9 + .093)/3.2 if 'abs' in protocol_name else 1000.0]*12 for _ in range(8)]
+    clock, ham_int, reader_int, pump_int = sim_instruments(speedup=5000, readings=readings, seed=0)
+    reader_int.data_dir = str(tmp_path/'sim_reader_data')
+    monkeypatch.setattr(robot_method.sys_state, 'instruments', (ham_int, reader_int, pump_int))
+    monkeypatch.setattr(robot_method.sys_state, 'clock', clock.time)
+    monkeypatch.setattr(command_metrics, 'clock', clock.time)
+    robot_method.assign_labware(LayoutManager(LAYFILE))
+    robot_method.meas_db = BackgroundMeasurementWriter(str(tmp_path/'sim.db'), str(tmp_path/'sim.db.spool'))
+    robot_method.telemetry = TelemetryWriter(str(tmp_path/'sim.turbtel'))
+    scheduler = ResourceScheduler(robot_method.instrument_resources, clock=clock.time)
+    labware = robot_method.plates, robot_method.tip_boxes, robot_method.media_sources
+    try:
+        carried_service = None
+        for _ in range(2): # the first cycle has no transfer volumes yet; the second services
+            carried_service = robot_method.run_cycle(scheduler, labware, robot_method.reader_protocols,
+                                                     carried_service)
+    finally:
+        robot_method.meas_db.close()
+    assert callable(carried_service) # the last plate's service waits for the next cycle
+    ran = {task.name for task in scheduler.last_run}
+    assert {'service_prev_cycle', 'read_0', 'control_0', 'service_0', 'unload_4'} <= ran and 'service_4' not in ran
+    assert len(robot_method.controller_bank.history) == 2 # every plate stepped into one row per cycle
+    assert robot_method.controller_bank.ever_updated.any()
+    assert (tmp_path/'controller_history'/'controller_bank.npz').exists()
+    bank = robot_method.controller_bank
+    assert not bank.ever_updated[:2].any() and bank.ever_updated[2:].all() # wells that are off aren't stepped
+    assert np.isnan(bank.history.column('od')[:, :2]).all()
+    telemetry = read_telemetry(str(tmp_path/'sim.turbtel'), plates=[0])
+    assert np.isnan(telemetry['k_estimate'][:, :2]).all() and not np.isnan(telemetry['k_estimate'][:, 2:]).any()
+    with sqlite3.connect(str(tmp_path/'sim.db')) as conn:
+        recorded = {lagoon for lagoon, in conn.execute('SELECT DISTINCT lagoon_number FROM measurements')}
+    assert recorded == set(range(2, 96*robot_method.num_plates)) # nor recorded
+    assert {'ISWAP_GET', 'ISWAP_PLACE', 'PICKUP', 'ASPIRATE', 'DISPENSE', 'EJECT'} <= {name for name, *_ in ham_int.command_log}
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from service_plan import (batch_seconds, plan_service, bin_vols, plan_service_96, residual_batch_commands,
+                          head96_command_seconds, head96_commands)
+
+def test_full_plate_is_one_batch_per_column():
+    plan = plan_service([100.0]*96)
+    assert len(plan.batches) == 12
+    assert plan.batches[3] == list(range(24, 32))
+    assert plan.num_wells() == 96 and plan.seconds_saved() == 0
+    assert plan.delivered_vols() == [100.0]*96
+
+def test_inactive_and_minimal_wells_left_out():
+    vols = [100.0]*96
+    vols[9] = 20.0 # B2, at the minimum
+    active = [True]*96
+    active[0] = False # A1 off
+    plan = plan_service(vols, active, skip_at_or_below=20.0)
+    delivered = plan.delivered_vols()
+    assert delivered[0] == delivered[9] == 0.0
+    assert plan.num_wells() == 94
+    assert all(idx is None or idx % 8 == ch for batch in plan.batches for ch, idx in enumerate(batch))
+
+def test_sparse_columns_merged():
+    vols = [0.0]*96
+    for idx in (0, 13, 42, 95): # A1, F2, C6, H12: one per row, spread over four columns
+        vols[idx] = 150.0
+    plan = plan_service(vols, skip_at_or_below=0.0)
+    assert plan.batches == [[0, None, 42, None, None, 13, None, 95]]
+    assert plan.vols[0][2] == 150.0 and plan.vols[0][1] is None
+    assert plan.estimated_seconds() == pytest.approx(batch_seconds(num_columns=4))
+    assert plan.seconds_saved() == pytest.approx(12*batch_seconds() - batch_seconds(num_columns=4))
+
+def test_nothing_to_service():
+    plan = plan_service([0.0]*96, skip_at_or_below=0.0)
+    assert plan.batches == [] and plan.estimated_seconds() == 0
+    assert plan.report()['wells'] == 0
+
+def test_bin_vols():
+    assert bin_vols([20, 40, 69, 95, 200, -5], 20, 200, 4) == [20, 20, 80, 80, 200, 20]
+    assert bin_vols([50, 150], 100, 100, 4) == [100.0, 100.0]
+
+def test_96_head_plan_tops_up_above_base():
+    vols = [30.0]*96
+    vols[10], vols[50] = 190.0, 100.0
+    plan = plan_service_96(vols, min_vol=20, max_vol=200, num_bins=4)
+    assert plan.base_vol == 20
+    assert plan.residual_plan.num_wells() == 2
+    delivered = plan.delivered_vols()
+    assert delivered[10] == 200 and delivered[50] == 80 and delivered[0] == 20
+    assert plan.residual_plan.commands == residual_batch_commands
+    assert plan.seconds_saved() > 0
+
+def test_96_head_base_from_active_wells_only():
+    vols = [150.0]*96
+    vols[5] = 20.0
+    active = [True]*96
+    active[5] = False
+    plan = plan_service_96(vols, 20, 200, active, num_bins=4)
+    assert plan.base_vol == 140
+    assert plan.residual_plan.num_wells() == 0
+    assert plan.delivered_vols()[5] == 140 # the 96 head reaches inactive wells too
+
+def test_96_head_uniform_plate_needs_no_8_channel_batches():
+    plan = plan_service_96([100.0]*96, 20, 200, num_bins=10)
+    assert plan.residual_plan.batches == []
+    assert plan.estimated_seconds() == sum(head96_command_seconds[cmd] for cmd in head96_commands)
+
+def test_skipped_wells_report_no_exchange_to_controllers():
+    # a well skipped at the minimum volume gets no media at all; stepping the bank with the volumes the plan
+    # delivered (0 for it) keeps its growth rate estimate right, where assuming the minimum went in would not
+    from turb_control import ParamEstTurbCtrlrBank
+    turb_vol, min_vol, k, cycle_time = 150.0, 15.0, .6, 20*60
+    bank = ParamEstTurbCtrlrBank(2, setpoint=.8, init_od=.1, init_k=k)
+    bank.output_limits = min_vol/turb_vol, 1.0
+    ods = np.array([.2, .9]) # below setpoint, so pinned at the minimum and skipped; above, so serviced
+    delivered, all_delivered = None, []
+    for _ in range(6):
+        replace_vols = (bank.step(cycle_time, ods, delivered)*turb_vol).tolist()
+        plan = plan_service(replace_vols, skip_at_or_below=min_vol + 1e-6)
+        delivered = np.array(plan.delivered_vols(num_wells=2))/turb_vol
+        all_delivered.append(delivered)
+        ods = ods*np.exp(k*cycle_time/3600)/(1 + delivered) # grow, then dilute by what went in
+    all_delivered = np.array(all_delivered)
+    assert (all_delivered[:, 0] == 0).all() and (all_delivered[1:, 1] > min_vol/turb_vol).all()
+    np.testing.assert_allclose(bank.k_estimate, k)
+    pinned = ParamEstTurbCtrlrBank(1, setpoint=.8, init_od=ods[0], init_k=k)
+    pinned.output_limits = min_vol/turb_vol, 1.0
+    pinned.step(cycle_time, ods[0])
+    pinned.step(cycle_time, ods[0]*np.exp(k*cycle_time/3600)) # no exchange, but none reported
+    assert pinned.k_estimate[0] > k
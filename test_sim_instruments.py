@@ -0,0 +1,17 @@
+import pytest
+
+def test_fake_hamilton_latency_and_faults_by_command_name(stub_instruments):
+    import pyhamilton
+    from pace_util import send_command, wait_on_response
+    from sim_instruments import VirtualClock, FakeHamiltonInterface
+    clock = VirtualClock(speedup=1e6)
+    ham_int = FakeHamiltonInterface(clock, command_latency={'ASPIRATE': (20, 0), 'ISWAP_GET': (40, 0)},
+                                    fault_rates={'ISWAP_GET': 1.0}, seed=0)
+    wait_on_response(ham_int, send_command(ham_int, pyhamilton.ASPIRATE, channelVariable='1'))
+    cmd_id = send_command(ham_int, pyhamilton.ISWAP_GET)
+    with pytest.raises(pyhamilton.PositionError):
+        wait_on_response(ham_int, cmd_id, raise_first_exception=True)
+    (aspirate, *asp_times, asp_failed), (iswap_get, *get_times, get_failed) = ham_int.command_log
+    assert (aspirate, iswap_get) == ('ASPIRATE', 'ISWAP_GET') # not pyhamilton's command strings
+    assert asp_times[1] - asp_times[0] == pytest.approx(20) and not asp_failed
+    assert get_times[0] >= asp_times[1] and get_times[1] - get_times[0] == pytest.approx(40) and get_failed
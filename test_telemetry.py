@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from telemetry import TelemetryWriter, header_dtype, record_dtype, read_header, read_telemetry, telemetry_magic
+
+def write_cycles(writer, num_cycles, num_plates=2, num_wells=96, start=0):
+    for cycle in range(start, start + num_cycles):
+        for plate_no in range(num_plates):
+            vals = np.full(num_wells, cycle + plate_no/10)
+            writer.append(1000. + cycle, plate_no, vals, vals + 1, vals + 2, vals + 3, vals + 4)
+
+def test_format(tmp_path):
+    path = str(tmp_path/'run.turbtel')
+    write_cycles(TelemetryWriter(path, num_wells=8), 3, num_wells=8)
+    raw = open(path, 'rb').read()
+    assert header_dtype.itemsize == 16 and raw[:8] == telemetry_magic
+    assert read_header(path) == 8
+    assert len(raw) == 16 + 6*record_dtype(8).itemsize
+    records = np.frombuffer(raw[16:], dtype=record_dtype(8))
+    np.testing.assert_array_equal(records['plate'], [0, 1, 0, 1, 0, 1])
+    np.testing.assert_array_equal(records['replace_vol'][3], np.full(8, 1.1 + 4))
+
+def test_read_window_and_plates(tmp_path):
+    path = str(tmp_path/'run.turbtel')
+    write_cycles(TelemetryWriter(path), 10)
+    records = read_telemetry(path, start_time=1003, end_time=1006, plates=[1])
+    np.testing.assert_array_equal(records['time'], [1003, 1004, 1005])
+    np.testing.assert_array_equal(records['od_reading'][:, 0], [3.1, 4.1, 5.1])
+    assert len(read_telemetry(path)['time']) == 20
+
+def test_reopen_truncates_torn_record(tmp_path):
+    path = str(tmp_path/'run.turbtel')
+    write_cycles(TelemetryWriter(path), 2)
+    with open(path, 'ab') as f:
+        f.write(b'\x07'*100) # crash partway through a record
+    assert len(read_telemetry(path)['time']) == 4 # ignored on read
+    write_cycles(TelemetryWriter(path), 2, start=2)
+    records = read_telemetry(path)
+    np.testing.assert_array_equal(records['time'], np.repeat([1000, 1001, 1002, 1003], 2))
+    np.testing.assert_array_equal(records['k_estimate'][-1], np.full(96, 3.1 + 2))
+
+def test_rejects_mismatched_files(tmp_path):
+    path = str(tmp_path/'run.turbtel')
+    TelemetryWriter(path, num_wells=96)
+    with pytest.raises(ValueError):
+        TelemetryWriter(path, num_wells=8)
+    other = tmp_path/'other.turbtel'
+    other.write_bytes(b'x'*64)
+    with pytest.raises(ValueError):
+        read_header(str(other))
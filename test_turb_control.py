@@ -0,0 +1,178 @@
+import numpy as np
+import pytest
+from turb_control import StateHistory, ParamEstTurbCtrlr, ParamEstTurbCtrlrBank
+
+cycle_time = 20*60
+
+def readings(num_ctrlrs, num_steps, seed=0):
+    # growing, noisy reads, with some at or below zero as a blank-subtracted reader can give
+    rng = np.random.default_rng(seed)
+    ods = rng.uniform(.05, .8, (num_steps, num_ctrlrs))
+    ods[rng.random(ods.shape) < .1] = -rng.uniform(0, .02)
+    ods[-1, ::7] = 0.0
+    return ods
+
+def test_bank_matches_scalar_controllers():
+    num_ctrlrs, num_steps = 40, 30
+    rng = np.random.default_rng(1)
+    setpoints = rng.uniform(.2, .8, num_ctrlrs)
+    scalars = [ParamEstTurbCtrlr(setpoint, init_od=.1) for setpoint in setpoints]
+    bank = ParamEstTurbCtrlrBank(num_ctrlrs, init_od=.1)
+    bank.setpoint[:] = setpoints
+    for ctrlr in scalars:
+        ctrlr.output_limits = .05, .68
+    bank.output_limits = .05, .68
+    ods = readings(num_ctrlrs, num_steps)
+    for step, od_row in enumerate(ods):
+        delivered = None if step % 3 else rng.uniform(0, .5, num_ctrlrs) # some steps report what was delivered
+        with np.errstate(all='ignore'):
+            expected = [ctrlr.step(cycle_time, od, None if delivered is None else delivered[i])
+                        for i, (ctrlr, od) in enumerate(zip(scalars, od_row))]
+            outputs = bank.step(cycle_time, od_row, delivered)
+        np.testing.assert_allclose(outputs, expected)
+        np.testing.assert_allclose(bank.k_estimate, [ctrlr.k_estimate for ctrlr in scalars])
+    for key in ('od', 'output', 'k_estimate'):
+        np.testing.assert_allclose(np.array([view.scrape_history(key) for view in bank.views]),
+                                   np.array([ctrlr.scrape_history(key) for ctrlr in scalars]))
+
+def test_views_step_like_scalar_controllers():
+    num_ctrlrs, num_steps = 12, 10
+    scalars = [ParamEstTurbCtrlr(.5, init_od=.1) for _ in range(num_ctrlrs)]
+    bank = ParamEstTurbCtrlrBank(num_ctrlrs, setpoint=.5, init_od=.1)
+    for od_row in readings(num_ctrlrs, num_steps, seed=2):
+        with np.errstate(all='ignore'):
+            for view, ctrlr, od in zip(bank.views, scalars, od_row):
+                assert view.step(cycle_time, od) == pytest.approx(ctrlr.step(cycle_time, od))
+    for view, ctrlr in zip(bank.views, scalars):
+        assert len(view.state_history) == len(ctrlr.state_history)
+        assert view.state == pytest.approx(ctrlr.state)
+        for key in StateHistory.keys:
+            np.testing.assert_allclose(view.scrape_history(key), ctrlr.scrape_history(key))
+
+def test_view_steps_share_history_rows():
+    bank = ParamEstTurbCtrlrBank(96)
+    for _ in range(3):
+        for view in bank.views:
+            view.step(cycle_time, .3)
+    assert len(bank.history) == 3 # one row per round of the views, not per view
+    bank.views[5].step(cycle_time, .3) # stepped again before the others: a new row
+    assert len(bank.history) == 4
+    assert len(bank.views[5].history()) == 4 and len(bank.views[6].history()) == 3
+    bank.step(cycle_time, .3) # whole-bank steps always take their own row
+    bank.views[6].step(cycle_time, .3)
+    assert len(bank.history) == 6
+
+def test_windowed_history_keeps_views_and_spills():
+    history = StateHistory(window=4, spill_path=None)
+    for i in range(8):
+        history.append({'update_time': i, 'od': i/10})
+    col = history.column('update_time')
+    np.testing.assert_array_equal(col, np.arange(8))
+    history.append({'update_time': 8}) # full: shifts the last 4 rows down
+    np.testing.assert_array_equal(col, np.arange(8)) # the earlier view is unaffected
+    np.testing.assert_array_equal(history.column('update_time'), np.arange(4, 9))
+    assert len(history) == 9 and history[-1]['update_time'] == 8
+    with pytest.raises(IndexError):
+        history[0]
+
+def test_spilled_rows_read_back(tmp_path):
+    spill_path = str(tmp_path/'bank.spill')
+    history = StateHistory(window=3, spill_path=spill_path, row_shape=(2,))
+    rows = np.arange(10*5*2, dtype=float).reshape(10, 5, 2)
+    history.extend(rows)
+    spilled = history.read_spill()
+    assert len(spilled) == history.num_dropped
+    np.testing.assert_array_equal(np.concatenate((spilled, np.swapaxes(history.rows(), 0, 1))), rows)
+
+def test_scrape_history_is_nan_padded_array():
+    ctrlr = ParamEstTurbCtrlr(.5, init_od=.1)
+    ctrlr.step(cycle_time, .2)
+    ctrlr.state_history.append({'update_time': ctrlr.state['update_time'] + cycle_time, 'od': .25}) # no output
+    ctrlr.step(cycle_time, .3)
+    outputs = ctrlr.scrape_history('output')
+    assert isinstance(outputs, np.ndarray) and len(outputs) == 3
+    assert np.isnan(outputs[1]) and not np.isnan(outputs[[0, 2]]).any()
+    np.testing.assert_array_equal(ctrlr.scrape_history('output', fill_value=0), np.nan_to_num(outputs))
+    np.testing.assert_allclose(ctrlr.scrape_history('od'), [.2, .25, .3])
+
+def test_log_recovers_from_torn_record(tmp_path):
+    save_dir = str(tmp_path)
+    ctrlr = ParamEstTurbCtrlr(.5, init_od=.1)
+    ctrlr.enable_log(save_dir, compact_every=100)
+    for od in (.2, .25, .3):
+        ctrlr.step(cycle_time, od)
+    log_path = tmp_path/(ctrlr.name + '.turblog')
+    with open(log_path, 'ab') as f:
+        f.write(b'\x01'*13) # crash partway through the next record
+    # restart: reload, then keep logging
+    restarted = ParamEstTurbCtrlr(.5, init_od=.1)
+    restarted.name = ctrlr.name
+    restarted.load(save_dir, ctrlr.name + '.turbhistory')
+    restarted.enable_log(save_dir, compact_every=100)
+    restarted.step(cycle_time, .35)
+    assert log_path.stat().st_size % (8*len(StateHistory.keys)) == 0
+    reloaded = ParamEstTurbCtrlr(.5, init_od=.1)
+    reloaded.load(save_dir, ctrlr.name + '.turbhistory')
+    # with no snapshot yet, the log's first record stands in for the initial state
+    np.testing.assert_allclose(reloaded.state_history.column('od'), [.2, .25, .3, .35])
+
+def test_log_compacts_into_snapshot(tmp_path):
+    ctrlr = ParamEstTurbCtrlr(.5, init_od=.1)
+    ctrlr.enable_log(str(tmp_path), compact_every=4)
+    for i in range(10):
+        ctrlr.step(cycle_time, .1 + i/100)
+    assert (tmp_path/(ctrlr.name + '.turblog')).stat().st_size == 2*8*len(StateHistory.keys)
+    reloaded = ParamEstTurbCtrlr(.5)
+    reloaded.load(str(tmp_path), ctrlr.name + '.turbhistory')
+    np.testing.assert_allclose(reloaded.scrape_history('od'), ctrlr.scrape_history('od'))
+
+def test_bank_checkpoint_after_spill_has_no_duplicates(tmp_path):
+    save_dir = str(tmp_path)
+    bank = ParamEstTurbCtrlrBank(8, setpoint=.5, init_od=.1)
+    bank.set_history_window(3, save_dir)
+    for i in range(10):
+        bank.step(cycle_time, .1 + i/50)
+    bank.save(save_dir)
+    with np.load(str(tmp_path/'controller_bank.npz')) as saved:
+        assert 'history' not in saved.files and int(saved['num_spilled']) == 10 # history is in the spill file
+    for i in range(4): # rows spilled past the checkpoint, then a crash before the next one
+        bank.step(cycle_time, .5)
+    restarted = ParamEstTurbCtrlrBank(8, setpoint=.5)
+    for view, old_view in zip(restarted.views, bank.views):
+        view.name = old_view.name
+    restarted.set_history_window(3, save_dir)
+    restarted.load(save_dir)
+    assert len(restarted.history) == 10
+    np.testing.assert_allclose(restarted.history.read_spill()[:, 1, 2], .1 + np.arange(10)/50)
+    np.testing.assert_allclose(restarted.views[2].scrape_history('od'), .1 + np.arange(7, 10)/50) # last window
+    for i in range(5): # carries on without duplicating what was read back
+        restarted.step(cycle_time, .6)
+    restarted.save(save_dir)
+    np.testing.assert_allclose(restarted.history.read_spill()[:, 1, 2], np.r_[.1 + np.arange(10)/50, [.6]*5])
+
+def test_bank_spill_reset(tmp_path):
+    bank = ParamEstTurbCtrlrBank(4)
+    bank.set_history_window(2, str(tmp_path))
+    for i in range(6):
+        bank.step(cycle_time, .2)
+    bank.save(str(tmp_path))
+    fresh = ParamEstTurbCtrlrBank(4)
+    fresh.set_history_window(2, str(tmp_path))
+    fresh.history.resume_spill(0) # as robot_method does with --reset
+    fresh.step(cycle_time, .3)
+    fresh.save(str(tmp_path))
+    np.testing.assert_allclose(fresh.history.read_spill()[:, 1], [[.3]*4])
+
+def test_view_log_records_bank_and_view_steps(tmp_path):
+    save_dir = str(tmp_path)
+    bank = ParamEstTurbCtrlrBank(4, setpoint=.5, init_od=.1)
+    bank.views[1].enable_log(save_dir, compact_every=3)
+    for i in range(4):
+        bank.step(cycle_time, .1 + i/20) # as robot_method steps a plate
+    bank.views[1].step(cycle_time, .4)
+    assert not (tmp_path/(bank.views[0].name + '.turblog')).exists()
+    reloaded = ParamEstTurbCtrlr(.5)
+    reloaded.load(save_dir, bank.views[1].name + '.turbhistory')
+    np.testing.assert_allclose(reloaded.scrape_history('od'), [.1, .15, .2, .25, .4])
+    for key in ('output', 'k_estimate'):
+        np.testing.assert_allclose(reloaded.scrape_history(key), bank.views[1].scrape_history(key))
@@ -1,138 +1,640 @@
-import os
-import numpy as np
-import matplotlib.pyplot as plt
-import random
-import time
-import json
-
-class TurbController: # Abstract class for real-time turbidostat feedback control
-    id_counter = 0
-
-    def __init__(self, setpoint=0.0, init_od=1e-6):
-        self.output_limits = 0, float('inf')
-        self.setpoint = setpoint
-        self.od = init_od
-        self.state = {'update_time': time.time(), 'od':init_od}
-        self.state_history = [self.state]
-        self.name = str(self.id_counter)
-        self.__class__.id_counter += 1
-        self.ever_updated = False
-
-    def step(self, delta_time=None, od_meas=None, last_transfer_vol_frac=None):
-        if delta_time is None: # use real time
-            self.state = {'update_time': time.time()}
-        else: 
-            self.state = {'update_time': self._last_time() + delta_time}
-        delta_time = self.state['update_time'] - self._last_time()
-        transfer_vol_frac = self._step(delta_time, od_meas, last_transfer_vol_frac)
-        # limit output
-        min_out, max_out = self.output_limits
-        transfer_vol_frac = min(max_out, max(min_out, transfer_vol_frac))
-        self.state.update({'od':self.od, 'delta_time':delta_time, 'output':transfer_vol_frac})
-        self.state_history.append(self.state)
-        self.ever_updated = True
-        return transfer_vol_frac
-
-    def _step(self, delta_time, od_meas, last_transfer_frac=None):
-        #last_transfer_frac: allow override of last command used in calculations with report of what system actually did
-        pass
-    
-    def _last_time(self):
-        return self.state_history[-1]['update_time']
-
-    def history(self):
-        return self.state_history[1:] if self.state_history else [] # omit initial state
-
-    def last_known_od(self):
-        last_state = self.state_history[-1]
-        return last_state.get('od', self.od)
-
-    def last_known_output(self):
-        last_state = self.state_history[-1]
-        return last_state.get('output', 0)
-
-    def scrape_history(self, key, fill_value = None):
-        return [state.get(key, fill_value) for state in self.history()]
-
-    def __call__(self, *args, **kwargs):
-        return self.step(None, *args, **kwargs) # default to real time
-
-    def save(self, save_dir='controller_history', filename=None):
-        if not os.path.exists(save_dir):
-            os.mkdir(save_dir)
-        if not os.path.isdir(save_dir):
-            raise ValueError('Controller save directory is not a directory')
-        if filename is None:
-            filename = self.name + '.turbhistory'
-        path = os.path.join(save_dir, filename)
-        with open(path, 'w+') as f:
-            f.write(json.dumps(self.state_history))
-
-    def load(self, from_dir='controller_history', filename=None):
-        if filename is None:
-            filename = self.name + '.turbhistory' # go get the one with this one's name from before
-        path = os.path.join(from_dir, filename)
-        if not os.path.isfile(path):
-            raise ValueError('No controller save history found at ' + path)
-        with open(path) as f:
-            self.state_history = json.loads(f.read())
-        self.ever_updated = False
-
-
-class ParamEstTurbCtrlr(TurbController):
-    def __init__(self, setpoint=0.0, init_od=1e-6, init_k=None):
-        super(ParamEstTurbCtrlr, self).__init__(setpoint, init_od)
-        self.default_k = .5
-        if init_k is None:
-            init_k = self.default_k
-        self.k_estimate = init_k
-        self.state.update({'k_estimate': init_k})
-        self.k_limits = .05, 3
-
-    def predict_od(self, od_now, transfer_vol_frac, dt, k):
-        # delta time (dt) is in seconds, k is in hr^-1
-        return od_now*np.exp(dt/3600*k)/(1+transfer_vol_frac)
-
-    def infer_k(self, od_then, transfer_vol_frac, od_now, dt):
-        min_k, max_k = self.k_limits
-        return max(min_k, min(max_k, np.log((transfer_vol_frac + 1)*od_now/od_then)/dt*3600))
-
-    def last_known_k(self):
-        last_state = self.state_history[-1]
-        return last_state.get('k_estimate', self.default_k)
-
-    def _step(self, delta_time, od_meas, last_transfer_frac=None):
-        prior_od = self.last_known_od()
-        last_known_out = self.last_known_output()
-        prior_k = self.last_known_k()
-        last_state = self.state_history[-1]
-        prior_out = last_known_out if last_transfer_frac is None else last_transfer_frac
-        if od_meas is not None:
-            prediction = self.predict_od(prior_od, prior_out, delta_time, prior_k)
-            self.od = od_meas # max(prediction - .05, min(prediction + .05, od_meas)) # clamp based on prediction to rule out crazy readings
-        #error = self.predict_od(prior_od, prior_out, delta_time, prior_k) - od_meas
-        if self.ever_updated: # only sensible to infer k after more than one point
-            s = .15
-            self.k_estimate = prior_k*(1-s) + self.infer_k(prior_od, prior_out,
-                                                      self.od, delta_time)*s
-            # try to close a fraction of the distance to the correct volume per iteration
-            # use model to solve for perfect transfer volume, which may not be achievable
-            s = .7
-            transfer_vol_frac = (self.od*np.exp(delta_time/3600*self.k_estimate)
-                        /((self.setpoint*s + prior_od*(1-s))) - 1)
-        else:
-            # play it safe
-            self.k_estimate = prior_k
-            transfer_vol_frac = prior_out
-        # limit output
-        min_out, max_out = self.output_limits
-        transfer_vol_frac = min(max_out, max(min_out, transfer_vol_frac))
-        self.state.update({'k_estimate':self.k_estimate})
-        return transfer_vol_frac
-
-    def set_od(self, od):
-        self.od = od
-
-if __name__ == '__main__':
-    pass
-
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+import random
+import time
+import json
+
+class StateHistory: # Columnar store of controller states, optionally bounded to a window of recent rows
+    keys = ('update_time', 'od', 'delta_time', 'output', 'k_estimate')
+
+    def __init__(self, window=None, spill_path=None, row_shape=()):
+        # window: max number of rows kept in memory (None for unbounded). Older rows are appended to
+        # spill_path as raw float64 records if given, otherwise discarded. flush_spill() also appends the rows
+        # still in memory, so the spill file can hold the whole history.
+        # row_shape: shape of each field per row, e.g. (num_ctrlrs,) for a controller bank.
+        self.window = window
+        self.spill_path = spill_path
+        self.row_shape = tuple(row_shape)
+        self.num_dropped = 0 # rows spilled or discarded, still counted in len()
+        self.num_spilled = 0 # rows in the spill file, which may include some still in memory
+        self._len = 0
+        capacity = 16 if window is None else 2*window # twice the window so rows only shift every window appends
+        self._data = np.full((len(self.keys), capacity) + self.row_shape, np.nan)
+
+    def __len__(self):
+        return self.num_dropped + self._len
+
+    def _row_to_state(self, row):
+        if self.row_shape:
+            return dict(zip(self.keys, row))
+        return {key: float(val) for key, val in zip(self.keys, row) if not np.isnan(val)}
+
+    def _state_to_row(self, state):
+        if isinstance(state, dict):
+            return [state.get(key, np.nan) for key in self.keys]
+        return state
+
+    def _mem_idx(self, idx):
+        if idx < 0:
+            idx += len(self)
+        idx -= self.num_dropped
+        if not 0 <= idx < self._len:
+            raise IndexError('State history index out of range (or no longer in memory)')
+        return idx
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self))) if i >= self.num_dropped]
+        return self._row_to_state(self._data[:, self._mem_idx(idx)])
+
+    def __setitem__(self, idx, state):
+        self._data[:, self._mem_idx(idx)] = self._state_to_row(state)
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self._row_to_state(self._data[:, i])
+
+    def append(self, state):
+        if self._len == self._data.shape[1]:
+            self._make_room()
+        self._data[:, self._len] = self._state_to_row(state)
+        self._len += 1
+
+    def extend(self, states):
+        for state in states:
+            self.append(state)
+
+    @classmethod
+    def from_rows(cls, rows):
+        # unbounded history of a (len(keys), num_rows, *row_shape) array of rows, copied in one go
+        history = cls(row_shape=rows.shape[2:])
+        num_rows = rows.shape[1]
+        if num_rows > history._data.shape[1]:
+            history._data = np.full((len(cls.keys), num_rows) + history.row_shape, np.nan)
+        history._data[:, :num_rows] = rows
+        history._len = num_rows
+        return history
+
+    def _make_room(self):
+        if self.window is None:
+            grown = np.full((self._data.shape[0], 2*self._data.shape[1]) + self.row_shape, np.nan)
+            grown[:, :self._len] = self._data[:, :self._len]
+            self._data = grown
+            return
+        num_old = self._len - self.window
+        if self.spill_path is not None and self.num_spilled < self.num_dropped + num_old:
+            self._spill(self._data[:, self.num_spilled - self.num_dropped:num_old])
+        # into a fresh buffer, so views handed out by column()/rows() keep showing the rows they were taken over
+        shifted = np.full_like(self._data, np.nan)
+        shifted[:, :self.window] = self._data[:, num_old:self._len]
+        self._data = shifted
+        self._len = self.window
+        self.num_dropped += num_old
+
+    def column(self, key, start=0):
+        # zero-copy view of one field for rows from index start on that are still in memory; rows appended
+        # later aren't in it, and dropping older rows from memory doesn't change it
+        start = max(0, start - self.num_dropped)
+        return self._data[self.keys.index(key), start:self._len]
+
+    def rows(self, start=0):
+        # zero-copy (len(keys), num_rows, *row_shape) view of the rows still in memory
+        start = max(0, start - self.num_dropped)
+        return self._data[:, start:self._len]
+
+    def _spill(self, rows):
+        with open(self.spill_path, 'ab') as f:
+            np.ascontiguousarray(np.swapaxes(rows, 0, 1)).tofile(f)
+        self.num_spilled += rows.shape[1]
+
+    def flush_spill(self):
+        # append the rows not yet in the spill file; rows already there must not be changed afterwards
+        if self.num_spilled < len(self):
+            self._spill(self._data[:, self.num_spilled - self.num_dropped:self._len])
+
+    def read_spill(self):
+        # (num_rows, len(keys), *row_shape) array of the rows spilled to disk, oldest first
+        if self.spill_path is None or not os.path.isfile(self.spill_path):
+            return np.empty((0, len(self.keys)) + self.row_shape)
+        return np.fromfile(self.spill_path).reshape((-1, len(self.keys)) + self.row_shape)
+
+    def resume_spill(self, num_rows):
+        # continue from the first num_rows rows of the spill file (e.g. as of a checkpoint), reading the last
+        # window of them back into memory; rows written after those are cut off. 0 starts a new history.
+        row_size = len(self.keys)*int(np.prod(self.row_shape))
+        num_in_memory = 0
+        if self.spill_path is not None and os.path.isfile(self.spill_path):
+            if os.path.getsize(self.spill_path) > 8*num_rows*row_size:
+                os.truncate(self.spill_path, 8*num_rows*row_size)
+            num_in_memory = num_rows if self.window is None else min(self.window, num_rows)
+            rows = np.fromfile(self.spill_path, count=num_in_memory*row_size, offset=8*(num_rows - num_in_memory)*row_size)
+            rows = np.swapaxes(rows.reshape((-1, len(self.keys)) + self.row_shape), 0, 1)
+            num_in_memory = rows.shape[1]
+            if num_in_memory > self._data.shape[1]:
+                self._data = np.full((len(self.keys), num_in_memory) + self.row_shape, np.nan)
+            self._data[:, :num_in_memory] = rows
+        self._len = num_in_memory
+        self.num_dropped = num_rows - num_in_memory
+        self.num_spilled = num_rows
+
+    def to_list(self):
+        return list(self)
+
+
+class TurbController: # Abstract class for real-time turbidostat feedback control
+    id_counter = 0
+    history_window = None # max states kept in memory; None to keep all of them
+
+    def __init__(self, setpoint=0.0, init_od=1e-6):
+        self.output_limits = 0, float('inf')
+        self.setpoint = setpoint
+        self.od = init_od
+        self.state = {'update_time': time.time(), 'od':init_od}
+        self.state_history = StateHistory(self.history_window)
+        self.state_history.append(self.state)
+        self.name = str(self.id_counter)
+        self.__class__.id_counter += 1
+        self.ever_updated = False
+        self.log_dir = None # incremental persistence off until enable_log()
+
+    def set_history_window(self, window, spill_dir=None):
+        # keep only the last window states in memory, spilling older ones to <name>.turbspill in spill_dir
+        spill_path = None if spill_dir is None else os.path.join(spill_dir, self.name + '.turbspill')
+        old_history = self.state_history
+        self.state_history = StateHistory(window, spill_path)
+        self.state_history.extend(old_history)
+
+    def step(self, delta_time=None, od_meas=None, last_transfer_vol_frac=None):
+        if delta_time is None: # use real time
+            self.state = {'update_time': time.time()}
+        else: 
+            self.state = {'update_time': self._last_time() + delta_time}
+        delta_time = self.state['update_time'] - self._last_time()
+        transfer_vol_frac = self._step(delta_time, od_meas, last_transfer_vol_frac)
+        # limit output
+        min_out, max_out = self.output_limits
+        transfer_vol_frac = min(max_out, max(min_out, transfer_vol_frac))
+        self.state.update({'od':self.od, 'delta_time':delta_time, 'output':transfer_vol_frac})
+        self.state_history.append(self.state)
+        self.ever_updated = True
+        if self.log_dir is not None:
+            self._log_state(self.state)
+        return transfer_vol_frac
+
+    def _step(self, delta_time, od_meas, last_transfer_frac=None):
+        #last_transfer_frac: allow override of last command used in calculations with report of what system actually did
+        pass
+    
+    def _last_time(self):
+        return self.state_history[-1]['update_time']
+
+    def history(self):
+        return self.state_history[1:] if len(self.state_history) else [] # omit initial state
+
+    def last_known_od(self):
+        last_state = self.state_history[-1]
+        return last_state.get('od', self.od)
+
+    def last_known_output(self):
+        last_state = self.state_history[-1]
+        return last_state.get('output', 0)
+
+    def scrape_history(self, key, fill_value = None):
+        # zero-copy array view over the history (initial state omitted); missing values are nan unless filled
+        col = self.state_history.column(key, start=1)
+        if fill_value is None:
+            return col
+        return np.where(np.isnan(col), fill_value, col)
+
+    def __call__(self, *args, **kwargs):
+        return self.step(None, *args, **kwargs) # default to real time
+
+    def save(self, save_dir='controller_history', filename=None):
+        if not os.path.exists(save_dir):
+            os.mkdir(save_dir)
+        if not os.path.isdir(save_dir):
+            raise ValueError('Controller save directory is not a directory')
+        if filename is None:
+            filename = self.name + '.turbhistory'
+        path = os.path.join(save_dir, filename)
+        with open(path + '.tmp', 'w+') as f:
+            f.write(json.dumps(self.state_history.to_list()))
+        os.replace(path + '.tmp', path) # never leave a half-written history behind
+
+    def load(self, from_dir='controller_history', filename=None, tail=None):
+        # tail: if given, keep only the latest state and up to this many states before it
+        if filename is None:
+            filename = self.name + '.turbhistory' # go get the one with this one's name from before
+        path = os.path.join(from_dir, filename)
+        log_path = os.path.splitext(path)[0] + '.turblog'
+        if not os.path.isfile(path) and not os.path.isfile(log_path):
+            raise ValueError('No controller save history found at ' + path)
+        states = []
+        if os.path.isfile(path):
+            with open(path) as f:
+                states = json.loads(f.read())
+        self._trim_log(log_path)
+        states += self._read_log(log_path, after_time=states[-1]['update_time'] if states else None)
+        if tail is not None:
+            states = states[-tail-1:]
+        state_history = StateHistory(self.state_history.window, self.state_history.spill_path)
+        state_history.extend(states)
+        self.state_history = state_history
+        self.ever_updated = False
+
+    def enable_log(self, save_dir='controller_history', compact_every=96):
+        # incremental persistence: each step appends one fixed-size record to <name>.turblog instead of
+        # rewriting the whole history; every compact_every steps the log is folded into <name>.turbhistory
+        if not os.path.exists(save_dir):
+            os.mkdir(save_dir)
+        self.log_dir = save_dir
+        self.compact_every = compact_every
+        self.steps_since_compact = 0
+        self._trim_log(os.path.join(save_dir, self.name + '.turblog'))
+
+    def _log_state(self, state):
+        row = np.array([state.get(key, np.nan) for key in StateHistory.keys], dtype='<f8')
+        with open(os.path.join(self.log_dir, self.name + '.turblog'), 'ab') as f:
+            f.write(row.tobytes())
+        self.steps_since_compact += 1
+        if self.steps_since_compact >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        # snapshot the history, then drop the log records it now contains
+        self.save(self.log_dir)
+        open(os.path.join(self.log_dir, self.name + '.turblog'), 'wb').close()
+        self.steps_since_compact = 0
+
+    @staticmethod
+    def _trim_log(log_path):
+        # cut off a record torn by a crash mid-write, so records appended after it stay aligned
+        if os.path.isfile(log_path):
+            size = os.path.getsize(log_path)
+            if size % (8*len(StateHistory.keys)):
+                os.truncate(log_path, size - size % (8*len(StateHistory.keys)))
+
+    @staticmethod
+    def _read_log(log_path, after_time=None):
+        # states from a .turblog; a torn record at the end from a crash mid-write is ignored, as are records
+        # already in the snapshot (if we died between writing the snapshot and truncating the log)
+        if not os.path.isfile(log_path):
+            return []
+        with open(log_path, 'rb') as f:
+            raw = f.read()
+        record_size = 8*len(StateHistory.keys)
+        rows = np.frombuffer(raw[:len(raw) - len(raw)%record_size], dtype='<f8').reshape(-1, len(StateHistory.keys))
+        if after_time is not None:
+            rows = rows[rows[:, 0] > after_time]
+        return [{key: float(val) for key, val in zip(StateHistory.keys, row) if not np.isnan(val)} for row in rows]
+
+
+class ParamEstTurbCtrlr(TurbController):
+    def __init__(self, setpoint=0.0, init_od=1e-6, init_k=None):
+        super(ParamEstTurbCtrlr, self).__init__(setpoint, init_od)
+        self.default_k = .5
+        if init_k is None:
+            init_k = self.default_k
+        self.k_estimate = init_k
+        self.state.update({'k_estimate': init_k})
+        self.state_history[-1] = self.state
+        self.k_limits = .05, 3
+        self.k_smoothing = .15 # weight of each newly inferred k in the running k estimate
+        self.approach_frac = .7 # fraction of the distance from the last od to the setpoint to close per step
+
+    def predict_od(self, od_now, transfer_vol_frac, dt, k):
+        # delta time (dt) is in seconds, k is in hr^-1
+        return od_now*np.exp(dt/3600*k)/(1+transfer_vol_frac)
+
+    def infer_k(self, od_then, transfer_vol_frac, od_now, dt):
+        min_k, max_k = self.k_limits
+        return max(min_k, min(max_k, np.log((transfer_vol_frac + 1)*od_now/od_then)/dt*3600))
+
+    def last_known_k(self):
+        last_state = self.state_history[-1]
+        return last_state.get('k_estimate', self.default_k)
+
+    def _step(self, delta_time, od_meas, last_transfer_frac=None):
+        prior_od = self.last_known_od()
+        last_known_out = self.last_known_output()
+        prior_k = self.last_known_k()
+        last_state = self.state_history[-1]
+        prior_out = last_known_out if last_transfer_frac is None else last_transfer_frac
+        if od_meas is not None:
+            prediction = self.predict_od(prior_od, prior_out, delta_time, prior_k)
+            self.od = od_meas # max(prediction - .05, min(prediction + .05, od_meas)) # clamp based on prediction to rule out crazy readings
+        #error = self.predict_od(prior_od, prior_out, delta_time, prior_k) - od_meas
+        if self.ever_updated: # only sensible to infer k after more than one point
+            s = self.k_smoothing
+            self.k_estimate = prior_k*(1-s) + self.infer_k(prior_od, prior_out,
+                                                      self.od, delta_time)*s
+            # try to close a fraction of the distance to the correct volume per iteration
+            # use model to solve for perfect transfer volume, which may not be achievable
+            s = self.approach_frac
+            transfer_vol_frac = (self.od*np.exp(delta_time/3600*self.k_estimate)
+                        /((self.setpoint*s + prior_od*(1-s))) - 1)
+        else:
+            # play it safe
+            self.k_estimate = prior_k
+            transfer_vol_frac = prior_out
+        # limit output
+        min_out, max_out = self.output_limits
+        transfer_vol_frac = min(max_out, max(min_out, transfer_vol_frac))
+        self.state.update({'k_estimate':self.k_estimate})
+        return transfer_vol_frac
+
+    def set_od(self, od):
+        self.od = od
+
+
+class ParamEstTurbCtrlrBank: # Many ParamEstTurbCtrlrs stepped together as arrays, one element per well
+    id_counter = 0
+
+    def __init__(self, num_ctrlrs, setpoint=0.0, init_od=1e-6, init_k=None):
+        self.default_k = .5
+        if init_k is None:
+            init_k = self.default_k
+        n = self.num_ctrlrs = num_ctrlrs
+        self.setpoint = np.full(n, setpoint, dtype=float)
+        self.od = np.full(n, init_od, dtype=float)
+        self.k_estimate = np.full(n, init_k, dtype=float)
+        # values from the last recorded state, which the update is computed from
+        self.last_time = np.full(n, time.time())
+        self.last_od = self.od.copy()
+        self.last_k = self.k_estimate.copy()
+        self.last_output = np.zeros(n)
+        self.min_output = np.zeros(n)
+        self.max_output = np.full(n, float('inf'))
+        self.min_k = np.full(n, .05)
+        self.max_k = np.full(n, 3.0)
+        self.k_smoothing = np.full(n, .15) # tuning, per controller as in ParamEstTurbCtrlr
+        self.approach_frac = np.full(n, .7)
+        self.ever_updated = np.zeros(n, dtype=bool)
+        self.logged = np.zeros(n, dtype=bool) # controllers whose view has enable_log() on
+        self.history = StateHistory(row_shape=(n,)) # one row per step, nan for controllers not stepped
+        self._open_row = False # whether single-controller steps may still fill in the last row
+        self.name_offset = self.__class__.id_counter
+        self.__class__.id_counter += n
+        self.views = [ParamEstTurbCtrlrView(self, i) for i in range(n)]
+
+    def set_history_window(self, window, spill_dir=None, filename='controller_bank.spill'):
+        # keep only the last window rows in memory, spilling older ones to filename in spill_dir
+        spill_path = None if spill_dir is None else os.path.join(spill_dir, filename)
+        old_history = self.history
+        self.history = StateHistory(window, spill_path, row_shape=(self.num_ctrlrs,))
+        for row in np.swapaxes(old_history.rows(), 0, 1):
+            self.history.append(row)
+        self._open_row = False
+
+    def save(self, save_dir='controller_history', filename='controller_bank.npz'):
+        # every controller in one file, atomically replaced so a crash never leaves a mix of old and new
+        if not os.path.exists(save_dir):
+            os.mkdir(save_dir)
+        if not os.path.isdir(save_dir):
+            raise ValueError('Controller save directory is not a directory')
+        path = os.path.join(save_dir, filename)
+        # state each controller's bank history starts from (its last state loaded from elsewhere, if any)
+        initial = np.array([[view._base_history[-1].get(key, np.nan) for view in self.views]
+                            for key in StateHistory.keys])
+        arrays = {}
+        if self.history.spill_path is not None: # history goes to the spill file; the checkpoint says how far
+            self.history.flush_spill()
+            self._open_row = False # flushed rows must not be filled in further
+            arrays['num_spilled'] = self.history.num_spilled
+        else:
+            arrays['history'] = self.history.rows()
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f, names=np.array([view.name for view in self.views]), initial=initial,
+                     last_time=self.last_time, od=self.od, last_od=self.last_od, k_estimate=self.k_estimate,
+                     last_k=self.last_k, last_output=self.last_output, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    def load(self, from_dir='controller_history', filename='controller_bank.npz'):
+        path = os.path.join(from_dir, filename)
+        if not os.path.isfile(path):
+            raise ValueError('No controller bank save found at ' + path)
+        with np.load(path) as saved:
+            if [view.name for view in self.views] != saved['names'].tolist():
+                raise ValueError('Controller bank save at ' + path + ' is for different controllers')
+            for attr in ('last_time', 'od', 'last_od', 'k_estimate', 'last_k', 'last_output'):
+                getattr(self, attr)[:] = saved[attr]
+            initial = saved['initial']
+            history = saved['history'] if 'history' in saved.files else None
+            if 'num_spilled' in saved.files:
+                num_spilled = int(saved['num_spilled'])
+            elif 'num_dropped' in saved.files: # older checkpoints held the rows still in memory
+                num_spilled = int(saved['num_dropped'])
+            else: # or didn't say how many had been spilled
+                num_spilled = None
+        self.history = StateHistory(self.history.window, self.history.spill_path, row_shape=(self.num_ctrlrs,))
+        if num_spilled is None:
+            num_spilled = len(self.history.read_spill())
+        # rows spilled after the checkpoint are dropped: the controllers' state is from the checkpoint
+        self.history.resume_spill(num_spilled)
+        if history is not None:
+            for row in np.swapaxes(history, 0, 1):
+                self.history.append(row)
+        for view in self.views:
+            view._base_history = StateHistory()
+            view._base_history.append(initial[:, view.idx])
+            view._history_start = 0
+        self.ever_updated[:] = False
+        self._open_row = False
+
+    @property
+    def output_limits(self):
+        return self.min_output, self.max_output
+
+    @output_limits.setter
+    def output_limits(self, limits):
+        self.min_output[:], self.max_output[:] = limits
+
+    @property
+    def k_limits(self):
+        return self.min_k, self.max_k
+
+    @k_limits.setter
+    def k_limits(self, limits):
+        self.min_k[:], self.max_k[:] = limits
+
+    def step(self, delta_time=None, od_meas=None, last_transfer_vol_frac=None, idxs=None, same_row=False):
+        # same update as ParamEstTurbCtrlr.step for every controller in idxs (default all) at once.
+        # od_meas and last_transfer_vol_frac may be arrays over idxs; nan entries mean "not given".
+        # same_row: record into the last history row if it came from a same_row step and none of idxs are in
+        # it yet, so stepping controllers one at a time (as views do) takes a row per round, not per controller
+        if idxs is None:
+            idxs = np.arange(self.num_ctrlrs)
+        else:
+            idxs = np.asarray(idxs, dtype=int)
+        prior_time = self.last_time[idxs]
+        if delta_time is None: # use real time
+            update_time = np.full(len(idxs), time.time())
+        else:
+            update_time = prior_time + delta_time
+        delta_time = update_time - prior_time
+        prior_od = self.last_od[idxs]
+        prior_k = self.last_k[idxs]
+        prior_out = self.last_output[idxs]
+        if last_transfer_vol_frac is not None:
+            override = np.broadcast_to(np.asarray(last_transfer_vol_frac, dtype=float), prior_out.shape)
+            prior_out = np.where(np.isnan(override), prior_out, override)
+        od = self.od[idxs]
+        if od_meas is not None:
+            od_meas = np.broadcast_to(np.asarray(od_meas, dtype=float), od.shape)
+            od = np.where(np.isnan(od_meas), od, od_meas)
+        updated = self.ever_updated[idxs] # only sensible to infer k after more than one point
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inferred_k = np.clip(np.log((prior_out + 1)*od/prior_od)/delta_time*3600,
+                                 self.min_k[idxs], self.max_k[idxs])
+            # an undefined inference (e.g. od read as <= 0) goes to max k, as min()/max() in infer_k do with nan
+            inferred_k = np.where(np.isnan(inferred_k), self.max_k[idxs], inferred_k)
+            s = self.k_smoothing[idxs]
+            k_estimate = np.where(updated, prior_k*(1-s) + inferred_k*s, prior_k)
+            # try to close a fraction of the distance to the correct volume per iteration
+            s = self.approach_frac[idxs]
+            transfer_vol_frac = np.where(updated, od*np.exp(delta_time/3600*k_estimate)
+                        /(self.setpoint[idxs]*s + prior_od*(1-s)) - 1, prior_out)
+        # limit output
+        transfer_vol_frac = np.minimum(self.max_output[idxs], np.maximum(self.min_output[idxs], transfer_vol_frac))
+        self.od[idxs] = od
+        self.k_estimate[idxs] = k_estimate
+        self.last_time[idxs] = update_time
+        self.last_od[idxs] = od
+        self.last_k[idxs] = k_estimate
+        self.last_output[idxs] = transfer_vol_frac
+        self.ever_updated[idxs] = True
+        if same_row and self._open_row and np.isnan(self.history.rows(len(self.history) - 1)[0, 0, idxs]).all():
+            self.history.rows(len(self.history) - 1)[:, 0, idxs] = (update_time, od, delta_time, transfer_vol_frac,
+                                                                    k_estimate)
+        else:
+            row = np.full((len(StateHistory.keys), self.num_ctrlrs), np.nan)
+            row[:, idxs] = update_time, od, delta_time, transfer_vol_frac, k_estimate
+            self.history.append(row)
+            self._open_row = same_row
+        logged = self.logged[idxs]
+        if logged.any():
+            states = np.array((update_time, od, delta_time, transfer_vol_frac, k_estimate))[:, logged]
+            for idx, state in zip(idxs[logged], states.T):
+                self.views[idx]._log_state(dict(zip(StateHistory.keys, state)))
+        return transfer_vol_frac
+
+    def __call__(self, *args, **kwargs):
+        return self.step(None, *args, **kwargs) # default to real time
+
+    def column_history(self, idx, start_row=0):
+        # (len(StateHistory.keys), num_steps) array of one controller's recorded states
+        cols = self.history.rows(start_row)[:, :, idx]
+        stepped = ~np.isnan(cols[0])
+        return cols if stepped.all() else cols[:, stepped]
+
+
+class ParamEstTurbCtrlrView(TurbController): # one well of a ParamEstTurbCtrlrBank behind the TurbController API
+    def __init__(self, bank, idx):
+        self.bank = bank
+        self.idx = idx
+        self.name = str(bank.name_offset + idx)
+        self.default_k = bank.default_k
+        self._base_history = StateHistory()
+        self._base_history.append({'update_time': bank.last_time[idx], 'od': bank.last_od[idx],
+                                   'k_estimate': bank.last_k[idx]})
+        self._history_start = len(bank.history)
+        self.log_dir = None
+
+    def enable_log(self, save_dir='controller_history', compact_every=96):
+        # the bank logs this controller's state whenever it's stepped, through the view or the bank
+        super().enable_log(save_dir, compact_every)
+        self.bank.logged[self.idx] = True
+
+    def _bank_attr(name):
+        def get(self):
+            return getattr(self.bank, name)[self.idx]
+        def set(self, value):
+            getattr(self.bank, name)[self.idx] = value
+        return property(get, set)
+
+    setpoint = _bank_attr('setpoint')
+    od = _bank_attr('od')
+    k_estimate = _bank_attr('k_estimate')
+    ever_updated = _bank_attr('ever_updated')
+    k_smoothing = _bank_attr('k_smoothing')
+    approach_frac = _bank_attr('approach_frac')
+    del _bank_attr
+
+    @property
+    def output_limits(self):
+        return self.bank.min_output[self.idx], self.bank.max_output[self.idx]
+
+    @output_limits.setter
+    def output_limits(self, limits):
+        self.bank.min_output[self.idx], self.bank.max_output[self.idx] = limits
+
+    @property
+    def k_limits(self):
+        return self.bank.min_k[self.idx], self.bank.max_k[self.idx]
+
+    @k_limits.setter
+    def k_limits(self, limits):
+        self.bank.min_k[self.idx], self.bank.max_k[self.idx] = limits
+
+    @property
+    def state_history(self):
+        return StateHistory.from_rows(np.concatenate((self._base_history.rows(),
+                                      self.bank.column_history(self.idx, self._history_start)), axis=1))
+
+    @state_history.setter
+    def state_history(self, state_history): # e.g. from load(); the last state becomes the bank's current state
+        b, i = self.bank, self.idx
+        last_state = state_history[-1]
+        b.last_time[i] = last_state['update_time']
+        b.od[i] = b.last_od[i] = last_state.get('od', b.od[i])
+        b.k_estimate[i] = b.last_k[i] = last_state.get('k_estimate', self.default_k)
+        b.last_output[i] = last_state.get('output', 0)
+        self._base_history = StateHistory()
+        self._base_history.extend(state_history)
+        self._history_start = len(b.history)
+        b._open_row = False # later steps of this controller must land at or after _history_start
+
+    @property
+    def state(self):
+        steps = self.bank.column_history(self.idx, self._history_start)
+        if not steps.shape[1]:
+            return self._base_history[-1]
+        return StateHistory.from_rows(steps[:, -1:])[-1]
+
+    def history(self):
+        return self.state_history[1:]
+
+    def scrape_history(self, key, fill_value = None):
+        col = self.bank.column_history(self.idx, self._history_start)[StateHistory.keys.index(key)]
+        if len(self._base_history) > 1: # loaded history precedes what the bank has recorded
+            col = np.concatenate((self._base_history.column(key, start=1), col))
+        if fill_value is None:
+            return col
+        return np.where(np.isnan(col), fill_value, col)
+
+    def step(self, delta_time=None, od_meas=None, last_transfer_vol_frac=None):
+        od_meas = np.nan if od_meas is None else od_meas
+        last_transfer_vol_frac = np.nan if last_transfer_vol_frac is None else last_transfer_vol_frac
+        return float(self.bank.step(delta_time, od_meas, last_transfer_vol_frac, idxs=[self.idx], same_row=True)[0])
+
+    def _last_time(self):
+        return self.bank.last_time[self.idx]
+
+    def last_known_od(self):
+        return self.bank.last_od[self.idx]
+
+    def last_known_output(self):
+        return self.bank.last_output[self.idx]
+
+    def last_known_k(self):
+        return self.bank.last_k[self.idx]
+
+    def set_od(self, od):
+        self.od = od
+
+if __name__ == '__main__':
+    pass
+
@@ -0,0 +1,178 @@
+#!python3
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+method_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if method_path not in sys.path:
+    sys.path.append(method_path)
+
+# Runs robot_method's cycle (run_cycle, with the real scheduling, control, service planning and measurement
+# writing) against sim_instruments on a virtual clock, and reports robot time per cycle, per plate and per
+# stage, the CPU time Python spent per cycle, and how many plates would fit in cycle_time. Results are
+# written as JSON; --compare=<earlier results .json> flags metrics that got worse by more than --tolerance.
+#
+#   python bench_cycle.py [--cycles=3] [--speedup=200] [--seed=0] [--service96] [--out=<file>.json]
+#                         [--compare=<baseline>.json] [--tolerance=.1] [--min-delta=1]
+#
+# Robot time is virtual, so keep --speedup low enough that Python's own overhead (which the virtual clock
+# also scales) stays small next to instrument latencies; cpu_seconds_per_cycle is in real seconds.
+
+def arg_value(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--' + name + '='):
+            return type(default)(arg.split('=', 1)[1])
+    return default
+
+num_cycles = arg_value('cycles', 3)
+speedup = arg_value('speedup', 200.0)
+seed = arg_value('seed', 0)
+service96 = '--service96' in sys.argv
+out_path = os.path.abspath(arg_value('out', 'cycle_bench_' + time.strftime('%y%m%d_%H%M') + '.json'))
+compare_path = arg_value('compare', '')
+if compare_path:
+    compare_path = os.path.abspath(compare_path)
+tolerance = arg_value('tolerance', .1)
+min_delta = arg_value('min-delta', 1.0) # robot seconds; smaller changes are noise
+manifest_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'controller_manifest.csv')
+
+stages = {'load': 'plate_moves', 'unload': 'plate_moves', 'read': 'read', 'record': 'record',
+          'control': 'control', 'service': 'service'}
+higher_is_better = ('max_plates',)
+noise_floors = {'cpu_seconds_per_cycle': .01, 'max_plates': 0} # the rest are robot seconds, floor min_delta
+
+def stage_and_plate(task_name, num_plates):
+    if task_name == 'service_prev_cycle': # the previous cycle's last plate
+        return 'service', num_plates - 1
+    prefix, plate_no = task_name.rsplit('_', 1)
+    return stages[prefix], int(plate_no)
+
+def cycle_result(tasks, seconds, cpu_seconds, num_plates):
+    # a plate's time runs from its first task starting to its last ending, within this cycle
+    stage_seconds = dict.fromkeys(stages.values(), 0.0)
+    plate_spans = {}
+    for task in tasks:
+        stage, plate_no = stage_and_plate(task.name, num_plates)
+        stage_seconds[stage] += task.end_time - task.start_time
+        if task.name != 'service_prev_cycle':
+            start, end = plate_spans.get(plate_no, (task.start_time, task.end_time))
+            plate_spans[plate_no] = min(start, task.start_time), max(end, task.end_time)
+    return {'seconds': seconds, 'cpu_seconds': cpu_seconds,
+            'stage_seconds_per_plate': {stage: total/num_plates for stage, total in stage_seconds.items()},
+            'plate_seconds': {str(plate_no): end - start for plate_no, (start, end) in sorted(plate_spans.items())}}
+
+def mean(vals):
+    vals = list(vals)
+    return sum(vals)/len(vals)
+
+def summarize(cycles, num_plates, cycle_time):
+    # the first cycle has no carried-over service, so steady state comes from the rest when there are any
+    steady = cycles[1:] or cycles
+    plate_period = mean(cycle['seconds'] for cycle in steady)/num_plates
+    return {'cycle_seconds': mean(cycle['seconds'] for cycle in steady),
+            'cycle_seconds_max': max(cycle['seconds'] for cycle in steady),
+            'cpu_seconds_per_cycle': mean(cycle['cpu_seconds'] for cycle in cycles),
+            'plate_period_seconds': plate_period,
+            'max_plates': int(cycle_time//plate_period),
+            'stage_seconds_per_plate': {stage: mean(cycle['stage_seconds_per_plate'][stage] for cycle in steady)
+                                        for stage in steady[0]['stage_seconds_per_plate']},
+            'plate_seconds': {plate_no: mean(cycle['plate_seconds'][plate_no] for cycle in steady)
+                              for plate_no in steady[0]['plate_seconds']}}
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=method_path,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(work_dir):
+    # robot_method loads its manifest and controller history from the working directory when imported, so
+    # it gets a scratch one with the stock manifest and starts from fresh controllers
+    os.makedirs(os.path.join(work_dir, 'method_local'))
+    shutil.copy(manifest_path, os.path.join(work_dir, 'method_local', 'controller_manifest.csv'))
+    os.chdir(work_dir)
+    sys.argv = ['robot_method.py', '--reset'] + (['--service96'] if service96 else [])
+    import robot_method
+    from pace_util import LayoutManager, LAYFILE, command_metrics
+    from meas_db import BackgroundMeasurementWriter
+    from telemetry import TelemetryWriter
+    from cycle_scheduler import ResourceScheduler
+    from sim_instruments import sim_instruments
+
+    clock, ham_int, reader_int, pump_int = sim_instruments(speedup=speedup, seed=seed)
+    reader_int.data_dir = os.path.join(work_dir, 'sim_reader_data')
+    robot_method.sys_state.instruments = ham_int, reader_int, pump_int
+    robot_method.sys_state.clock = command_metrics.clock = clock.time
+    robot_method.assign_labware(LayoutManager(LAYFILE))
+    robot_method.meas_db = BackgroundMeasurementWriter(os.path.join(work_dir, 'bench.db'),
+                                                       os.path.join(work_dir, 'bench.db.spool'))
+    robot_method.telemetry = TelemetryWriter(os.path.join(work_dir, 'bench.turbtel'))
+    labware = robot_method.plates, robot_method.tip_boxes, robot_method.media_sources
+    scheduler = ResourceScheduler(robot_method.instrument_resources, clock=clock.time)
+    cycles = []
+    carried_service = None
+    for cycle_no in range(num_cycles):
+        start_time, start_cpu = clock.time(), time.process_time()
+        carried_service = robot_method.run_cycle(scheduler, labware, robot_method.reader_protocols, carried_service)
+        cycles.append(cycle_result(scheduler.last_run, clock.time() - start_time, time.process_time() - start_cpu,
+                                   robot_method.num_plates))
+        print('cycle', cycle_no, 'took', round(cycles[-1]['seconds']), 'robot seconds,',
+              round(cycles[-1]['cpu_seconds'], 3), 'CPU seconds')
+    robot_method.meas_db.close()
+    return {'config': {'num_plates': robot_method.num_plates, 'cycle_time': robot_method.cycle_time,
+                       'cycles': num_cycles, 'speedup': speedup, 'seed': seed, 'service96': service96,
+                       'revision': git_revision(), 'python': sys.version.split()[0],
+                       'run_at': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'summary': summarize(cycles, robot_method.num_plates, robot_method.cycle_time),
+            'utilization': scheduler.utilization(),
+            'command_latency': command_metrics.snapshot()['commands'],
+            'cycles': cycles}
+
+def flat_metrics(summary, prefix=''):
+    metrics = {}
+    for key, val in summary.items():
+        if isinstance(val, dict):
+            metrics.update(flat_metrics(val, prefix + key + '.'))
+        else:
+            metrics[prefix + key] = val
+    return metrics
+
+def compare(baseline, results):
+    '''Metrics that got worse than the baseline by more than tolerance, as {name: (baseline, new)}'''
+    old_metrics, new_metrics = flat_metrics(baseline['summary']), flat_metrics(results['summary'])
+    regressions = {}
+    for name in sorted(set(old_metrics) & set(new_metrics)):
+        old, new = old_metrics[name], new_metrics[name]
+        if name in higher_is_better:
+            old, new = -old, -new
+        if new > old + abs(old)*tolerance and new - old > noise_floors.get(name, min_delta):
+            regressions[name] = old_metrics[name], new_metrics[name]
+    return regressions
+
+if __name__ == '__main__':
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='cycle_bench_') as work_dir:
+        try:
+            results = run_benchmark(work_dir)
+        finally:
+            os.chdir(start_dir)
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results['summary'], indent=2))
+    print('results written to', out_path)
+    if compare_path:
+        with open(compare_path) as f:
+            baseline = json.load(f)
+        setup_keys = ('num_plates', 'cycle_time', 'cycles', 'speedup', 'seed', 'service96')
+        if any(baseline['config'].get(key) != results['config'][key] for key in setup_keys):
+            print('warning: baseline was run with a different configuration', baseline['config'])
+        regressions = compare(baseline, results)
+        for name, (old, new) in regressions.items():
+            print('REGRESSION', name, round(old, 3), '->', round(new, 3))
+        if regressions:
+            exit(1)
+        print('no regressions beyond', tolerance, 'against', compare_path)
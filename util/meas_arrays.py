@@ -0,0 +1,221 @@
+import os
+import numpy as np
+from datetime import datetime
+
+# Loading the measurements table as numpy arrays for the plotting utilities: one query for all the data
+# types wanted, instead of one per well, and readings pivoted into one row per lagoon.
+
+wells_per_plate = 96
+
+def table_columns(db_conn):
+    return [row[1] for row in db_conn.execute('PRAGMA table_info(measurements)')]
+
+def epochs_from_filenames(filenames):
+    # reader data files end in _yymmdd_HHMM.<ext>; every well of a plate read shares a file, so each distinct
+    # stamp is parsed once and spread back out. nan where the name doesn't parse (e.g. dummy reads)
+    stamps = np.array([f[-15:-4] if f else '' for f in filenames])
+    unique_stamps, inverse = np.unique(stamps, return_inverse=True)
+    unique_epochs = np.full(len(unique_stamps), np.nan)
+    for i, stamp in enumerate(unique_stamps):
+        try:
+            unique_epochs[i] = datetime.strptime(stamp, '%y%m%d_%H%M').timestamp()
+        except ValueError:
+            pass
+    return unique_epochs[inverse]
+
+def load_measurements(db_conn, data_type, since=None, after_rowid=0):
+    '''
+    Every reading of data_type, leaving out dummy reads, in a single query, as numpy arrays
+    {'rowid', 'lagoon', 'timestamp' (seconds since the epoch), 'reading'} ordered by time, then lagoon.
+    since drops readings taken before that epoch time; after_rowid only returns rows added after it.
+    Databases with the old untyped table get their timestamps from the data file names.
+    '''
+    return load_measurements_by_type(db_conn, (data_type,), since, after_rowid)[data_type]
+
+def load_measurements_by_type(db_conn, data_types, since=None, after_rowid=0):
+    '''
+    {data_type: load_measurements arrays} for all of data_types, fetched in one query and split apart here,
+    so a script plotting several types scans the table once.
+    '''
+    typed = 'plate_number' in table_columns(db_conn)
+    query = ('SELECT rowid, lagoon_number, ' + ('timestamp' if typed else 'filename') + ', reading, data_type'
+             ' FROM measurements WHERE data_type IN (' + ','.join('?'*len(data_types)) + ')'
+             ' AND rowid>? AND filename NOT LIKE ?')
+    params = list(data_types) + [after_rowid, '%dummy%']
+    if typed and since is not None:
+        query += ' AND timestamp>=?'
+        params.append(since)
+    rows = db_conn.execute(query, params).fetchall()
+    if not rows:
+        return {data_type: {'rowid': np.zeros(0, dtype=np.int64), 'lagoon': np.zeros(0, dtype=np.int64),
+                            'timestamp': np.zeros(0), 'reading': np.zeros(0)} for data_type in data_types}
+    rowids, lagoons, times, readings, types = zip(*rows)
+    data = {'rowid': np.array(rowids, dtype=np.int64), 'lagoon': np.array(lagoons, dtype=float).astype(np.int64),
+            'timestamp': np.array(times, dtype=float) if typed else epochs_from_filenames(times),
+            'reading': np.array(readings, dtype=float)}
+    types = np.array(types)
+    keep = ~np.isnan(data['timestamp'])
+    if since is not None:
+        keep &= data['timestamp'] >= since
+    by_type = {}
+    for data_type in data_types:
+        of_type = np.flatnonzero(keep & (types == data_type))
+        order = of_type[np.lexsort((data['lagoon'][of_type], data['timestamp'][of_type]))]
+        by_type[data_type] = {key: vals[order] for key, vals in data.items()}
+    return by_type
+
+def sorted_by_time(data):
+    # ordered by time, then lagoon, as load_measurements returns them; rows added in a later update can be
+    # older than some already cached, but usually aren't, and then nothing is sorted
+    time_step, lagoon_step = np.diff(data['timestamp']), np.diff(data['lagoon'])
+    if ((time_step > 0) | (time_step == 0) & (lagoon_step >= 0)).all():
+        return data
+    order = np.lexsort((data['lagoon'], data['timestamp']))
+    return {key: vals[order] for key, vals in data.items()}
+
+cache_dtype = np.dtype([('rowid', '<i8'), ('lagoon', '<i8'), ('timestamp', '<f8'), ('reading', '<f8')])
+
+class MeasurementCache:
+    '''
+    The load_measurements arrays for one data type, kept as fixed-size binary records in a file next to
+    the database, so that a rerun only queries the rows added since the last one, i.e. with a rowid above
+    the cache's high-water mark, and appends just those. since (rounded to whole seconds) is part of the
+    file name, so scripts plotting from different start times keep separate caches. The cache is thrown
+    away and rebuilt if the database no longer has the row the mark points at with the same reading (e.g.
+    it was replaced or migrated); a record torn by a crash mid-append is ignored.
+    '''
+    def __init__(self, db_path, data_type, since=None):
+        self.since = None if since is None else round(since)
+        self.path = (db_path + '.' + data_type + ('' if self.since is None else '.since' + str(self.since))
+                     + '.cache')
+        self.data_type = data_type
+
+    def load(self, db_conn):
+        if not os.path.isfile(self.path):
+            return None
+        records = np.fromfile(self.path, dtype=cache_dtype) # whole records only
+        if len(records):
+            last = np.argmax(records['rowid'])
+            row = db_conn.execute('SELECT reading FROM measurements WHERE rowid=?',
+                                  (int(records['rowid'][last]),)).fetchone()
+            if row is None or row[0] != records['reading'][last]:
+                return None
+        return sorted_by_time({key: records[key] for key in cache_dtype.names})
+
+    @staticmethod
+    def record_bytes(data):
+        records = np.zeros(len(data['rowid']), dtype=cache_dtype)
+        for key in cache_dtype.names:
+            records[key] = data[key]
+        return records.tobytes()
+
+    def save(self, data):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.record_bytes(data))
+        os.replace(tmp_path, self.path)
+
+    def append(self, data):
+        with open(self.path, 'r+b') as f:
+            f.seek(os.path.getsize(self.path)//cache_dtype.itemsize*cache_dtype.itemsize) # past any torn record
+            f.truncate()
+            f.write(self.record_bytes(data))
+
+    def update(self, db_conn):
+        '''
+        (data, new_lagoons): all readings, as load_measurements returns them, and the lagoons that got
+        new readings since the last update (every lagoon with readings if the cache was rebuilt). Only
+        the new rows are queried and written; the cached ones are read back in full.
+        '''
+        data = self.load(db_conn)
+        if data is None:
+            data = load_measurements(db_conn, self.data_type, since=self.since)
+            self.save(data)
+            return data, np.unique(data['lagoon'])
+        after_rowid = int(data['rowid'].max()) if len(data['rowid']) else 0
+        new_data = load_measurements(db_conn, self.data_type, since=self.since, after_rowid=after_rowid)
+        if len(new_data['rowid']):
+            self.append(new_data)
+            data = sorted_by_time({key: np.concatenate((data[key], new_data[key])) for key in data})
+        return data, np.unique(new_data['lagoon'])
+
+def pivot_reads(lagoons, timestamps, readings, num_lagoons=None):
+    '''
+    (times, values), each (num_lagoons, most reads of any lagoon): row l holds lagoon l's reads in time
+    order, padded with nan. Lagoons on the same plate are read together, so their columns line up.
+    '''
+    if num_lagoons is None:
+        num_lagoons = int(lagoons.max()) + 1 if len(lagoons) else 0
+    order = np.lexsort((timestamps, lagoons))
+    lagoons, timestamps, readings = lagoons[order], timestamps[order], readings[order]
+    counts = np.bincount(lagoons, minlength=num_lagoons)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    read_idx = np.arange(len(lagoons)) - starts[lagoons]
+    times = np.full((num_lagoons, counts.max() if len(counts) else 0), np.nan)
+    values = np.full(times.shape, np.nan)
+    times[lagoons, read_idx] = timestamps
+    values[lagoons, read_idx] = readings
+    return times, values
+
+def num_plates_for(num_lagoons):
+    return -(-num_lagoons//wells_per_plate)
+
+def time_bins(lagoons, timestamps):
+    '''
+    Assign every read to the cycle it was taken in, so reads of different plates in the same cycle line up
+    even though they aren't taken at the same moment. The robot reads each plate once per cycle, all its
+    wells at once, so plate reads are taken in time order and a new cycle starts whenever a plate comes up
+    that was already read in the current one; unlike a fixed time grid, this doesn't alias as the cycle
+    time drifts. Returns (bin index per read, bin times), bin times being the mean time of the reads in
+    each cycle.
+    '''
+    if not len(timestamps):
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    plates = lagoons//wells_per_plate
+    order = np.lexsort((plates, timestamps))
+    new_read = np.ones(len(order), dtype=bool) # first row of each plate read, in time order
+    new_read[1:] = (np.diff(timestamps[order]) != 0) | (np.diff(plates[order]) != 0)
+    read_plates = plates[order][new_read]
+    read_cycles = np.empty(len(read_plates), dtype=np.int64)
+    cycle, read_this_cycle = 0, set()
+    for i, plate in enumerate(read_plates.tolist()): # one step per plate read, not per well
+        if plate in read_this_cycle:
+            cycle, read_this_cycle = cycle + 1, set()
+        read_this_cycle.add(plate)
+        read_cycles[i] = cycle
+    bins = np.empty(len(order), dtype=np.int64)
+    bins[order] = read_cycles[np.cumsum(new_read) - 1]
+    bin_times = np.bincount(bins, weights=timestamps)/np.bincount(bins)
+    return bins, bin_times
+
+def group_stats(groups, bins, values, num_groups, num_bins, quantiles=(.25, .5, .75)):
+    '''
+    Per (group, bin) statistics of values, ignoring nans, computed for all groups at once. groups and bins
+    give each value's group (negative for values not in any group) and time bin. Returns a dict of
+    (num_groups, num_bins) arrays 'count', 'mean', 'std' and (len(quantiles), num_groups, num_bins)
+    'quantiles', nan where a cell has no values. Quantiles interpolate linearly, as np.nanquantile does.
+    '''
+    keep = (groups >= 0) & ~np.isnan(values)
+    keys = groups[keep]*num_bins + bins[keep]
+    values = values[keep]
+    size = num_groups*num_bins
+    counts = np.bincount(keys, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(keys, weights=values, minlength=size)/counts
+        deviations = values - means[keys]
+        stds = np.sqrt(np.bincount(keys, weights=deviations*deviations, minlength=size)/counts)
+    # quantiles: sort by cell then value, and interpolate within each cell's run of sorted values
+    order = np.lexsort((values, keys))
+    sorted_values = values[order]
+    starts = np.cumsum(counts) - counts
+    filled = counts > 0
+    quantile_vals = np.full((len(quantiles), size), np.nan)
+    for i, q in enumerate(quantiles):
+        pos = starts[filled] + q*(counts[filled] - 1)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, starts[filled] + counts[filled] - 1)
+        frac = pos - lo
+        quantile_vals[i, filled] = sorted_values[lo]*(1 - frac) + sorted_values[hi]*frac
+    shape = (num_groups, num_bins)
+    return {'count': counts.reshape(shape), 'mean': means.reshape(shape), 'std': stds.reshape(shape),
+            'quantiles': quantile_vals.reshape((len(quantiles),) + shape)}
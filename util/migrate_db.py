@@ -0,0 +1,40 @@
+import sqlite3
+import sys
+import os
+import time
+
+meas_db_path = os.path.abspath('..')
+if meas_db_path not in sys.path:
+    sys.path.append(meas_db_path)
+
+from meas_db import migrate_meas_table, create_meas_indexes
+
+# Converts measurement databases from the old untyped measurements table to the typed, indexed one, in place.
+# The robot method does this itself on startup; running this first just keeps it from taking time then.
+db_dir = os.path.join('..', 'method_local')
+
+if len(sys.argv) > 2:
+    print('Only (optional) argument is the name of the database you want to migrate')
+    exit()
+dbs = [filename for filename in os.listdir(db_dir) if filename.split('.')[-1] == 'db']
+if len(sys.argv) == 2:
+    db_name = sys.argv[1]
+    if db_name not in dbs:
+        print('database does not exist in ' + db_dir)
+        exit()
+    dbs = [db_name]
+
+for db_name in dbs:
+    conn = sqlite3.connect(os.path.join(db_dir, db_name))
+    cols = [row[1] for row in conn.execute('PRAGMA table_info(measurements)')]
+    if not cols or 'plate_number' in cols:
+        print(db_name + ': nothing to migrate')
+        create_meas_indexes(conn)
+        conn.commit()
+        conn.close()
+        continue
+    start_time = time.time()
+    num_rows = migrate_meas_table(conn, progress=lambda n: print(db_name + ':', n, 'rows', end='\r'))
+    print(db_name + ': migrated', num_rows, 'rows in', round(time.time() - start_time, 1), 'seconds')
+    conn.execute('VACUUM')
+    conn.close()
@@ -0,0 +1,81 @@
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+# Draws every well of a plate on one set of axes: each well gets a panel at its position on the plate
+# (A1 top left), and all 96 time series go into a single LineCollection, so a plate is a handful of
+# artists instead of 96 subplots with their own axes, ticks and labels.
+
+rows, cols = 8, 12
+panel_width, panel_height = .9, .8 # fraction of a grid cell, leaving a gap between panels
+
+def panel_segments(hours, values, ylim, max_hours=None):
+    '''
+    Line segments for one plate's wells, in grid coordinates: hours and values are (wells, reads) arrays
+    (nan-padded), well i drawn in the panel for row i%8, column i//8. Values are clipped to ylim.
+    '''
+    num_wells = len(values)
+    well_idxs = np.arange(num_wells)
+    if max_hours is None:
+        max_hours = np.nanmax(hours) if np.isfinite(hours).any() else 1.0
+    x = (well_idxs//rows)[:, None] + hours/max(max_hours, 1e-9)*panel_width
+    y_lo, y_hi = ylim
+    scaled = (np.clip(values, y_lo, y_hi) - y_lo)/(y_hi - y_lo)
+    y = (rows - 1 - well_idxs % rows)[:, None] + scaled*panel_height
+    points = np.stack((x, y), axis=-1)
+    finite = np.isfinite(x) & np.isfinite(y)
+    return [points[i][finite[i]] for i in range(num_wells)]
+
+def draw_plate(ax, hours, values, ylim, title='', color='b', max_hours=None, linewidth=.8):
+    ax.add_collection(LineCollection(panel_segments(hours, values, ylim, max_hours), colors=color, linewidths=linewidth))
+    # panel outlines as one more collection
+    corners = [[(c, r), (c + panel_width, r), (c + panel_width, r + panel_height), (c, r + panel_height), (c, r)]
+               for r in range(rows) for c in range(cols)]
+    ax.add_collection(LineCollection(corners, colors='.8', linewidths=.5))
+    for r in range(rows):
+        ax.text(-.15, rows - 1 - r + panel_height/2, 'ABCDEFGH'[r], ha='center', va='center', fontsize=8)
+    for c in range(cols):
+        ax.text(c + panel_width/2, rows - .05, str(c + 1), ha='center', va='bottom', fontsize=8)
+    ax.set_xlim(-.3, cols)
+    ax.set_ylim(-.1, rows + .2)
+    ax.set_axis_off()
+    ax.set_title(title, fontsize=10)
+
+def plate_title(name, ylim, max_hours):
+    return name + '  (y ' + str(ylim[0]) + ' to ' + str(ylim[1]) + ', x 0 to ' + str(round(max_hours, 1)) + ' h)'
+
+def render_plates(hours, values, ylim, path_for_plate, tiles=False, plates=None, wells_per_plate=96, dpi=100):
+    '''
+    Render (lagoons, reads) arrays of hours and values as plate grids. With tiles, each plate is saved to
+    path_for_plate(plate_no); otherwise all plates are stacked in one figure saved to path_for_plate(None).
+    plates limits which plates are redrawn: with tiles only theirs are, otherwise the figure is redrawn
+    only if plates isn't empty. All plates share the time scale of the latest read, as of when they were
+    drawn. Returns the paths written.
+    '''
+    num_plates = -(-len(values)//wells_per_plate)
+    max_hours = np.nanmax(hours) if np.isfinite(hours).any() else 1.0
+    plate_slices = [slice(p*wells_per_plate, (p + 1)*wells_per_plate) for p in range(num_plates)]
+    paths = []
+    if tiles:
+        for plate_no, plate_slice in enumerate(plate_slices):
+            if plates is not None and plate_no not in plates:
+                continue
+            fig, ax = plt.subplots(figsize=(12, 8.5))
+            draw_plate(ax, hours[plate_slice], values[plate_slice], ylim,
+                       plate_title('plate ' + str(plate_no), ylim, max_hours), max_hours=max_hours)
+            paths.append(path_for_plate(plate_no))
+            fig.savefig(paths[-1], dpi=dpi, bbox_inches='tight')
+            plt.close(fig)
+        return paths
+    if plates is not None and not len(plates):
+        return paths
+    fig, axs = plt.subplots(num_plates, 1, figsize=(12, 8.5*num_plates), squeeze=False)
+    for plate_no, (plate_slice, ax) in enumerate(zip(plate_slices, axs[:, 0])):
+        draw_plate(ax, hours[plate_slice], values[plate_slice], ylim,
+                   plate_title('plate ' + str(plate_no), ylim, max_hours), max_hours=max_hours)
+    paths.append(path_for_plate(None))
+    fig.savefig(paths[-1], dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return paths
@@ -1,20 +1,24 @@
 import sqlite3
-import matplotlib.pyplot as plt
 from datetime import datetime
-import pdb
 import sys
 import os
 import numpy as np
+from meas_arrays import load_measurements, pivot_reads, MeasurementCache, wells_per_plate, num_plates_for
+from plate_grid import render_plates
 
-number_of_turb = 96
 db_dir = os.path.join('..', 'method_local')
+min_time = datetime(2019, 7, 10, 11, 0).timestamp() # ignore anything older
 
-if len(sys.argv) > 2:
-    print('Only (optional) argument is the name of the database you want to plot from')
+tiles = '--tiles' in sys.argv # one image per plate instead of all plates in one
+# only fetch rows added since the last run (cached next to the database) and only redraw plates with new data
+incremental = '--incremental' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg not in ('--tiles', '--incremental')]
+if len(args) > 1:
+    print('Only (optional) argument is the name of the database you want to plot from, plus --tiles and --incremental')
     exit()
 dbs = [filename for filename in os.listdir(db_dir) if filename.split('.')[-1] == 'db']
-if len(sys.argv) == 2:
-    db_name = sys.argv[1]
+if len(args) == 1:
+    db_name = args[0]
     if db_name not in dbs:
         print('database does not exist in ' + db_dir)
         exit()
@@ -24,60 +28,31 @@ else:
         exit()
     db_name, = dbs
 
-conn = sqlite3.connect(os.path.join(db_dir, db_name))
-c = conn.cursor()
+db_path = os.path.join(db_dir, db_name)
+conn = sqlite3.connect(db_path)
 
 for type in ['abs']:
-    scale = 2
-    table = []
-    fig1 = plt.figure(figsize=(24*scale, 16*scale))
-    subplot = 0
-    for column in ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']:
-        for row in range(1,13):
-            subplot = subplot + 1
-            well = column + str(row)
-            
-            # set up plot
-            ax = fig1.add_subplot(8, number_of_turb/8, subplot)
-            ax.set_title("Lagoon" + well, x=0.5, y=0.8)
-
-            n = (well, type, )
-            c.execute('SELECT filename, well, reading FROM measurements WHERE well=? AND data_type=?', n)
-   
-            x = c.fetchall()
-            print(len(x), "entries fetched")
-            #pdb.set_trace()
-            vals = [(datetime.strptime(f[-15:-4], '%y%m%d_%H%M'), w, v) for (f, w, v) in x if 'dummy' not in f]
-            #pdb.set_trace()
-            vals = [(t, w, v) for t, w, v in vals if t > datetime(2019, 7, 10, 11, 0)] 
-    
-            #assert w == well, "Recorded lagoon " + str(w) + " not equal to expected lagoon well" + str(well)
-
-            times = [t for (t, _, _) in vals]
-            ys = [5.40541*data_val - 0.193514 for (j, _, data_val) in vals]
-            plt.plot(times, ys, 'b.-')
-    
-            if type == 'abs':
-                plt.ylim(0.0, 2.5)
-            else:
-                plt.ylim(450, 4000.0)
-                #plt.ylim(0, 500.0)
-        
-            # decrease number of plotted X axis labels
-            # make there be fewer labels so that you can read them
-            
-            deltas = [t - times[0] for t in times]
-            labels = [int(d.seconds/60/60 + d.days*24) for d in deltas]
-            labels_sparse = [labels[x] if x % 6 == 0 else '' for x in range(len(labels))]
-            plt.xticks(times, labels_sparse)
-            locs, labels = plt.xticks()
-            if ys:
-                table.append(ys)
-    table = np.array(table)
-    fig1.tight_layout()
-    plt.savefig(os.path.join(db_dir, 'plot_' + type + ".png"), dpi = 200)
+    if incremental:
+        data, new_lagoons = MeasurementCache(db_path, type, since=min_time).update(conn)
+        print(len(data['reading']), "entries,", len(new_lagoons), "lagoons with new readings")
+    else:
+        data = load_measurements(conn, type, since=min_time) # every well of every plate in one query
+        print(len(data['reading']), "entries fetched")
+    times, readings = pivot_reads(data['lagoon'], data['timestamp'], data['reading'])
+    ys = 5.40541*readings - 0.193514
+    hours = (times - np.nanmin(times))/3600 if times.size else times
+    ylim = (0.0, 2.5) if type == 'abs' else (450, 4000.0)
+    def plot_path(plate_no):
+        return os.path.join(db_dir, 'plot_' + type + ('' if plate_no is None else '_plate' + str(plate_no)) + '.png')
+    plates = None
+    if incremental:
+        plates = set((new_lagoons//wells_per_plate).tolist())
+        plates |= {plate_no for plate_no in range(num_plates_for(len(ys))) # and any plot that's gone missing
+                   if not os.path.isfile(plot_path(plate_no if tiles else None))}
+    for path in render_plates(hours, ys, ylim, plot_path, tiles=tiles, plates=plates):
+        print('wrote', path)
     with open('out_' + str(type) + '.csv', 'w+') as f:
-        for row in np.transpose(table):
+        for row in np.transpose(ys):
             f.write(','.join((str(rowel) for rowel in row)) + '\n')
 
-conn.close()
\ No newline at end of file
+conn.close()
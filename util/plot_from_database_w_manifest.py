@@ -9,42 +9,57 @@ import matplotlib.patches as mpatches
 import matplotlib
 import random
 import numpy as np
+from meas_arrays import load_measurements_by_type, time_bins, group_stats, MeasurementCache
 
 number_of_wells = 96
 
-def well_data(well, type):
-    '''Fetches data of type (lum, abs) for a particular well and plots it on the graph'''
-    n = (well, type, )
-    c.execute('SELECT filename, well, reading FROM measurements WHERE well=? AND data_type=?', n)
-
-    x = c.fetchall()
-    print(len(x), "entries fetched")
-    vals = [(datetime.strptime(f[-15:-4], '%y%m%d_%H%M'), w, 5.40541*data_val - 0.193514) for (f, w, data_val) in x if 'dummy' not in f]
-    t_vals = [t for t, w, v in vals] 
-    return [(t, w, v) if v < .7 else (t, w, np.nan) for t, w, v in vals] 
-
-def line_plot_well(well, type, plt, color = 'b', linewidth = 1, linestyle = '.-'):
-    vals = well_data(well, type)
-    plt.plot([j for (j, _, _) in vals], [lum for (j, _, lum) in vals], color = color, linestyle = linestyle, linewidth=linewidth, marker = 'o', markersize = 1.5)
-    
-    # decrease number of plotted X axis labels
-    # make there be fewer labels so that you can read them
-    times = [x for (x, _, _) in vals]
-    deltas = [t - times[0] for t in times]
-    labels = [int(d.seconds/60/60 + d.days*24) for d in deltas]
-    labels_sparse = [labels[x] if x % 6 == 0 else '' for x in range(len(labels))]
-    plt.xticks(times, labels_sparse)
-    locs, labels = plt.xticks()
+def lagoon_for(plate, well):
+    '''Lagoon number of a manifest entry, e.g. plate 'plate1' (or '1', blank for plate 0) and well 'B3'.'''
+    plate_digits = ''.join(ch for ch in plate if ch.isdigit())
+    row, col = 'ABCDEFGH'.index(well[0].upper()), int(well[1:]) - 1
+    return int(plate_digits or 0)*number_of_wells + col*8 + row # lagoons run down the columns, as in Plate96
+
+def type_data(type, data=None):
+    '''
+    Data of type (lum, abs) for every well: calibrated readings, with readings of .7 and up dropped as
+    nan, and the time bin of the cycle each was read in (see meas_arrays.time_bins). data is what
+    load_measurements_by_type fetched for this type, or None to update the --incremental cache instead.
+    Also the lagoons with readings new since the last --incremental run (None when not incremental).
+    '''
+    if data is None:
+        data, new_lagoons = MeasurementCache(db_path, type).update(conn)
+        print(len(data['reading']), "entries,", len(new_lagoons), "lagoons with new readings")
+    else:
+        new_lagoons = None
+        print(len(data['reading']), "entries fetched")
+    vals = 5.40541*data['reading'] - 0.193514
+    vals[vals >= .7] = np.nan
+    bins, bin_times = time_bins(data['lagoon'], data['timestamp'])
+    return data['lagoon'], bins, bin_times, vals, new_lagoons
+
+def write_stats(measurement_type, group_names, hours, stats):
+    # one row per group per cycle, for looking at the numbers behind the plot
+    with open(os.path.join(db_dir, 'manifest_stats_' + measurement_type + '.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['group', 'hours', 'count', 'mean', 'std', 'q05', 'median', 'q95'])
+        for group_no, name in enumerate(group_names):
+            for bin_no, hour in enumerate(hours):
+                if stats['count'][group_no, bin_no]:
+                    writer.writerow([name, hour, stats['count'][group_no, bin_no], stats['mean'][group_no, bin_no],
+                                     stats['std'][group_no, bin_no]] + list(stats['quantiles'][:, group_no, bin_no]))
 
 # automatically find the database file for this 96-robot method
 db_dir = os.path.join('..', 'method_local')
 
-if len(sys.argv) > 2:
-    print('Only (optional) argument is the name of the database you want to plot from')
+# only fetch rows added since the last run (cached next to the database), and don't redraw if there are none
+incremental = '--incremental' in sys.argv
+args = [arg for arg in sys.argv[1:] if arg != '--incremental']
+if len(args) > 1:
+    print('Only (optional) argument is the name of the database you want to plot from, plus --incremental')
     exit()
 dbs = [filename for filename in os.listdir(db_dir) if filename.split('.')[-1] == 'db']
-if len(sys.argv) == 2:
-    db_name = sys.argv[1]
+if len(args) == 1:
+    db_name = args[0]
     if db_name not in dbs:
         print('database does not exist in ' + db_dir)
         exit()
@@ -54,8 +69,8 @@ else:
         exit()
     db_name, = dbs
 
-conn = sqlite3.connect(os.path.join(db_dir, db_name))
-c = conn.cursor()
+db_path = os.path.join(db_dir, db_name)
+conn = sqlite3.connect(db_path)
 
 # read in the manifest file
 # assign colors to the types as they arise
@@ -70,12 +85,16 @@ manifest = {}
 well_phage = {}
 for row in reader:
     (plate, well, type, phage) =  row[:4]
-    
+    lagoon = lagoon_for(plate, well)
+
     if type not in manifest:
-        manifest[type] = [well]
+        manifest[type] = [lagoon]
     else:
-        manifest[type].append(well)
-    well_phage[well] = type
+        manifest[type].append(lagoon)
+    well_phage[lagoon] = type
+group_names = list(manifest)
+if not group_names:
+    print('no entries in Manifest.csv, plotting no groups')
 
 '''
 # 96-plot
@@ -112,39 +131,38 @@ for measurement_type in ['lum', 'abs']:
 '''
 
 # manifest plot
-for measurement_type in ['lum', 'abs']:
+measurement_types = ['lum', 'abs']
+# all types in one query, unless the caches only need the rows added since the last run
+fetched = {} if incremental else load_measurements_by_type(conn, measurement_types)
+for measurement_type in measurement_types:
+    plot_path = os.path.join(db_dir, 'manifest_single_plot_' + measurement_type + ".png")
+    lagoons, bins, bin_times, vals, new_lagoons = type_data(measurement_type, fetched.get(measurement_type))
+    if new_lagoons is not None and not len(new_lagoons) and os.path.isfile(plot_path):
+        print('no new', measurement_type, 'readings, keeping', plot_path)
+        continue
     fig2 = plt.figure()
     
+    # every group's mean, std and quantiles per cycle, computed at once
+    lagoon_group = np.full(max(max(well_phage, default=0), lagoons.max() if len(lagoons) else 0) + 1, -1)
+    for group_no, type in enumerate(group_names):
+        lagoon_group[manifest[type]] = group_no
+    stats = group_stats(lagoon_group[lagoons], bins, vals, len(group_names), len(bin_times), quantiles=(.05, .5, .95))
+    hours = (bin_times - np.nanmin(bin_times))/3600 if len(bin_times) else bin_times
+    write_stats(measurement_type, group_names, hours, stats)
+
     # plot the data one type at a time
-    i = 0
     patches = []
-    for i, (type, wells) in enumerate(manifest.items()):
+    for i, type in enumerate(group_names):
         i = i + 1
-
-        all_type_data = []
-        for well in wells:
-            # aggregate data
-            all_type_data.append(well_data(well, measurement_type))
-            # plot one well at a time
-            ls = 'solid'
-            #line_plot_well(well, measurement_type, plt, color = colors[i%len(colors)], linestyle = ls, linewidth = 1)
         color = colors[i%len(colors)]
         patches.append(mpatches.Patch(color=color, label=type))
 
-        times = [[t for (t, w, v) in data_tups] for data_tups in all_type_data][0]
-        if not times:
+        avgs, stds = stats['mean'][i - 1], stats['std'][i - 1]
+        if np.isnan(avgs).all():
             continue
-        vals = [[v for (t, w, v) in  data_tups] for data_tups in all_type_data]
-        avgs = np.array([np.nanmean(vs) for vs in zip(*vals)])
-        stds = np.array([np.nanstd(vs) for vs in zip(*vals)])
-        print(avgs)
-        plt.plot(times, avgs, color=color, alpha=.8)
-        plt.fill_between(times, avgs + stds, avgs - stds, color=color, alpha=.2, linewidth=0)
-        plt.fill_between(times, avgs + 2*stds, avgs - 2*stds, color=color, alpha=.2, linewidth=0)
-        deltas = [t - times[0] for t in times]
-        labels = [int(d.seconds/60/60 + d.days*24) for d in deltas]
-        labels_sparse = [labels[x] if x % 6 == 0 else '' for x in range(len(labels))]
-        plt.xticks(times, labels_sparse)
+        plt.plot(hours, avgs, color=color, alpha=.8)
+        plt.fill_between(hours, avgs + stds, avgs - stds, color=color, alpha=.2, linewidth=0)
+        plt.fill_between(hours, avgs + 2*stds, avgs - 2*stds, color=color, alpha=.2, linewidth=0)
         # add the legend item
 
     # plot the legend
@@ -164,13 +182,14 @@ for measurement_type in ['lum', 'abs']:
     # adjust limit values to reflect the type of graph
     if measurement_type == 'abs':
         plt.ylim(0.0, 0.7)
-        plt.gca().set_aspect(1/2)
+        plt.gca().set_aspect(1/48) # x in hours
     else:
         #plt.ylim(350.0, 4000.0)
         fig2.get_axes()[0].set_yscale('log')
         plt.autoscale(enable=True, axis='y')
     
     #fig2.tight_layout()
-    plt.savefig(os.path.join(db_dir, 'manifest_single_plot_' + measurement_type + ".png"), dpi = 200, bbox_inches="tight")
+    plt.savefig(plot_path, dpi = 200, bbox_inches="tight")
+    plt.close(fig2)
 
 conn.close()
@@ -0,0 +1,239 @@
+import os
+import sys
+import csv
+import glob
+import time
+import sqlite3
+import importlib
+import numpy as np
+turb_ctrl_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if turb_ctrl_path not in sys.path:
+    sys.path.append(turb_ctrl_path)
+
+from turb_control import StateHistory, TurbController, ParamEstTurbCtrlrBank
+from meas_arrays import load_measurements, pivot_reads, wells_per_plate
+
+'''
+Replay recorded OD readings through a controller offline, to see what it would have asked for on the same
+data. Readings come from one of:
+    --db=<name>         the measurements database in ../method_local (the only one there by default)
+    --histories=<dir>   .turbhistory/.turblog files saved by individual controllers, one per lagoon
+    --bank=<dir>        a controller_bank.npz checkpoint plus its controller_bank.spill
+Controller histories also have the outputs that were commanded at the time, which are reported alongside
+and, unless --own-outputs, fed back to the replayed controller as what was actually done to each culture
+(otherwise it infers growth as if its own outputs had been applied, which they weren't).
+--controller=module.Class picks the controller (default turb_control.ParamEstTurbCtrlrBank): a bank class
+is stepped for all lagoons at once, any other TurbController is made once per lagoon and stepped one read
+at a time. Setpoints come from --manifest (default ../method_local/controller_manifest.csv), lagoons
+marked off or missing from it get --setpoint; output limits are --min-output and --max-output; any
+name=value argument is set on the controller(s), e.g. k_smoothing=.3. Per-lagoon results go to --out
+(default replay.csv), media in uL for a --turb-vol uL lagoon.
+'''
+
+od_calibration = 3.2, -.093 # abs reading to OD, as robot_method.convert_to_ods
+
+def arg_value(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--' + name + '='):
+            return type(default)(arg.split('=', 1)[1])
+    return default
+
+def make_recording(lagoons, times, ods, outputs=None, num_lagoons=None):
+    '''
+    Per-lagoon time series from flat arrays of readings: {'time', 'od', 'output'}, each (num_lagoons, most
+    reads of any lagoon), in time order along each row and nan-padded. output is nan where not recorded.
+    '''
+    lagoons = np.asarray(lagoons, dtype=np.int64)
+    if outputs is None:
+        outputs = np.full(len(lagoons), np.nan)
+    recording = {}
+    for key, values in (('od', ods), ('output', outputs)):
+        recording['time'], recording[key] = pivot_reads(lagoons, np.asarray(times, dtype=float),
+                                                        np.asarray(values, dtype=float), num_lagoons)
+    return recording
+
+def recording_from_db(db_conn, since=None):
+    data = load_measurements(db_conn, 'abs', since=since)
+    slope, intercept = od_calibration
+    return make_recording(data['lagoon'], data['timestamp'], slope*data['reading'] + intercept)
+
+def recording_from_histories(history_dir):
+    # controllers are named by their lagoon number; history states past the initial one are the steps
+    names = {os.path.splitext(os.path.basename(path))[0] for path in
+             glob.glob(os.path.join(history_dir, '*.turbhistory')) + glob.glob(os.path.join(history_dir, '*.turblog'))}
+    columns = {key: [] for key in ('lagoon', 'update_time', 'od', 'output')}
+    for name in sorted(names):
+        if not name.isdigit():
+            continue
+        controller = TurbController()
+        controller.load(history_dir, name + '.turbhistory')
+        stepped = controller.scrape_history('update_time')
+        columns['lagoon'].append(np.full(len(stepped), int(name)))
+        for key in ('update_time', 'od', 'output'):
+            columns[key].append(controller.scrape_history(key))
+    if not columns['lagoon']:
+        raise ValueError('No controller histories found in ' + history_dir)
+    lagoons, times, ods, outputs = (np.concatenate(columns[key]) for key in ('lagoon', 'update_time', 'od', 'output'))
+    valid = ~np.isnan(times) & ~np.isnan(ods)
+    return make_recording(lagoons[valid], times[valid], ods[valid], outputs[valid])
+
+def recording_from_bank(history_dir, filename='controller_bank.npz', spill_filename='controller_bank.spill'):
+    # the rows in the spill file as of the bank checkpoint, then any rows held in the checkpoint itself
+    path = os.path.join(history_dir, filename)
+    if not os.path.isfile(path):
+        raise ValueError('No controller bank save found at ' + path)
+    with np.load(path) as saved:
+        num_ctrlrs = len(saved['names'])
+        history = saved['history'] if 'history' in saved.files else np.empty((len(StateHistory.keys), 0, num_ctrlrs))
+        num_spilled = None # older checkpoints don't say; take the whole file
+        for key in ('num_spilled', 'num_dropped'):
+            if key in saved.files:
+                num_spilled = int(saved[key])
+                break
+    spill_path = os.path.join(history_dir, spill_filename)
+    if os.path.isfile(spill_path):
+        spilled = np.fromfile(spill_path).reshape((-1, len(StateHistory.keys), num_ctrlrs))[:num_spilled]
+        history = np.concatenate((np.swapaxes(spilled, 0, 1), history), axis=1)
+    times, ods, outputs = (history[StateHistory.keys.index(key)] for key in ('update_time', 'od', 'output'))
+    stepped = ~np.isnan(times) & ~np.isnan(ods) # each row only has the controllers stepped together
+    lagoons = np.broadcast_to(np.arange(num_ctrlrs), times.shape)[stepped]
+    return make_recording(lagoons, times[stepped], ods[stepped], outputs[stepped], num_ctrlrs)
+
+def replay(recording, controllers, use_recorded_outputs=True):
+    '''
+    Step controllers through every recorded reading in time order, lagoon by lagoon, on the recorded
+    timestamps (never the real clock). controllers is a bank with one controller per lagoon, or a list of
+    TurbControllers (None for lagoons to skip). With use_recorded_outputs, each step is told the output
+    recorded at the lagoon's previous reading, where there is one, as the transfer that was really made.
+    Returns {'output', 'k_estimate'}: (lagoons, reads) arrays of what the controllers commanded and
+    estimated at each reading, nan where there was no reading.
+    '''
+    times, ods = recording['time'], recording['od']
+    num_lagoons, num_reads = times.shape
+    # transfer made after each lagoon's previous reading, as told to the step for the reading after it
+    last_transfers = np.full(times.shape, np.nan)
+    if use_recorded_outputs:
+        last_transfers[:, 1:] = recording['output'][:, :-1]
+    result = {'output': np.full(times.shape, np.nan), 'k_estimate': np.full(times.shape, np.nan)}
+    is_bank = hasattr(controllers, 'num_ctrlrs')
+    if is_bank:
+        bank = controllers
+        if bank.num_ctrlrs < num_lagoons:
+            raise ValueError('Controller bank has ' + str(bank.num_ctrlrs) + ' controllers for ' +
+                             str(num_lagoons) + ' lagoons')
+        has_reads = ~np.isnan(times[:, 0]) if num_reads else np.zeros(num_lagoons, dtype=bool)
+        bank.last_time[:num_lagoons][has_reads] = times[has_reads, 0] # so timestamps replay as recorded
+        for read_no in range(num_reads):
+            # the read_no'th reading of every lagoon that has one; lagoons are independent, so stepping
+            # them together keeps each lagoon's readings in time order
+            idxs = np.flatnonzero(~np.isnan(times[:, read_no]))
+            if not len(idxs):
+                continue
+            outputs = bank.step(times[idxs, read_no] - bank.last_time[idxs], ods[idxs, read_no],
+                                last_transfers[idxs, read_no], idxs=idxs)
+            result['output'][idxs, read_no] = outputs
+            result['k_estimate'][idxs, read_no] = bank.k_estimate[idxs]
+        return result
+    for lagoon, controller in enumerate(controllers[:num_lagoons]):
+        reads = np.flatnonzero(~np.isnan(times[lagoon]))
+        if controller is None or not len(reads):
+            continue
+        controller.state_history[-1] = dict(controller.state_history[-1], update_time=times[lagoon, reads[0]])
+        for read_no in reads:
+            last_transfer = last_transfers[lagoon, read_no]
+            result['output'][lagoon, read_no] = controller.step(times[lagoon, read_no] - controller._last_time(),
+                    ods[lagoon, read_no], None if np.isnan(last_transfer) else last_transfer)
+            result['k_estimate'][lagoon, read_no] = getattr(controller, 'k_estimate', np.nan)
+    return result
+
+def read_setpoints(manifest_path, num_lagoons, default_setpoint):
+    # controller manifest rows are "plateN,<well>",<setpoint or off>; lagoons run down the plate columns
+    setpoints = np.full(num_lagoons, default_setpoint)
+    active = np.ones(num_lagoons, dtype=bool)
+    if not os.path.isfile(manifest_path):
+        return setpoints, active
+    with open(manifest_path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2:
+                continue
+            plate, well = row[0].split(',')
+            lagoon = (int(plate[len('plate'):])*wells_per_plate + (int(well[1:]) - 1)*8
+                      + 'ABCDEFGH'.index(well[0].upper()))
+            if lagoon >= num_lagoons:
+                continue
+            if row[1].strip().lower() == 'off':
+                active[lagoon] = False
+            else:
+                setpoints[lagoon] = float(row[1])
+    return setpoints, active
+
+def controller_class(spec):
+    module_name, class_name = spec.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+def parse_setting(text):
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+if __name__ == '__main__':
+    method_local_dir = os.path.join('..', 'method_local')
+    if arg_value('histories', ''):
+        recording = recording_from_histories(arg_value('histories', ''))
+    elif arg_value('bank', ''):
+        recording = recording_from_bank(arg_value('bank', ''))
+    else:
+        dbs = [filename for filename in os.listdir(method_local_dir) if filename.split('.')[-1] == 'db']
+        db_name = arg_value('db', dbs[0] if len(dbs) == 1 else '')
+        if db_name not in dbs:
+            print('can\'t find the database to replay from, please specify with --db=<name in ' + method_local_dir + '>')
+            exit()
+        with sqlite3.connect(os.path.join(method_local_dir, db_name)) as conn:
+            recording = recording_from_db(conn)
+    num_lagoons, num_reads = recording['time'].shape
+    setpoints, active = read_setpoints(arg_value('manifest', os.path.join(method_local_dir, 'controller_manifest.csv')),
+                                       num_lagoons, arg_value('setpoint', .6))
+    output_limits = arg_value('min-output', .1), arg_value('max-output', 1.0) # robot_method's 15 and 150 uL of 150
+    settings = dict(arg.split('=', 1) for arg in sys.argv[1:] if '=' in arg and not arg.startswith('--'))
+    cls = controller_class(arg_value('controller', 'turb_control.ParamEstTurbCtrlrBank'))
+    if issubclass(cls, ParamEstTurbCtrlrBank):
+        controllers = cls(num_lagoons)
+        controllers.set_history_window(1) # replay returns what's needed
+        controllers.setpoint[:] = setpoints
+        controllers.output_limits = output_limits
+        for name, value in settings.items():
+            getattr(controllers, name)[:] = parse_setting(value)
+    else:
+        controllers = [cls() if is_active else None for is_active in active]
+        for controller, setpoint in zip(controllers, setpoints):
+            if controller is not None:
+                controller.setpoint = setpoint
+                controller.output_limits = output_limits
+                for name, value in settings.items():
+                    setattr(controller, name, parse_setting(value))
+
+    start_time = time.time()
+    result = replay(recording, controllers, use_recorded_outputs='--own-outputs' not in sys.argv)
+    print('replayed', int((~np.isnan(recording['time'])).sum()), 'readings of', num_lagoons, 'lagoons in',
+          round(time.time() - start_time, 2), 's')
+
+    turb_vol = arg_value('turb-vol', 150.0)
+    out_path = arg_value('out', 'replay.csv')
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['lagoon', 'active', 'setpoint', 'reads', 'replay_media_uL', 'recorded_media_uL',
+                         'replay_mean_output', 'recorded_mean_output', 'final_k_estimate'])
+        for lagoon in range(num_lagoons):
+            outputs, recorded = result['output'][lagoon], recording['output'][lagoon]
+            stepped, was_recorded = ~np.isnan(outputs), ~np.isnan(recorded)
+            k_estimates = result['k_estimate'][lagoon][stepped]
+            writer.writerow([lagoon, int(active[lagoon]), setpoints[lagoon], int(stepped.sum()),
+                             outputs[stepped].sum()*turb_vol,
+                             recorded[was_recorded].sum()*turb_vol if was_recorded.any() else '',
+                             outputs[stepped].mean() if stepped.any() else '',
+                             recorded[was_recorded].mean() if was_recorded.any() else '',
+                             k_estimates[-1] if len(k_estimates) else ''])
+    replay_media = np.nansum(result['output'][active])*turb_vol/1000
+    recorded_media = np.nansum(recording['output'][active])*turb_vol/1000
+    print('media: replay', round(replay_media, 1), 'mL, recorded', round(recorded_media, 1), 'mL; wrote', out_path)
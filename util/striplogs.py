@@ -1,94 +1,235 @@
 import datetime as dt
 import os
+import re
 import sys
 import csv
+import gzip
+import json
+import mmap
+import base64
+from array import array
 
 do_plot = '--plot' in sys.argv
 do_export = '--noexport' not in sys.argv
 include_all = '--all' in sys.argv
+resume = '--resume' in sys.argv
 
 '''
 Hi Emma! Use this with no arguments to create getlogstuff_output.csv and do your R magic to it.
 It automatically attempts to only output the chunk of data corresponding to the last real experiment run with real data. If you don't want it to be smart and just want everything in the whole log, just use the --all switch, i.e.
     py getlogstuff.py --all
+The log is read in one pass, so it works on logs of any size. main.log is rotated (main.log.1.gz is the
+newest old segment), and every segment still there is read, oldest first. With --resume, it picks up where
+the last run left off (saved in striplogs_state.json) instead of reading the whole log again, even if the
+log has been rotated since. --plates=N sets how many plates are read per cycle (default 5, as in
+robot_method).
 '''
 
+def arg_value(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--' + name + '='):
+            return type(default)(arg.split('=', 1)[1])
+    return default
+
+num_plates = arg_value('plates', 5)
+log_path = os.path.join('..', 'method_local', 'log', 'main.log')
+state_path = 'striplogs_state.json'
+tokens = ('OD ESTIMATES', 'K ESTIMATES', 'REPLACEMENT VOLUMES', 'CONVERTED OD READINGS', 'FLUORESCENCE RFP READINGS',
+          'FLUORESCENCE YFP READINGS', 'FLUORESCENCE CFP READINGS')
+split_marker = b' root INFO '
+block_gap = 30*60 # seconds without a reading that start a new experiment run
+
 if do_plot:
     from matplotlib import pyplot as plt
 
-csv_rows = []
-
-with open(os.path.join('..', 'method_local', 'log', 'main.log')) as f:
-    lines = [l for l in f]
-    print(lines[0])
-def process_token(token):
-    split_token = ' root INFO ' + token + ' '
-    contiguous_blocks = [[]]
-    num_plates = 3
-    last_time = start_time = None
-    plate_rotation = 0
-    build_data = []
-    for line in lines:
-        if split_token in line:
-            plate_rotation = (plate_rotation + 1) % num_plates
-            time_str, data = line.split(split_token)
-            time = dt.datetime.strptime(time_str, '[%Y-%m-%d %H:%M:%S,%f]')
-            #if last_time:
-            #    print((time - last_time).seconds)
-            if last_time and (include_all or (time - last_time).seconds > 30*60):
-                contiguous_blocks.append([])
-            current_block = contiguous_blocks[-1]
-            #print(len(current_block))
-            if not current_block:
-                start_time = time
-            delta_time = time - start_time
-            build_data += eval(data)
-            if plate_rotation == 0:
-                print(len(build_data))
-                current_block.append((delta_time.seconds/3600+delta_time.days*24, build_data))
-                build_data = []
-            last_time = time
-
-    # expected shape of contiguous_blocks for some particular split token:
-    # dim 1: Number of different experiment runs separated by an hour, or more, maybe 3-5
-    # dim 2: Varies; number of time points in each of those separated blocks
-    # dim 3: 2. One time, a float, and a list of data.
-    # dim 4: (For the first element, the time, n/a.) For the second element: 96, or however many vessels there are.
-    #print(len(contiguous_blocks[-1]))
-    #print(len(contiguous_blocks[-1][0]))
-    #print(len(contiguous_blocks[-1][0][1]))
-    #print(len(contiguous_blocks[-1][0][1][0]))
-    #print('those ^ three things')
-    #print(len(contiguous_blocks))
-    #print(time)
-    #print(start_time)
-    last_block = []
-    while len(last_block) < 5:
-        last_block = contiguous_blocks.pop()
-    print(last_block)
-    times, datablock = zip(*last_block)
-    print(times)
+def parse_values(payload):
+    # a logged list like "[0.1, 2, None, nan]" -> floats, None as nan; no eval
+    payload = payload.strip()
+    if not (payload.startswith('[') and payload.endswith(']')):
+        raise ValueError('Not a list of values: ' + payload[:40])
+    return [float('nan') if item.strip() == 'None' else float(item) for item in payload[1:-1].split(',') if item.strip()]
+
+def parse_log_time(time_str):
+    # '[2020-03-01 14:05:09,123' -> seconds since the epoch, without the cost of strptime on every line
+    return dt.datetime(int(time_str[1:5]), int(time_str[6:8]), int(time_str[9:11]), int(time_str[12:14]),
+                       int(time_str[15:17]), int(time_str[18:20]), int(time_str[21:24])*1000).timestamp()
+
+class TokenSeries:
+    '''
+    Builds the time series for one token as lines stream past: consecutive lines are gathered into one
+    time point per cycle of num_plates, and a gap of more than block_gap starts a new block (run). Only
+    the blocks the output can still come from are kept: the one being built and the latest finished one
+    with at least min_points time points.
+    '''
+    min_points = 5
+
+    def __init__(self, token, state=None):
+        self.token = token
+        state = state or {}
+        # [[(hours since block start, values for every well), ...], ...]
+        self.blocks = [[(hours, unpack_values(values)) for hours, values in block] for block in state.get('blocks', [[]])]
+        self.build_data = state.get('build_data', [])
+        self.plate_rotation = state.get('plate_rotation', 0)
+        self.last_time = state.get('last_time')
+        self.start_time = state.get('start_time')
+
+    def add(self, time, values):
+        self.plate_rotation = (self.plate_rotation + 1) % num_plates
+        if self.last_time is not None and not include_all and time - self.last_time > block_gap:
+            finished = self.blocks.pop()
+            if len(finished) >= self.min_points:
+                self.blocks = [finished]
+            self.blocks.append([])
+        if not self.blocks[-1]:
+            self.start_time = time
+        self.build_data += values
+        if self.plate_rotation == 0:
+            self.blocks[-1].append(((time - self.start_time)/3600, array('d', self.build_data))) # 8 bytes a value
+            self.build_data = []
+        self.last_time = time
+
+    def state(self):
+        return {'blocks': [[(hours, pack_values(values)) for hours, values in block] for block in self.blocks],
+                'build_data': self.build_data, 'plate_rotation': self.plate_rotation,
+                'last_time': self.last_time, 'start_time': self.start_time}
+
+    def last_block(self):
+        # the latest run with at least min_points time points, or None
+        for block in reversed(self.blocks):
+            if len(block) >= self.min_points:
+                return block
+        return None
+
+def pack_values(values):
+    # saved state keeps each time point as base64 of the raw doubles, which is compact and exact
+    return base64.b64encode(values.tobytes()).decode()
+
+def unpack_values(packed):
+    values = array('d')
+    values.frombytes(base64.b64decode(packed))
+    return values
+
+def scan_log(path, series_by_token, offset=0):
+    '''
+    One pass over a log segment from byte offset, handing every matching line to its token's series. The
+    live log is memory-mapped; a rotated, gzipped segment is decompressed into memory (segments are at
+    most the rotation size). Returns the offset to resume from: the start of the first incomplete line.
+    '''
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as f:
+            return scan_buffer(f.read(), series_by_token, offset)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= offset:
+            return offset
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            return scan_buffer(log_map, series_by_token, offset)
+
+def scan_buffer(log_map, series_by_token, offset=0):
+    # lines that don't contain split_marker are skipped by searching for the marker directly rather than
+    # reading line by line
+    token_keys = {token.encode(): token for token in series_by_token}
+    pos = offset
+    while True:
+        marker_pos = log_map.find(split_marker, pos)
+        if marker_pos < 0:
+            return max(pos, log_map.rfind(b'\n', pos) + 1)
+        line_start = max(pos, log_map.rfind(b'\n', pos, marker_pos) + 1)
+        line_end = log_map.find(b'\n', marker_pos)
+        if line_end < 0: # still being written
+            return line_start
+        pos = line_end + 1
+        rest = log_map[marker_pos + len(split_marker):line_end]
+        token = token_keys.get(rest[:rest.find(b' [')])
+        if token is None:
+            continue
+        time = parse_log_time(log_map[line_start:marker_pos].decode())
+        values = parse_values(rest[len(token) + 1:].decode())
+        series_by_token[token].add(time, values)
+
+def segment_head(path):
+    # the first line identifies a segment, as rotation renames main.log.1.gz to main.log.2.gz and so on
+    with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+        return f.readline().decode(errors='replace')
+
+def log_segments():
+    # (path, first line) of main.log's rotated segments (main.log.N.gz, oldest first), then main.log itself
+    log_dir, log_name = os.path.split(log_path)
+    rotated = []
+    for name in os.listdir(log_dir):
+        match = re.fullmatch(re.escape(log_name) + r'\.(\d+)\.gz', name)
+        if match:
+            rotated.append((int(match.group(1)), os.path.join(log_dir, name)))
+    paths = [path for _, path in sorted(rotated, reverse=True)] + ([log_path] if os.path.isfile(log_path) else [])
+    return [(path, segment_head(path)) for path in paths]
+
+def load_state(segments):
+    if resume and os.path.isfile(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        # the segment read last has to still be there (now main.log or a rotated one) to carry on from it
+        if (state['log_head'] in [head for _, head in segments] and
+                state['num_plates'] == num_plates and state['include_all'] == include_all):
+            return state
+        print('log or options changed since the saved state; reading the whole log')
+    return {'done_heads': [], 'log_head': None, 'offset': 0, 'series': {}}
+
+def scan_segments(segments, series_by_token, state):
+    '''
+    Read every segment not already read in full, oldest first, resuming the one read last at its saved
+    offset. Returns (first lines of segments read in full, first line of the last segment read, offset in it).
+    '''
+    done_heads, log_head, offset = set(state['done_heads']), state['log_head'], state['offset']
+    for path, head in segments:
+        if not head or head in done_heads: # empty (just rotated), or read before
+            continue
+        offset = scan_log(path, series_by_token, offset if head == log_head else 0)
+        log_head = head
+        if path.endswith('.gz'): # rotated, so complete
+            done_heads.add(head)
+    return [head for _, head in segments if head in done_heads], log_head, offset
+
+def save_state(done_heads, log_head, offset, series_by_token):
+    state = {'done_heads': done_heads, 'log_head': log_head, 'offset': offset, 'num_plates': num_plates,
+             'include_all': include_all,
+             'series': {token: series.state() for token, series in series_by_token.items()}}
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+if __name__ == '__main__':
+    segments = log_segments()
+    state = load_state(segments)
+    series_by_token = {token: TokenSeries(token, state['series'].get(token)) for token in tokens}
+    done_heads, log_head, offset = scan_segments(segments, series_by_token, state)
+    save_state(done_heads, log_head, offset, series_by_token)
+    print('read', len(segments), 'segments of', log_path, 'up to byte', offset, 'of the last')
+
+    csv_rows = []
+    for token, series in series_by_token.items():
+        last_block = series.last_block()
+        if last_block is None:
+            print('no run with enough', token, 'readings')
+            continue
+        times, datablock = zip(*last_block)
+        print(token, len(times), 'time points')
+        if do_export:
+            cols = [([] if csv_rows else ['hours']) + list(times),
+                    ([] if csv_rows else ['datatype']) + [token.replace(' ', '') for _ in times]]
+            for turbnum, time_course in enumerate(zip(*datablock)):
+                cols.append(([] if csv_rows else ['turb_' + str(turbnum)]) + list(time_course))
+            for row in zip(*cols):
+                csv_rows.append(row)
+        if do_plot:
+            plt.figure(token)
+            for time_course in zip(*datablock):
+                plt.plot(times, time_course)
+
     if do_export:
-        cols = [([] if csv_rows else ['hours']) + list(times),
-                ([] if csv_rows else ['datatype']) + [token.replace(' ', '') for _ in times]]
-        for turbnum, time_course in enumerate(zip(*datablock)):
-            cols.append(([] if csv_rows else ['turb_' + str(turbnum)]) + list(time_course))
-        for row in zip(*cols):
-            csv_rows.append(row)
+        print('exporting')
+        with open('getlogstuff_output.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            for row in csv_rows:
+                writer.writerow(row)
     if do_plot:
-        plt.figure(token)
-        # print(token)
-        for time_course in zip(*datablock):
-            plt.plot(times, time_course)
-
-for token in 'OD ESTIMATES', 'K ESTIMATES', 'REPLACEMENT VOLUMES', 'CONVERTED OD READINGS', 'FLUORESCENCE RFP READINGS', 'FLUORESCENCE YFP READINGS', 'FLUORESCENCE CFP READINGS':
-    process_token(token)
-    
-if do_export:
-    print('exporting')
-    with open('getlogstuff_output.csv', 'w', newline='') as f:
-        writer = csv.writer(f)
-        for row in csv_rows:
-            writer.writerow(row)
-if do_plot:
-    plt.show()
+        plt.show()
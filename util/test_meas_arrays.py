@@ -0,0 +1,80 @@
+import os
+import sqlite3
+import numpy as np
+from meas_db import create_meas_table
+from meas_arrays import load_measurements_by_type, time_bins, MeasurementCache, cache_dtype
+
+def test_types_from_one_query_match_per_type_queries():
+    conn = sqlite3.connect(':memory:')
+    create_meas_table(conn, 'measurements')
+    rng = np.random.default_rng(0)
+    rows = []
+    for cycle in range(5):
+        for lagoon in rng.permutation(10): # inserted out of order
+            for data_type in ('abs', 'lum', 'yfp'):
+                filename = ('dummy' if cycle == 2 and lagoon == 3 else data_type) + '_240301_12%02d.csv' % cycle
+                rows.append((int(lagoon), filename, 'plate_0', 1e9 + 60*cycle + lagoon, 'A1', 0.0,
+                             float(rng.random()), data_type, 0, ''))
+    conn.executemany('INSERT INTO measurements VALUES (?,?,?,?,?,?,?,?,?,?)', rows)
+    by_type = load_measurements_by_type(conn, ('abs', 'lum', 'cfp'), since=1e9 + 60)
+    assert set(by_type) == {'abs', 'lum', 'cfp'} and not len(by_type['cfp']['rowid'])
+    for data_type in ('abs', 'lum'):
+        expected = conn.execute('SELECT rowid, lagoon_number, timestamp, reading FROM measurements WHERE data_type=?'
+                                ' AND filename NOT LIKE ? AND timestamp>=? ORDER BY timestamp, lagoon_number',
+                                (data_type, '%dummy%', 1e9 + 60)).fetchall()
+        assert len(expected) == 4*10 - 1 # first cycle before since, one dummy read
+        for key, col in zip(('rowid', 'lagoon', 'timestamp', 'reading'), zip(*expected)):
+            np.testing.assert_array_equal(by_type[data_type][key], col)
+
+def test_time_bins_follow_plate_read_cycles_as_the_period_drifts():
+    lagoons, timestamps, cycles = [], [], []
+    start = 0.0
+    for cycle in range(12):
+        period = 900 + 60*cycle # drifts by well over half the first period
+        for plate in range(3):
+            if (cycle, plate) == (5, 1):
+                continue # a missed read
+            lagoons += range(plate*96, plate*96 + 96)
+            timestamps += [start + plate*period/3]*96
+            cycles += [cycle]*96
+        start += period
+    order = np.random.default_rng(0).permutation(len(lagoons)) # as if loaded by lagoon, not by time
+    lagoons, timestamps, cycles = np.array(lagoons)[order], np.array(timestamps)[order], np.array(cycles)[order]
+    bins, bin_times = time_bins(lagoons, timestamps)
+    np.testing.assert_array_equal(bins, cycles)
+    np.testing.assert_allclose(bin_times, [timestamps[cycles == cycle].mean() for cycle in range(12)])
+    empty_bins, empty_times = time_bins(np.zeros(0, dtype=np.int64), np.zeros(0))
+    assert not len(empty_bins) and not len(empty_times)
+
+def add_reads(conn, cycle, data_type='abs'):
+    conn.executemany('INSERT INTO measurements VALUES (?,?,?,?,?,?,?,?,?,?)',
+                     [(lagoon, data_type + '_240301_12%02d.csv' % cycle, 'plate_0', 1e9 + 60*cycle, 'A1', 0.0,
+                       cycle + lagoon/100, data_type, 0, '') for lagoon in range(4)])
+
+def test_cache_appends_new_rows_per_since(tmp_path):
+    db_path = str(tmp_path/'sim.db')
+    conn = sqlite3.connect(db_path)
+    create_meas_table(conn, 'measurements')
+    for cycle in range(3):
+        add_reads(conn, cycle)
+    cache = MeasurementCache(db_path, 'abs', since=1e9 + 60)
+    later_cache = MeasurementCache(db_path, 'abs', since=1e9 + 120)
+    assert cache.path != later_cache.path # different start times don't share (and rebuild) one cache
+    data, new_lagoons = cache.update(conn)
+    assert len(data['rowid']) == 8 and new_lagoons.tolist() == [0, 1, 2, 3]
+    add_reads(conn, 3)
+    with open(cache.path, 'ab') as f:
+        f.write(b'\x01'*5) # torn by a crash mid-append
+    size = os.path.getsize(cache.path)
+    data, new_lagoons = cache.update(conn)
+    assert os.path.getsize(cache.path) == size - 5 + 4*cache_dtype.itemsize # just the new rows appended
+    assert len(data['rowid']) == 12 and new_lagoons.tolist() == [0, 1, 2, 3]
+    expected = load_measurements_by_type(conn, ('abs',), since=1e9 + 60)['abs']
+    for key in expected:
+        np.testing.assert_array_equal(data[key], expected[key])
+    data, new_lagoons = MeasurementCache(db_path, 'abs', since=1e9 + 60).update(conn) # nothing new
+    assert len(data['rowid']) == 12 and not len(new_lagoons)
+    np.testing.assert_array_equal(data['reading'], expected['reading'])
+    conn.execute('UPDATE measurements SET reading=-1 WHERE rowid=(SELECT max(rowid) FROM measurements)')
+    data, new_lagoons = cache.update(conn) # the database changed under the cache: rebuilt
+    assert data['reading'][-1] == -1 and len(new_lagoons) == 4
@@ -0,0 +1,82 @@
+import os
+import gzip
+import datetime as dt
+import pytest
+import striplogs
+
+def log_line(time, token, values):
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S,') + '%03d' % (time.microsecond//1000)
+    return '[' + stamp + '] root INFO ' + token + ' ' + str(values) + '\n'
+
+def log_lines(num_cycles, start=dt.datetime(2024, 3, 1, 12)):
+    lines = [log_line(start - dt.timedelta(minutes=1), 'Begin execution of robot_method.py', [])]
+    for cycle in range(num_cycles):
+        for plate in range(striplogs.num_plates):
+            time = start + dt.timedelta(minutes=20*cycle, seconds=10*plate)
+            lines.append(log_line(time, 'OD ESTIMATES', [cycle + plate/10, float('nan')]))
+            lines.append(log_line(time, 'FLOW RATES', [.1, .2])) # not extracted
+    return lines
+
+def rotate(log_dir):
+    # as CompressingRotatingFileHandler does: shift the numbered segments up, gzip main.log to main.log.1.gz
+    log_path = os.path.join(log_dir, 'main.log')
+    rotated = sorted((int(name.split('.')[2]) for name in os.listdir(log_dir) if name.endswith('.gz')), reverse=True)
+    for n in rotated:
+        os.replace(os.path.join(log_dir, 'main.log.%d.gz' % n), os.path.join(log_dir, 'main.log.%d.gz' % (n + 1)))
+    with open(log_path, 'rb') as f_in, gzip.open(log_path + '.1.gz', 'wb') as f_out:
+        f_out.write(f_in.read())
+    open(log_path, 'w').close()
+
+def extract(state=None):
+    segments = striplogs.log_segments()
+    state = striplogs.load_state(segments)
+    series = {token: striplogs.TokenSeries(token, state['series'].get(token)) for token in striplogs.tokens}
+    done_heads, log_head, offset = striplogs.scan_segments(segments, series, state)
+    striplogs.save_state(done_heads, log_head, offset, series)
+    return [(hours, list(values)) for hours, values in series['OD ESTIMATES'].blocks[-1]]
+
+@pytest.fixture
+def log_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(striplogs, 'log_path', str(tmp_path/'main.log'))
+    monkeypatch.setattr(striplogs, 'state_path', str(tmp_path/'striplogs_state.json'))
+    monkeypatch.setattr(striplogs, 'resume', True)
+    return str(tmp_path)
+
+def write(log_dir, lines):
+    with open(os.path.join(log_dir, 'main.log'), 'a') as f:
+        f.writelines(lines)
+
+def test_reads_rotated_segments_in_order(log_dir):
+    lines = log_lines(12)
+    for chunk in (lines[:31], lines[31:70], lines[70:]):
+        write(log_dir, chunk)
+        rotate(log_dir)
+    write(log_dir, log_lines(14)[len(lines):]) # live segment
+    time_points = extract()
+    assert len(time_points) == 14
+    assert [values[0] for _, values in time_points] == [cycle for cycle in range(14)]
+    assert time_points[3][0] == pytest.approx(1.0)
+
+def test_resume_across_rotation(log_dir):
+    lines = log_lines(20)
+    write(log_dir, lines[:45])
+    write(log_dir, [lines[45][:20]]) # partly written line
+    assert len(extract()) == 4
+    with open(os.path.join(log_dir, 'main.log'), 'a') as f:
+        f.write(lines[45][20:])
+    write(log_dir, lines[46:120])
+    rotate(log_dir)
+    write(log_dir, lines[120:150])
+    rotate(log_dir)
+    write(log_dir, lines[150:])
+    resumed = extract()
+    os.remove(striplogs.state_path)
+    assert str(resumed) == str(extract()) # same as reading every segment from scratch (nan != nan)
+    assert len(resumed) == 20
+
+def test_replaced_log_read_from_scratch(log_dir):
+    write(log_dir, log_lines(8))
+    extract()
+    os.remove(os.path.join(log_dir, 'main.log'))
+    write(log_dir, log_lines(6, start=dt.datetime(2024, 4, 1)))
+    assert len(extract()) == 6
@@ -0,0 +1,171 @@
+import os
+import sys
+import csv
+import time
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from turbsim import SimPopulation, ParamEstTurbCtrlrBank
+
+'''
+Sweep ParamEstTurbCtrlr tuning over simulated populations and tabulate how each configuration does.
+Tuning parameters are given as name=values, values being a comma separated list or, for --random=N, a
+lo:hi range to draw from. Without --random every combination of the lists is run (a grid); parameters
+not given keep the controller's defaults. e.g.
+    py tune_ctrlr.py k_smoothing=.05,.15,.3 approach_frac=.5,.7,.9
+    py tune_ctrlr.py --random=500 k_smoothing=.02:.5 approach_frac=.3:1 max_k=1.5,3
+Each configuration controls a population of wells covering every growth rate (--ks), measurement noise
+level (--noise) and --replicates replicates, through a setpoint schedule of --cycles cycles per setpoint
+(--setpoints). Configurations are split across a pool of --workers processes, and each process steps all
+of its configurations' wells as one controller bank. Results go to --out (default tuning_sweep.csv),
+sorted by --sort (default ss_error_pct):
+    settling_hr_median, settling_hr_p90 - time after each setpoint change until od stays within
+                                         --settle-tol (fraction of the setpoint) of it, over wells that settle
+    unsettled_frac - fraction of (well, setpoint) segments that never settle
+    overshoot_pct_mean, overshoot_pct_max - od beyond the setpoint, as a percent of the setpoint change
+                                           (or of the settling band, if that's larger)
+    ss_error_pct - mean |od - setpoint| over the last quarter of each segment, as a percent of the setpoint
+    media_per_hr - commanded transfer volume, in lagoon volumes per hour
+'''
+
+tuning_defaults = {'k_smoothing': .15, 'approach_frac': .7, 'min_k': .05, 'max_k': 3.0}
+metric_names = ('settling_hr_median', 'settling_hr_p90', 'unsettled_frac', 'overshoot_pct_mean', 'overshoot_pct_max',
+                'ss_error_pct', 'media_per_hr')
+
+def arg_value(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--' + name + '='):
+            return type(default)(arg.split('=', 1)[1])
+    return default
+
+def float_list(text):
+    return [float(val) for val in text.split(',')]
+
+def tuning_configs(param_args, num_random=0, seed=0):
+    '''Configurations (dicts over tuning_defaults) from name=values args: their grid, or num_random draws'''
+    specs = {}
+    for arg in param_args:
+        name, values = arg.split('=', 1)
+        if name not in tuning_defaults:
+            raise ValueError('Unknown tuning parameter ' + name + '; expected one of ' + ', '.join(tuning_defaults))
+        specs[name] = tuple(float(val) for val in values.split(':')) if ':' in values else float_list(values)
+    if not num_random:
+        ranged = [name for name, spec in specs.items() if isinstance(spec, tuple)]
+        if ranged:
+            raise ValueError('Ranges (' + ', '.join(ranged) + ') need --random=N')
+        names = list(specs)
+        return [dict(tuning_defaults, **dict(zip(names, values))) for values in itertools.product(*specs.values())]
+    rng = np.random.default_rng(seed)
+    draws = {name: rng.uniform(*spec, num_random) if isinstance(spec, tuple) else rng.choice(spec, num_random)
+             for name, spec in specs.items()}
+    return [dict(tuning_defaults, **{name: float(vals[i]) for name, vals in draws.items()}) for i in range(num_random)]
+
+def population(scenario):
+    # (growth k, measurement noise, initial od) of each well every configuration is tried on
+    ks, noises = np.meshgrid(scenario['ks'], scenario['noise'], indexing='ij')
+    ks, noises = np.repeat(ks.ravel(), scenario['replicates']), np.repeat(noises.ravel(), scenario['replicates'])
+    init_od = np.linspace(.01, .41, len(ks)) # spread starting points, as visualize_ctrlr does
+    return ks, noises, init_od
+
+def response_metrics(od, output, setpoints, init_od, cycle_time, settle_tol):
+    '''
+    Per-well metrics over a run: od (as read) and output are (cycles, wells) traces, setpoints is
+    (cycles,). Returns {name: (segments, wells)} for settling_hr, overshoot_pct and ss_error_pct, and
+    media_per_hr (wells,).
+    '''
+    changes = np.flatnonzero(np.diff(setpoints)) + 1
+    bounds = list(zip(np.concatenate(([0], changes)), np.concatenate((changes, [len(setpoints)]))))
+    settling, overshoot, ss_error = [], [], []
+    for start, end in bounds:
+        setpoint = setpoints[start]
+        seg = od[start:end]
+        start_od = init_od if start == 0 else od[start - 1]
+        # settled from the cycle after the last one outside the band; never, if that's the segment's last
+        outside = np.abs(seg - setpoint) > settle_tol*setpoint
+        last_outside = np.where(outside.any(0), len(seg) - 1 - np.argmax(outside[::-1], 0), -1)
+        settled = last_outside + 1
+        settling.append(np.where(settled < len(seg), settled*cycle_time/3600, np.nan))
+        # relative to the size of the change, but no smaller than the band, for wells starting near the setpoint
+        direction = np.sign(setpoint - start_od)
+        step_size = np.maximum(np.abs(setpoint - start_od), settle_tol*setpoint)
+        overshoot.append(np.maximum(0, (direction*(seg - setpoint)).max(0))/step_size*100)
+        tail = seg[len(seg)*3//4:]
+        ss_error.append(np.abs(tail - setpoint).mean(0)/setpoint*100)
+    hours = len(setpoints)*cycle_time/3600
+    return {'settling_hr': np.array(settling), 'overshoot_pct': np.array(overshoot),
+            'ss_error_pct': np.array(ss_error), 'media_per_hr': output.sum(0)/hours}
+
+def run_configs(configs, scenario):
+    '''Simulate configs together as one controller bank; one row of metric_names per config'''
+    ks, noises, init_od = population(scenario)
+    wells_per_config = len(ks)
+    num_wells = len(configs)*wells_per_config
+    bank = ParamEstTurbCtrlrBank(num_wells, init_k=scenario['init_k'])
+    bank.set_history_window(1) # the traces are kept by the simulation
+    for name in tuning_defaults:
+        getattr(bank, name)[:] = np.repeat([config[name] for config in configs], wells_per_config)
+    setpoints = np.repeat(scenario['setpoints'], scenario['cycles'])
+    sim = SimPopulation(bank, scenario['cycle_time'], setpoints=setpoints, init_od=np.tile(init_od, len(configs)),
+                        growth_k=np.tile(ks, len(configs)), seed=scenario['seed'], meas_noise=np.tile(noises, len(configs)))
+    traces = sim.run(len(setpoints), record=('read_od', 'output'))
+    metrics = response_metrics(traces['read_od'], traces['output'], setpoints, np.tile(init_od, len(configs)),
+                               scenario['cycle_time'], scenario['settle_tol'])
+    rows = []
+    for i, config in enumerate(configs):
+        wells = slice(i*wells_per_config, (i + 1)*wells_per_config)
+        settling = metrics['settling_hr'][:, wells]
+        settled = settling[~np.isnan(settling)]
+        rows.append(dict(config,
+            settling_hr_median=float(np.median(settled)) if len(settled) else np.nan,
+            settling_hr_p90=float(np.percentile(settled, 90)) if len(settled) else np.nan,
+            unsettled_frac=float(np.isnan(settling).mean()),
+            overshoot_pct_mean=float(np.nanmean(metrics['overshoot_pct'][:, wells])),
+            overshoot_pct_max=float(np.nanmax(metrics['overshoot_pct'][:, wells])),
+            ss_error_pct=float(metrics['ss_error_pct'][:, wells].mean()),
+            media_per_hr=float(metrics['media_per_hr'][wells].mean())))
+    return rows
+
+def sweep(configs, scenario, workers=None, chunk_size=16):
+    # chunks of configurations to a process pool; each chunk is one vectorized simulation
+    chunks = [configs[i:i + chunk_size] for i in range(0, len(configs), chunk_size)]
+    if workers == 1:
+        return [row for chunk in chunks for row in run_configs(chunk, scenario)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return [row for rows in pool.map(run_configs, chunks, itertools.repeat(scenario)) for row in rows]
+
+def write_table(rows, path, sort_key):
+    rows = sorted(rows, key=lambda row: (np.isnan(row[sort_key]), row[sort_key]))
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(tuning_defaults) + list(metric_names))
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+if __name__ == '__main__':
+    # growth rates the output limits (.05 to .68 of the lagoon volume per cycle) can hold at the setpoint
+    scenario = {'ks': float_list(arg_value('ks', '.3,.5,.7,.9,1.1,1.3')),
+                'noise': float_list(arg_value('noise', '.002,.005,.01')),
+                'replicates': arg_value('replicates', 2),
+                'setpoints': float_list(arg_value('setpoints', '.45,.3,.8')),
+                'cycles': arg_value('cycles', 100), # per setpoint
+                'cycle_time': arg_value('cycle-time', 20*60),
+                'settle_tol': arg_value('settle-tol', .05),
+                'init_k': arg_value('init-k', .5),
+                'seed': arg_value('seed', 0)}
+    param_args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not param_args:
+        param_args = ['k_smoothing=.05,.1,.15,.25,.4', 'approach_frac=.4,.55,.7,.85,1', 'max_k=1.5,3']
+    configs = tuning_configs(param_args, arg_value('random', 0), scenario['seed'])
+    workers = arg_value('workers', os.cpu_count() or 1)
+    sort_key = arg_value('sort', 'ss_error_pct')
+    if sort_key not in metric_names:
+        print('--sort must be one of', ', '.join(metric_names))
+        exit()
+    start_time = time.time()
+    rows = sweep(configs, scenario, workers)
+    out_path = arg_value('out', 'tuning_sweep.csv')
+    rows = write_table(rows, out_path, sort_key)
+    print(len(configs), 'configurations x', len(population(scenario)[0]), 'wells in',
+          round(time.time() - start_time, 1), 's; wrote', out_path)
+    for row in rows[:10]:
+        print(', '.join(name + '=' + str(round(row[name], 3)) for name in list(tuning_defaults) + [sort_key, 'media_per_hr']))
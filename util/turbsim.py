@@ -1,126 +1,257 @@
-import os
-import sys
-turb_ctrl_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-if turb_ctrl_path not in sys.path:
-    sys.path.append(turb_ctrl_path)
-
-from turb_control import ParamEstTurbCtrlr
-import numpy as np
-import matplotlib.pyplot as plt
-import random
-import time
-import threading
-
-class SimTurbidostat:
-    def __init__(self, controller, cycle_time, setpoint=0.0, init_od=None, growth_k=2.08): # commonly cited double every 20 minutes
-        self.cycle_time = cycle_time # in seconds
-        self.growth_k = growth_k # ground truth k (hrs^-1), different from controller k estimate
-        if init_od is None:
-            init_od = controller.last_known_od()
-        else:
-            self = init_od # ground truth od, different from controller od
-        self.od = init_od/(1 + controller.last_known_output())
-        controller.output_limits = .05, .68
-        controller.setpoint = setpoint
-        self.controller = controller
-        self.wait_thread = None
-
-    def update(self, realtime=False):
-        if self.wait_thread: # use threading for delays to allow multiple simultaneous real-time simulations
-            self.wait_thread.join()
-        # grow culture
-        self.od = self.od*np.exp(self.cycle_time/3600*self.growth_k)
-        delta_time = None if realtime else self.cycle_time
-        meas_noise = rand_between(-.005, .005) + .1/(1+random.random()*10000) # Occasional very large spikes, as when clumps occlude sensor
-        if delta_time:
-            transfer_vol_frac = self.controller.step(delta_time, self.od + meas_noise)
-        else:
-            transfer_vol_frac = self.controller(self.od + meas_noise) # exercise callable functionality
-        # add mechanical/operational noise
-        actual_transfer_vol_frac = transfer_vol_frac + rand_between(-.01, .01)
-        # dilute according to command
-        self.od = self.od/(1+actual_transfer_vol_frac)
-        if realtime:
-            self.wait_thread = threading.Thread(target=lambda: time.sleep(cycle_time))
-            self.wait_thread.start() 
-
-    def set_k(self, k):
-        self.growth_k = k
-
-    def set_od(self, od):
-        self.od = od
-
-def rand_between(a, b):
-    return min(a,b) + random.random()*abs(b-a)
-
-realtime = '--realtime' in sys.argv
-load = '--load' in sys.argv
-
-if __name__ == '__main__':
-    normal_cycle_time = 15*60 # 15 mins in seconds
-    if realtime:
-        cycle_time = .1
-    else:
-        cycle_time = normal_cycle_time
-
-    xs = []
-    controllers = [ParamEstTurbCtrlr(init_k=.45) for _ in range(24)]
-    if load:
-        for controller in controllers:
-            try:
-                controller.load(from_dir='sim_controller_history')
-            except ValueError:
-                pass
-    sim_turbs = [SimTurbidostat(ctrlr, cycle_time) for ctrlr in controllers]
-
-    def get_history(turb, key):
-        return [state.get(key, 0) for state in turb.controller.history()]
-
-    def plotem():
-        od_courses, output_courses, k_courses = ([st.controller.scrape_history(key) for st in sim_turbs] for key in ('od', 'output', 'k_estimate'))
-        #print(k_courses)
-        plt.plot(xs, list(zip(*od_courses)))
-        plt.figure()
-        plt.plot(xs, list(zip(*output_courses)))
-        plt.figure()
-        plt.plot(xs, list(zip(*k_courses)))
-        plt.show()
-
-    try:
-        for w, sim_turb in enumerate(sim_turbs):
-            sim_turb.setpoint = .45
-            if not load:
-                sim_turb.set_od(rand_between(.0002, .5))
-            time_norm = normal_cycle_time*10 if realtime else 1
-            if realtime:
-                sim_turb.controller.k_limits = .05, 25000
-            if w < 12:
-                # linear range between 2 bounds
-                sim_turb.set_k((w/12*.3 + (12-w)/12*.5)*time_norm)
-            else:
-                # linear range between 2 bounds
-                w -= 12
-                sim_turb.set_k((w/12*1.1 + (12-w)/12*1.3)*time_norm)
-
-        for i in range(100 if realtime else 200):
-            try:
-                tooth_size = 40
-                if i % tooth_size == 0:
-                    tooth_height = .02 + rand_between(0,.06)
-                    for w, sim_turb in enumerate(sim_turbs):
-                        sim_turb.controller.setpoint = (i%(tooth_size*2)/tooth_size)*tooth_height+.4
-                        #print((i%(tooth_size*2)/tooth_size)*tooth_height+.4)
-                for sim_turb in sim_turbs:
-                    sim_turb.update(realtime=realtime)
-                print('cycle:', i)
-                #time.sleep(cycle_time/sim_time_dilation)
-            except KeyboardInterrupt:
-                import pdb; pdb.set_trace()
-
-        xs = [i*normal_cycle_time/3600 for i in range(len(sim_turbs[0].controller.history()))]
-
-        plotem()
-    finally:
-        for sim_turb in sim_turbs:
-            sim_turb.controller.save(save_dir='sim_controller_history')
-
+import os
+import sys
+turb_ctrl_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if turb_ctrl_path not in sys.path:
+    sys.path.append(turb_ctrl_path)
+
+from turb_control import ParamEstTurbCtrlr, ParamEstTurbCtrlrBank
+import numpy as np
+import matplotlib.pyplot as plt
+import random
+import time
+import threading
+
+class SimTurbidostat:
+    def __init__(self, controller, cycle_time, setpoint=0.0, init_od=None, growth_k=2.08): # commonly cited double every 20 minutes
+        self.cycle_time = cycle_time # in seconds
+        self.growth_k = growth_k # ground truth k (hrs^-1), different from controller k estimate
+        if init_od is None:
+            init_od = controller.last_known_od()
+        else:
+            self = init_od # ground truth od, different from controller od
+        self.od = init_od/(1 + controller.last_known_output())
+        controller.output_limits = .05, .68
+        controller.setpoint = setpoint
+        self.controller = controller
+        self.wait_thread = None
+
+    def update(self, realtime=False):
+        if self.wait_thread: # use threading for delays to allow multiple simultaneous real-time simulations
+            self.wait_thread.join()
+        # grow culture
+        self.od = self.od*np.exp(self.cycle_time/3600*self.growth_k)
+        delta_time = None if realtime else self.cycle_time
+        meas_noise = rand_between(-.005, .005) + .1/(1+random.random()*10000) # Occasional very large spikes, as when clumps occlude sensor
+        if delta_time:
+            transfer_vol_frac = self.controller.step(delta_time, self.od + meas_noise)
+        else:
+            transfer_vol_frac = self.controller(self.od + meas_noise) # exercise callable functionality
+        # add mechanical/operational noise
+        actual_transfer_vol_frac = transfer_vol_frac + rand_between(-.01, .01)
+        # dilute according to command
+        self.od = self.od/(1+actual_transfer_vol_frac)
+        if realtime:
+            self.wait_thread = threading.Thread(target=lambda: time.sleep(cycle_time))
+            self.wait_thread.start() 
+
+    def set_k(self, k):
+        self.growth_k = k
+
+    def set_od(self, od):
+        self.od = od
+
+def rand_between(a, b):
+    return min(a,b) + random.random()*abs(b-a)
+
+class WellRandom:
+    '''
+    Independent, reproducible random streams, one per well: uniform(stream, cycle) gives a number in [0, 1)
+    for every well, from splitmix64 of (seed, well, stream, cycle). A well's noise doesn't depend on how
+    many other wells are simulated or in what order, and there's no generator object per well.
+    '''
+    golden_gamma = np.uint64(0x9E3779B97F4A7C15)
+    num_streams = 4 # distinct streams per cycle
+
+    def __init__(self, num_wells, seed=0):
+        with np.errstate(over='ignore'):
+            self.keys = self._mix(np.full(num_wells, seed, dtype=np.uint64)*self.golden_gamma
+                                  + np.arange(num_wells, dtype=np.uint64))
+
+    @staticmethod
+    def _mix(z):
+        with np.errstate(over='ignore'):
+            z = (z ^ (z >> np.uint64(30)))*np.uint64(0xBF58476D1CE4E5B9)
+            z = (z ^ (z >> np.uint64(27)))*np.uint64(0x94D049BB133111EB)
+            return z ^ (z >> np.uint64(31))
+
+    def uniform(self, stream, cycle, low=0.0, high=1.0):
+        counter = np.array([cycle*self.num_streams + stream + 1], dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            bits = self._mix(self.keys + counter*self.golden_gamma)
+        return low + (bits >> np.uint64(11))*(2.0**-53)*(high - low)
+
+class SimPopulation:
+    '''
+    Many simulated turbidostat wells advanced together as arrays: the same growth, measurement noise
+    (small uniform noise plus occasional large spikes, as when clumps occlude the sensor) and pipetting
+    noise as SimTurbidostat, for every well in one step. controllers is either a ParamEstTurbCtrlrBank,
+    stepped as a whole, or a list of TurbControllers (e.g. ParamEstTurbCtrlr), stepped one by one.
+    growth_k (hrs^-1) and the noise sizes may be scalars or one value per well, and can be changed between
+    cycles. setpoints is a scalar, an array with one row per cycle (scalar or per well), or a function of
+    the cycle number.
+    '''
+    meas_stream, spike_stream, transfer_stream = range(3)
+
+    def __init__(self, controllers, cycle_time, setpoints=0.0, init_od=None, growth_k=2.08, seed=0,
+                 meas_noise=.005, spike_size=.1, transfer_noise=.01):
+        self.controllers = controllers
+        self.is_bank = isinstance(controllers, ParamEstTurbCtrlrBank)
+        self.num_wells = controllers.num_ctrlrs if self.is_bank else len(controllers)
+        self.cycle_time = cycle_time # in seconds
+        self.growth_k = np.broadcast_to(np.asarray(growth_k, dtype=float), (self.num_wells,)).copy()
+        self.setpoints = setpoints
+        self.meas_noise, self.spike_size, self.transfer_noise = meas_noise, spike_size, transfer_noise
+        self.random = WellRandom(self.num_wells, seed)
+        self.cycle = 0
+        if self.is_bank:
+            controllers.output_limits = .05, .68
+            last_od, last_output = controllers.last_od, controllers.last_output
+        else:
+            for controller in controllers:
+                controller.output_limits = .05, .68
+            last_od = np.array([controller.last_known_od() for controller in controllers])
+            last_output = np.array([controller.last_known_output() for controller in controllers])
+        if init_od is not None:
+            last_od = np.broadcast_to(np.asarray(init_od, dtype=float), (self.num_wells,))
+        self.od = last_od/(1 + last_output) # ground truth od, different from controller od
+        self.set_setpoints(0)
+
+    def set_setpoints(self, cycle):
+        if callable(self.setpoints):
+            setpoints = self.setpoints(cycle)
+        elif np.ndim(self.setpoints):
+            setpoints = self.setpoints[min(cycle, len(self.setpoints) - 1)]
+        else:
+            setpoints = self.setpoints
+        setpoints = np.broadcast_to(np.asarray(setpoints, dtype=float), (self.num_wells,))
+        if self.is_bank:
+            self.controllers.setpoint[:] = setpoints
+        else:
+            for controller, setpoint in zip(self.controllers, setpoints):
+                controller.setpoint = setpoint
+
+    def step_controllers(self, delta_time, od_meas):
+        if self.is_bank:
+            return self.controllers.step(delta_time, od_meas)
+        return np.array([controller.step(delta_time, meas) for controller, meas in zip(self.controllers, od_meas)])
+
+    def k_estimates(self):
+        if self.is_bank:
+            return self.controllers.k_estimate
+        return np.array([getattr(controller, 'k_estimate', np.nan) for controller in self.controllers])
+
+    def update(self, realtime=False):
+        '''One cycle for every well; returns (measured od, commanded transfer volume fraction)'''
+        self.set_setpoints(self.cycle)
+        # grow culture
+        self.od = self.od*np.exp(self.cycle_time/3600*self.growth_k)
+        self.read_od = self.od # true od when read, which is what the controller regulates
+        meas_noise = (self.random.uniform(self.meas_stream, self.cycle, -self.meas_noise, self.meas_noise)
+                      + self.spike_size/(1 + self.random.uniform(self.spike_stream, self.cycle)*10000))
+        od_meas = self.od + meas_noise
+        transfer_vol_frac = self.step_controllers(None if realtime else self.cycle_time, od_meas)
+        # add mechanical/operational noise, and dilute according to command
+        actual_transfer_vol_frac = transfer_vol_frac + self.random.uniform(self.transfer_stream, self.cycle,
+                                                                           -self.transfer_noise, self.transfer_noise)
+        self.od = self.od/(1 + actual_transfer_vol_frac)
+        self.cycle += 1
+        return od_meas, transfer_vol_frac
+
+    def run(self, num_cycles, realtime=False, record=('od', 'read_od', 'od_meas', 'output', 'k_estimate')):
+        '''
+        Run num_cycles cycles, returning {key: (num_cycles, num_wells) array} for the keys in record: true od
+        after each cycle's dilution, true od when read, measured od, controller output and k estimate. In
+        realtime, each cycle waits for cycle_time seconds (once for all wells) and controllers are stepped
+        on the real clock.
+        '''
+        traces = {key: np.empty((num_cycles, self.num_wells)) for key in record}
+        for i in range(num_cycles):
+            start_time = time.time()
+            od_meas, output = self.update(realtime)
+            for key, values in (('od', self.od), ('read_od', self.read_od), ('od_meas', od_meas), ('output', output)):
+                if key in traces:
+                    traces[key][i] = values
+            if 'k_estimate' in traces:
+                traces['k_estimate'][i] = self.k_estimates()
+            if realtime:
+                time.sleep(max(0, self.cycle_time - (time.time() - start_time)))
+        return traces
+
+def square_wave_setpoints(num_cycles, tooth_size=40, base=.4, seed=None):
+    # setpoint alternating between base and base plus a random height (.02 to .08) every tooth_size cycles
+    rng = np.random.default_rng(seed)
+    cycles = np.arange(num_cycles)
+    heights = .02 + rng.random(num_cycles//tooth_size + 1)*.06
+    return (cycles % (tooth_size*2) >= tooth_size)*heights[cycles//tooth_size] + base
+
+realtime = '--realtime' in sys.argv
+load = '--load' in sys.argv
+use_bank = '--bank' in sys.argv # step the wells with a ParamEstTurbCtrlrBank instead of one controller each
+
+def arg_value(name, default):
+    for arg in sys.argv[1:]:
+        if arg.startswith('--' + name + '='):
+            return type(default)(arg.split('=', 1)[1])
+    return default
+
+def ramp_growth_ks(num_wells):
+    # first half of the wells from .5 down to .3, second half from 1.3 down to 1.1 hrs^-1
+    half = num_wells//2
+    wells = np.arange(num_wells)
+    frac = np.where(wells < half, wells/max(half, 1), (wells - half)/max(num_wells - half, 1))
+    return np.where(wells < half, frac*.3 + (1 - frac)*.5, frac*1.1 + (1 - frac)*1.3)
+
+if __name__ == '__main__':
+    normal_cycle_time = 15*60 # 15 mins in seconds
+    if realtime:
+        cycle_time = .1
+    else:
+        cycle_time = normal_cycle_time
+    num_wells = arg_value('wells', 24)
+    num_cycles = arg_value('cycles', 100 if realtime else 200)
+    save_dir = 'sim_controller_history'
+
+    if use_bank:
+        controllers = ParamEstTurbCtrlrBank(num_wells, init_k=.45)
+        controllers.set_history_window(1) # the run's traces are kept by the simulation
+        if load:
+            try:
+                controllers.load(from_dir=save_dir)
+            except ValueError:
+                pass
+    else:
+        controllers = [ParamEstTurbCtrlr(init_k=.45) for _ in range(num_wells)]
+        if load:
+            for controller in controllers:
+                try:
+                    controller.load(from_dir=save_dir)
+                except ValueError:
+                    pass
+    time_norm = normal_cycle_time*10 if realtime else 1
+    if realtime:
+        controllers_k_limits = .05, 25000
+        if use_bank:
+            controllers.k_limits = controllers_k_limits
+        else:
+            for controller in controllers:
+                controller.k_limits = controllers_k_limits
+    init_od = None if load else np.random.uniform(.0002, .5, num_wells)
+    sim = SimPopulation(controllers, cycle_time, setpoints=square_wave_setpoints(num_cycles), init_od=init_od,
+                        growth_k=ramp_growth_ks(num_wells)*time_norm, seed=arg_value('seed', 0))
+
+    try:
+        start_time = time.time()
+        traces = sim.run(num_cycles, realtime=realtime)
+        print(num_wells, 'wells,', num_cycles, 'cycles in', round(time.time() - start_time, 2), 's')
+        if '--noplot' not in sys.argv:
+            xs = np.arange(num_cycles)*normal_cycle_time/3600
+            for key in ('od', 'output', 'k_estimate'):
+                plt.figure(key)
+                plt.plot(xs, traces[key][:, :100]) # more lines than this aren't readable anyway
+            plt.show()
+    finally:
+        if use_bank:
+            controllers.save(save_dir=save_dir)
+        else:
+            for controller in controllers:
+                controller.save(save_dir=save_dir)